@@ -0,0 +1,135 @@
+"""
+Middleware del proyecto.
+
+``WhiteNoiseMiddleware`` es el de WhiteNoise con modo asincrono. El
+original solo es sincrono y, bajo ASGI, Django ejecutaria por el en un
+unico hilo toda la cadena de cada peticion: una vista asincrona en espera
+(``services.views.game_wait``) bloquearia a todas las demas.
+
+El resto son los de Django con ``InlineHooksMixin``. En modo asincrono
+``MiddlewareMixin`` de Django 3.2 ejecuta cada ``process_request``,
+``process_view`` y ``process_response`` con ``sync_to_async``, en el unico
+hilo de las vistas sincronas: una docena de saltos de hilo por peticion
+que, en la rafaga de uniones de una partida grande, cuestan mas que las
+propias vistas asincronas (``restServer.play``). Esos metodos no hacen E/S
+salvo al guardar la sesion o los mensajes, asi que se ejecutan en el bucle
+de eventos y solo saltan al hilo cuando la peticion ha usado la sesion.
+"""
+import asyncio
+
+from asgiref.sync import markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.contrib.auth import middleware as auth
+from django.contrib.messages import middleware as messages
+from django.contrib.sessions import middleware as sessions
+from django.middleware import clickjacking, common, csrf, security
+from whitenoise import middleware
+
+
+class WhiteNoiseMiddleware(middleware.WhiteNoiseMiddleware):
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, settings=settings):
+        super().__init__(get_response, settings)
+        if asyncio.iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        # los ficheros estaticos se buscan en un diccionario en memoria
+        response = self.process_request(request)
+        if response is None:
+            response = await self.get_response(request)
+        return response
+
+
+class InlineHooksMixin:
+    """
+    Ejecuta en el bucle de eventos los metodos ``process_*`` de un
+    middleware de Django en modo asincrono, salvo cuando ``blocking``
+    indica que pueden consultar la base de datos.
+    """
+
+    def __init__(self, get_response=None):
+        super().__init__(get_response)
+        if asyncio.iscoroutinefunction(get_response) and \
+                hasattr(self, 'process_view'):
+            # Django adapta process_view con sync_to_async si no es una
+            # corrutina
+            process_view = self.process_view
+
+            async def aprocess_view(request, *args):
+                return process_view(request, *args)
+            self.process_view = aprocess_view
+
+    def blocking(self, request):
+        """
+        Indica si los metodos del middleware pueden hacer E/S en la peticion.
+
+        :param request: Petición HTTP
+
+        :return: True si deben ejecutarse en el hilo de las vistas
+            sincronas
+        """
+        return False
+
+    async def run(self, request, method, *args):
+        if self.blocking(request):
+            return await sync_to_async(method, thread_sensitive=True)(*args)
+        return method(*args)
+
+    async def __acall__(self, request):
+        response = None
+        if hasattr(self, 'process_request'):
+            response = await self.run(request, self.process_request, request)
+        response = response or await self.get_response(request)
+        if hasattr(self, 'process_response'):
+            response = await self.run(request, self.process_response,
+                                      request, response)
+        return response
+
+
+def session_used(request):
+    "la peticion ha leido o cambiado la sesion (su guardado consulta la BD)"
+    session = getattr(request, 'session', None)
+    return session is not None and (session.accessed or session.modified)
+
+
+class SecurityMiddleware(InlineHooksMixin, security.SecurityMiddleware):
+    pass
+
+
+class SessionMiddleware(InlineHooksMixin, sessions.SessionMiddleware):
+    def blocking(self, request):
+        return session_used(request)
+
+
+class CommonMiddleware(InlineHooksMixin, common.CommonMiddleware):
+    pass
+
+
+class CsrfViewMiddleware(InlineHooksMixin, csrf.CsrfViewMiddleware):
+    pass
+
+
+class AuthenticationMiddleware(InlineHooksMixin,
+                               auth.AuthenticationMiddleware):
+    pass
+
+
+class MessageMiddleware(InlineHooksMixin, messages.MessageMiddleware):
+    def blocking(self, request):
+        # los mensajes usados o nuevos se guardan en la sesion
+        storage = getattr(request, '_messages', None)
+        return session_used(request) or (
+            storage is not None and (storage.used or storage.added_new))
+
+
+class XFrameOptionsMiddleware(InlineHooksMixin,
+                              clickjacking.XFrameOptionsMiddleware):
+    pass
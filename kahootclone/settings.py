@@ -15,6 +15,7 @@ AUTORES: Alejandro Monterrubio, Juan Francisco Flores, Pablo Hernaez.
 import dj_database_url
 from pathlib import Path
 import os
+import sys
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -48,17 +49,24 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     'models.apps.ModelsConfig',
     'services.apps.ServicesConfig',
+    'rest_framework',
+    'restServer.apps.RestserverConfig',
 ]
 
 MIDDLEWARE = [
-    'whitenoise.middleware.WhiteNoiseMiddleware',
-    'django.middleware.security.SecurityMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
-    'django.middleware.common.CommonMiddleware',
-    'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
-    'django.contrib.messages.middleware.MessageMiddleware',
-    'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # WhiteNoise con modo asincrono, para las vistas asincronas bajo ASGI
+    'kahootclone.middleware.WhiteNoiseMiddleware',
+    # despues de WhiteNoise: los ficheros estaticos no se miden
+    'services.metrics.MetricsMiddleware',
+    'services.profiling.ProfilingMiddleware',
+    # los de Django, sin saltos de hilo en modo asincrono
+    'kahootclone.middleware.SecurityMiddleware',
+    'kahootclone.middleware.SessionMiddleware',
+    'kahootclone.middleware.CommonMiddleware',
+    'kahootclone.middleware.CsrfViewMiddleware',
+    'kahootclone.middleware.AuthenticationMiddleware',
+    'kahootclone.middleware.MessageMiddleware',
+    'kahootclone.middleware.XFrameOptionsMiddleware',
 ]
 
 ROOT_URLCONF = 'kahootclone.urls'
@@ -173,5 +181,71 @@ if not DEBUG:
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+REST_FRAMEWORK = {
+    # solo sesion: las peticiones anonimas rechazadas devuelven 403
+    'DEFAULT_AUTHENTICATION_CLASSES': [
+        'rest_framework.authentication.SessionAuthentication',
+    ],
+}
+
+# Ingesta de respuestas por lotes (services.ingestion)
+# DURABILITY: 'immediate', 'batch' (group commit) o 'async'
+GUESS_INGESTION = {
+    'DURABILITY': os.environ.get('GUESS_DURABILITY', 'batch'),
+    'MAX_BATCH': 100,
+    'MAX_DELAY': 0.02,
+}
+
+# Plazos de las partidas en el servidor (services.timers); los tests
+# avanzan las partidas a mano y no arrancan el hilo de los temporizadores
+GAME_TIMERS = {
+    'ENABLED': sys.argv[1:2] != ['test'],
+    'TICK': 0.05,
+    'WORKERS': 4,
+}
+
+# Bus de eventos entre workers (services.events): 'local' con un solo
+# proceso, 'unix' con varios workers en la misma maquina
+GAME_EVENTS = {
+    'BACKEND': os.environ.get('GAME_EVENTS', 'local'),
+    'PATH': os.environ.get('GAME_EVENTS_PATH',
+                           '/tmp/kahootclone-events.sock'),
+}
+
+# Vistas asincronas de juego (restServer.play, services.executor): hilos
+# para la base de datos y lotes de uniones. Los tests usan sync_to_async
+# (THREADS = 0) para compartir la conexion de la transaccion de cada test
+GAME_ASYNC = {
+    'THREADS': 0 if sys.argv[1:2] == ['test'] else int(
+        os.environ.get('GAME_ASYNC_THREADS', 8)),
+    'MAX_BATCH': 200,
+    'MAX_DELAY': 0.01,
+}
+
+# Tokens firmados de participantes y anfitriones (services.tokens)
+GAME_TOKENS = {
+    'TTL': 6 * 3600,
+    'ALGORITHM': 'HS256',
+}
+
+# Metricas de las peticiones y del juego (services.metrics); TOKEN permite
+# a Prometheus leer /services/metrics sin sesion de administrador
+GAME_METRICS = {
+    'ENABLED': True,
+    'TOKEN': os.environ.get('GAME_METRICS_TOKEN'),
+}
+
+# Perfilado bajo demanda (services.profiling): con la cabecera X-Profile
+# firmada o activandolo en /services/profiles
+GAME_PROFILING = {
+    'ENABLED': True,
+    'PATH': os.environ.get('GAME_PROFILING_PATH',
+                           '/tmp/kahootclone-profiles'),
+    'MAX_PROFILES': 100,
+    'SAMPLE_RATE': 0.1,
+    'VIEWS': (),
+    'HEADER_MAX_AGE': 3600,
+}
+
 LOGIN_REDIRECT_URL = 'home'
 LOGOUT_REDIRECT_URL = 'home'
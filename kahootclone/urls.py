@@ -24,6 +24,7 @@ urlpatterns = [
     path('accounts/', include('django.contrib.auth.urls')),
     path('models/', include('models.urls')),
     path('services/', include('services.urls')),
+    path('api/', include('restServer.urls')),
     path('', RedirectView.as_view(url='services/', permanent=True)),
 ]
 
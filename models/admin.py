@@ -37,11 +37,11 @@ admin.site.register(Answer, AnswerAdmin)
 
 
 class GameAdmin(admin.ModelAdmin):
-    list_display = ('questionnaire', 'created_at', 'state',
+    list_display = ('questionnaire', 'created_at', 'updated_at', 'state',
                     'publicId', 'countdownTime', 'questionNo')
-    list_filter = ('questionnaire', 'created_at', 'state',
+    list_filter = ('questionnaire', 'created_at', 'updated_at', 'state',
                    'publicId', 'countdownTime', 'questionNo')
-    ordering = ('questionnaire', 'created_at', 'state',
+    ordering = ('questionnaire', 'created_at', 'updated_at', 'state',
                 'publicId', 'countdownTime', 'questionNo')
 
 
@@ -7,18 +7,31 @@
 #
 # execute python manage.py  populate
 #
+# python manage.py populate --scale N generates N times the default sizes
+# with bulk_create in chunks of --chunk rows, so production-sized datasets
+# (millions of questions and answers) take minutes. --truncate empties the
+# tables with TRUNCATE (DELETE on SQLite) instead of deleting row by row
+# through the ORM; --scale always truncates.
+#
 # use module Faker generator to generate data
 # (https://zetcode.com/python/faker/)
 import os
 import time
+from itertools import islice
 
-from django.core.management.base import BaseCommand
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
 from models.models import User as User
 from models.models import Questionnaire as Questionnaire
 from models.models import Question as Question
 from models.models import Answer as Answer
 from models.models import Game as Game
 from models.models import Participant as Participant
+from models.models import Guess as Guess
+from models.models import FreePublicId, PublicIdCursor
+from models.constants import LEADERBOARD
 
 from faker import Faker
 import random
@@ -37,12 +50,27 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('publicId',
                             type=int,
+                            nargs='?',
+                            default=0,
                             help='game the participants will join to')
         parser.add_argument('sleep',
                             type=float,
+                            nargs='?',
                             default=2.,
                             help='wait this seconds until ' +
                             'inserting next participant')
+        parser.add_argument('--scale',
+                            type=int,
+                            default=0,
+                            help='multiply the default sizes and insert ' +
+                            'in bulk')
+        parser.add_argument('--chunk',
+                            type=int,
+                            default=5000,
+                            help='rows per bulk_create in --scale mode')
+        parser.add_argument('--truncate',
+                            action='store_true',
+                            help='empty the tables with TRUNCATE')
 
     def __init__(self, sneaky=True, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -75,9 +103,17 @@ class Command(BaseCommand):
 
         self.faker = Faker()
 
+        # bulk mode, production-sized datasets
+        if kwargs['scale']:
+            self.chunk = kwargs['chunk']
+            self.truncateDataBase()
+            self.scale(kwargs['scale'])
         # if no argument populate database
-        if not kwargs['publicId']:
-            self.cleanDataBase()   # clean database
+        elif not kwargs['publicId']:
+            if kwargs['truncate']:
+                self.truncateDataBase()
+            else:
+                self.cleanDataBase()   # clean database
             # The faker.Faker() creates and initializes a faker generator,
             self.user()  # create users
             self.questionnaire()  # create questionaries
@@ -100,6 +136,18 @@ class Command(BaseCommand):
         User.objects.all().delete()
         print("clean Database")
 
+    def truncateDataBase(self):
+        "empty the game tables at once, without the ORM delete collector"
+        models = [User, Questionnaire, Question, Answer, Game, Participant,
+                  Guess, FreePublicId, PublicIdCursor]
+        tables = [model._meta.db_table for model in models]
+        # TRUNCATE ... CASCADE on PostgreSQL, DELETE on SQLite
+        sql = connection.ops.sql_flush(no_style(), tables,
+                                       reset_sequences=True,
+                                       allow_cascade=True)
+        connection.ops.execute_sql_flush(sql)
+        print("truncate Database")
+
     def user(self):
         " Insert users"
         # create user
@@ -187,10 +235,174 @@ class Command(BaseCommand):
         Inserts participants
         '''
         print("Participants")
+        game = Game.objects.get(publicId=self.publicId)
         for _ in range(self.NUMBERPARTICIPANTS):
-            game = Game.objects.get(publicId=self.publicId)
             alias = self.faker.user_name()
             points = random.randint(0, 100)
             participant = Participant(game=game, alias=alias, points=points)
             participant.save()
             time.sleep(self.sleep)
+
+    # ---- bulk mode ----
+    def scale(self, scale):
+        """
+        Inserts ``scale`` times the default number of rows, in chunks.
+
+        Rows are generated lazily (one chunk in memory at a time); texts
+        and aliases come from a pool of Faker values because generating
+        millions of them one by one is what makes the default mode slow.
+        """
+        if not connection.features.can_return_rows_from_bulk_insert:
+            raise CommandError('--scale needs a database that returns the '
+                               'ids of bulk inserts (PostgreSQL)')
+        start = time.perf_counter()
+        self.sentences = [self.faker.sentence() for _ in range(1000)]
+        self.aliases = [self.faker.user_name() for _ in range(1000)]
+        users = self.scaleUsers(self.NUMBERUSERS * scale)
+        questionnaires = self.scaleQuestionnaires(
+            users, self.NUMBERQESTIONARIES * scale,
+            self.NUMBERQUESTIONS * scale)
+        self.scaleQuestions(questionnaires)
+        self.scaleGames(questionnaires, self.NUMBERGAMES * scale)
+        print("%d rows in %.1f s" % (self.rows, time.perf_counter() - start))
+
+    def bulk(self, model, objects):
+        "bulk_create a lazy iterable of objects in chunks, yield each chunk"
+        objects = iter(objects)
+        while True:
+            batch = list(islice(objects, self.chunk))
+            if not batch:
+                return
+            model.objects.bulk_create(batch, batch_size=self.chunk)
+            self.rows += len(batch)
+            yield batch
+
+    rows = 0
+
+    def sentence(self):
+        return random.choice(self.sentences)
+
+    def scaleUsers(self, number):
+        print("Users")
+        # every user shares one password, hashed once
+        password = make_password(self.faker.password(length=10))
+        prefix = self.faker.user_name()
+        ids = []
+        with transaction.atomic():
+            for batch in self.bulk(User, (
+                    User(username='%s%d' % (prefix, n),
+                         email='%s%d@example.com' % (prefix, n),
+                         password=password)
+                    for n in range(number))):
+                ids += [user.id for user in batch]
+        return ids
+
+    def scaleQuestionnaires(self, users, number, questions):
+        "questionnaires, with the number of questions each will get"
+        print("questionnaire")
+        counts = [0] * number
+        for _ in range(questions):
+            counts[random.randrange(number)] += 1
+        questionnaires = []
+        with transaction.atomic():
+            for batch in self.bulk(Questionnaire, (
+                    Questionnaire(title=self.sentence(),
+                                  user_id=random.choice(users),
+                                  question_count=count)
+                    for count in counts)):
+                questionnaires += [(questionnaire.id,
+                                    questionnaire.question_count)
+                                   for questionnaire in batch]
+        return questionnaires
+
+    def scaleQuestions(self, questionnaires):
+        "questions and their answers; positions as Question.save gives them"
+        print("Question and Answer")
+
+        def questions():
+            for questionnaire_id, count in questionnaires:
+                for position in range(count):
+                    yield Question(question=self.sentence() + "?",
+                                   questionnaire_id=questionnaire_id,
+                                   answerTime=random.randint(5, 60),
+                                   position=position)
+
+        def answers(batch):
+            for question in batch:
+                numberOfAnswers = random.randint(
+                    2, self.NUMBERANSWERPERQUESTION)
+                correctAnswer = random.randrange(numberOfAnswers)
+                for i in range(numberOfAnswers):
+                    yield Answer(answer=self.sentence(),
+                                 question_id=question.id,
+                                 correct=(i == correctAnswer))
+
+        with transaction.atomic():
+            for batch in self.bulk(Question, questions()):
+                for _ in self.bulk(Answer, answers(batch)):
+                    pass
+
+    def scaleGames(self, questionnaires, number):
+        """
+        Games with their participants and guesses. All but NUMBERGAMES
+        are finished (their PIN returned to the pool, as models.pins
+        does); the rest are new games with a PIN from the pool.
+        """
+        print("Game, Participant and Guess")
+        played = [random.choice(questionnaires)[0] for _ in range(number)]
+        active = played[-self.NUMBERGAMES:]
+        finished = played[:-self.NUMBERGAMES]
+        for start in range(0, len(finished), self.chunk):
+            with transaction.atomic():
+                self.scaleFinishedGames(finished[start:start + self.chunk])
+        for questionnaire_id in active:
+            Game(questionnaire_id=questionnaire_id).save()
+            self.rows += 1
+
+    def scaleFinishedGames(self, questionnaire_ids):
+        games = [game for batch in self.bulk(Game, (
+            Game(questionnaire_id=questionnaire_id, publicId=None,
+                 state=LEADERBOARD)
+            for questionnaire_id in questionnaire_ids)) for game in batch]
+        # questions and answers of the chunk, read once
+        questions = {}
+        for question_id, questionnaire_id, value in Question.objects.filter(
+                questionnaire_id__in=set(questionnaire_ids)).order_by(
+                'position').values_list('id', 'questionnaire_id', 'value'):
+            questions.setdefault(questionnaire_id, []).append(
+                [question_id, value, []])
+        by_id = {question[0]: question
+                 for questionnaire in questions.values()
+                 for question in questionnaire}
+        for answer_id, question_id, correct in Answer.objects.filter(
+                question_id__in=by_id).values_list(
+                'id', 'question_id', 'correct'):
+            by_id[question_id][2].append((answer_id, correct))
+
+        # every participant answers every question of the game
+        plays = []
+        for game in games:
+            game.questionNo = max(
+                len(questions.get(game.questionnaire_id, ())) - 1, 0)
+            for _ in range(self.NUMBERPARTICIPANTS):
+                choices = [(question_id, value, random.choice(answers))
+                           for question_id, value, answers
+                           in questions.get(game.questionnaire_id, ())
+                           if answers]
+                points = sum(value for _, value, (_, correct) in choices
+                             if correct)
+                plays.append((Participant(game_id=game.id,
+                                          alias=random.choice(self.aliases),
+                                          points=points), choices))
+        Game.objects.bulk_update(games, ['questionNo'],
+                                 batch_size=self.chunk)
+        for _ in self.bulk(Participant,
+                           (participant for participant, _ in plays)):
+            pass
+        for _ in self.bulk(Guess, (
+                Guess(participant_id=participant.id,
+                      game_id=participant.game_id,
+                      question_id=question_id, answer_id=answer_id)
+                for participant, choices in plays
+                for question_id, _, (answer_id, _) in choices)):
+            pass
@@ -0,0 +1,32 @@
+# Generated by Django 3.2.1 on 2026-10-18 07:29
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('models', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FreePublicId',
+            fields=[
+                ('publicId', models.IntegerField(primary_key=True, serialize=False)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PublicIdCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('segment', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='game',
+            name='publicId',
+            field=models.IntegerField(null=True, unique=True, validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(1000000)]),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.1 on 2026-10-18 07:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('models', '0002_public_id_pool'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='questionnaire',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,47 @@
+from django.db import migrations, models
+
+
+def number_questions(apps, schema_editor):
+    """Numera las preguntas existentes por orden de creacion"""
+    Questionnaire = apps.get_model('models', 'Questionnaire')
+    Question = apps.get_model('models', 'Question')
+    for questionnaire in Questionnaire.objects.all():
+        questions = list(Question.objects.filter(
+            questionnaire=questionnaire).order_by('id'))
+        for position, question in enumerate(questions):
+            question.position = position
+        Question.objects.bulk_update(questions, ['position'])
+        questionnaire.question_count = len(questions)
+        questionnaire.save(update_fields=['question_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('models', '0003_questionnaire_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='questionnaire',
+            name='question_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='question',
+            name='position',
+            field=models.PositiveIntegerField(default=0, editable=False),
+            preserve_default=False,
+        ),
+        migrations.RunPython(number_questions, migrations.RunPython.noop),
+        migrations.AlterModelOptions(
+            name='question',
+            options={'ordering': ['position']},
+        ),
+        migrations.AddConstraint(
+            model_name='question',
+            constraint=models.UniqueConstraint(
+                fields=('questionnaire', 'position'),
+                name='unique_question_position'),
+        ),
+    ]
@@ -0,0 +1,76 @@
+# Generated by Django 3.2.1 on 2026-10-18 08:16
+
+from django.db import migrations, models
+from django.db.models import Min
+import django.db.models.deletion
+import uuid
+
+
+def remove_repeated_guesses(apps, schema_editor):
+    """
+    Deja solo la primera respuesta de cada participante a cada pregunta,
+    para poder crear la restriccion de unicidad
+    """
+    Guess = apps.get_model('models', 'Guess')
+    first = (Guess.objects.order_by().values('participant', 'question')
+             .annotate(first=Min('id')).values('first'))
+    Guess.objects.exclude(id__in=first).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('models', '0004_question_position'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='participant',
+            name='uuidP',
+            field=models.UUIDField(default=uuid.uuid4, editable=False,
+                                   unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='guess',
+            index=models.Index(fields=['game', 'question', 'answer'],
+                               name='guess_game_question_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='participant',
+            index=models.Index(fields=['game', 'alias'],
+                               name='participant_game_alias_idx'),
+        ),
+        migrations.RunPython(remove_repeated_guesses,
+                             migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='guess',
+            constraint=models.UniqueConstraint(
+                fields=('participant', 'question'),
+                name='unique_guess_participant'),
+        ),
+        # los indices compuestos sustituyen a los de una sola columna
+        migrations.AlterField(
+            model_name='guess',
+            name='game',
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                to='models.game'),
+        ),
+        migrations.AlterField(
+            model_name='guess',
+            name='participant',
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                to='models.participant'),
+        ),
+        migrations.AlterField(
+            model_name='participant',
+            name='game',
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                to='models.game'),
+        ),
+    ]
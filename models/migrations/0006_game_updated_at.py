@@ -0,0 +1,32 @@
+# Generated by Django 3.2.1 on 2026-10-18 10:02
+
+from django.db import migrations, models
+from django.db.models import F
+import django.utils.timezone
+
+
+def copy_created_at(apps, schema_editor):
+    """
+    Las partidas existentes toman como ultima actividad su creacion, para
+    no retrasar la recuperacion de sus PIN
+    """
+    Game = apps.get_model('models', 'Game')
+    Game.objects.update(updated_at=F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('models', '0005_game_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True,
+                                       default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.RunPython(copy_created_at, migrations.RunPython.noop),
+    ]
@@ -1,9 +1,9 @@
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, Count, F, IntegerField, Value, When
 from django.core.validators import MaxValueValidator, MinValueValidator
 from .constants import WAITING, QUESTION, ANSWER, LEADERBOARD
 import uuid
-import random
 
 
 class User(AbstractUser):
@@ -19,6 +19,12 @@ class Questionnaire(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     # user = models.ForeignKey(User, on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # cambia con cada modificacion de sus preguntas o respuestas (la
+    # incrementan Question y Answer al guardarse y models.signals al
+    # borrarse)
+    version = models.PositiveIntegerField(default=0, editable=False)
+    # numero de preguntas, mantenido por Question.save y models.signals
+    question_count = models.PositiveIntegerField(default=0, editable=False)
 
     def __str__(self):
         """Devuelve el titulo del cuestionario representado por el modelo"""
@@ -29,6 +35,65 @@ class Questionnaire(models.Model):
         ordering = ['-updated_at']
 
 
+# desplazamiento temporal de las posiciones al renumerar, para no chocar
+# con el indice unico (cuestionario, posicion) a mitad del UPDATE
+POSITION_OFFSET = 10**6
+
+
+class QuestionQuerySet(models.QuerySet):
+    def reorder(self, questionnaire_id, question_ids):
+        """
+        Cambia el orden de las preguntas de un cuestionario con dos UPDATE.
+
+        :param questionnaire_id: Id del cuestionario
+        :param question_ids: Ids de todas sus preguntas en el orden nuevo
+
+        :raises ValueError: si los ids no son exactamente sus preguntas
+        """
+        question_ids = [int(pk) for pk in question_ids]
+        with transaction.atomic():
+            Questionnaire.objects.select_for_update().filter(
+                pk=questionnaire_id).exists()
+            questions = self.filter(questionnaire_id=questionnaire_id)
+            current = set(questions.values_list('id', flat=True))
+            if len(question_ids) != len(current) or \
+                    set(question_ids) != current:
+                raise ValueError(
+                    'the new order must list every question exactly once')
+            Questionnaire.objects.filter(pk=questionnaire_id).update(
+                version=F('version') + 1)
+            self._renumber(questions, question_ids)
+
+    def compact(self, questionnaire_id):
+        """
+        Recuenta las preguntas de un cuestionario, cierra los huecos que
+        dejan las borradas en su orden e incrementa su version.
+
+        :param questionnaire_id: Id del cuestionario
+        """
+        with transaction.atomic():
+            Questionnaire.objects.select_for_update().filter(
+                pk=questionnaire_id).exists()
+            rows = list(self.filter(questionnaire_id=questionnaire_id)
+                        .order_by('position').values_list('id', 'position'))
+            Questionnaire.objects.filter(pk=questionnaire_id).update(
+                question_count=len(rows), version=F('version') + 1)
+            if any(position != n for n, (_, position) in enumerate(rows)):
+                self._renumber(
+                    self.filter(questionnaire_id=questionnaire_id),
+                    [pk for pk, _ in rows])
+
+    def _renumber(self, questions, question_ids):
+        # dos UPDATE: todas fuera del rango y despues cada una a su sitio
+        if not question_ids:
+            return
+        questions.update(position=F('position') + POSITION_OFFSET)
+        questions.update(position=Case(
+            *[When(pk=pk, then=Value(position))
+              for position, pk in enumerate(question_ids)],
+            output_field=IntegerField()))
+
+
 class Question(models.Model):
     """Modelo que representa una pregunta"""
     question = models.CharField(max_length=255)
@@ -38,10 +103,50 @@ class Question(models.Model):
     answerTime = models.IntegerField(
         validators=[MinValueValidator(0)], default=20, blank=True)
     value = models.IntegerField(default=1)
+    # orden de la pregunta en el cuestionario, empezando en 0
+    position = models.PositiveIntegerField(editable=False)
+
+    objects = QuestionQuerySet.as_manager()
+
+    class Meta:
+        ordering = ['position']
+        constraints = [
+            models.UniqueConstraint(fields=['questionnaire', 'position'],
+                                    name='unique_question_position'),
+        ]
+
     """Devuelve un string con la pregunta representada por el modelo"""
     def __str__(self):
         return self.question
 
+    """
+    Guarda la pregunta e incrementa la version del cuestionario. Al crearla
+    la coloca al final del cuestionario y actualiza el numero de preguntas;
+    la fila del cuestionario se bloquea para que dos preguntas creadas a la
+    vez no reciban la misma posicion.
+    """
+    def save(self, *args, **kwargs):
+        changes = {'version': F('version') + 1}
+        with transaction.atomic():
+            if self._state.adding and self.position is None:
+                self.position = Questionnaire.objects.select_for_update() \
+                    .values_list('question_count', flat=True) \
+                    .get(pk=self.questionnaire_id)
+                changes['question_count'] = F('question_count') + 1
+            Questionnaire.objects.filter(pk=self.questionnaire_id).update(
+                **changes)
+            super(Question, self).save(*args, **kwargs)
+
+    """
+    Borra la pregunta con la fila del cuestionario ya bloqueada, en el mismo
+    orden que ``save``; el recuento y el orden los rehace models.signals.
+    """
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            Questionnaire.objects.select_for_update().filter(
+                pk=self.questionnaire_id).exists()
+            return super(Question, self).delete(*args, **kwargs)
+
 
 class Answer(models.Model):
     """Modelo que representa una respuesta"""
@@ -52,6 +157,17 @@ class Answer(models.Model):
     def __str__(self):
         return self.answer
 
+    def questionnaire_changed(self):
+        """Incrementa la version del cuestionario de la respuesta"""
+        Questionnaire.objects.filter(question=self.question_id).update(
+            version=F('version') + 1)
+
+    """Guarda la respuesta e incrementa la version del cuestionario"""
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super(Answer, self).save(*args, **kwargs)
+            self.questionnaire_changed()
+
 
 class Game(models.Model):
     """Modelo que representa un juego"""
@@ -64,20 +180,31 @@ class Game(models.Model):
 
     questionnaire = models.ForeignKey(Questionnaire, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
+    # ultima actividad de la partida (creacion o cambio de fase); con ella
+    # se decide cuando se recupera su PIN (ver models.pins)
+    updated_at = models.DateTimeField(auto_now=True)
     state = models.IntegerField(choices=STATE_CHOICES, default=WAITING)
-    publicId = models.IntegerField(unique=True, validators=[
+    # PIN de la partida; None cuando la partida ha terminado y su PIN se
+    # ha devuelto al reparto (ver models.pins)
+    publicId = models.IntegerField(unique=True, null=True, validators=[
                             MinValueValidator(1), MaxValueValidator(10**6)])
     countdownTime = models.IntegerField(
         validators=[MinValueValidator(0)], default=3)
     questionNo = models.IntegerField(default=0)
-    """Le asigna un publicId al juego si no tiene uno"""
+    """
+    Le asigna un publicId al juego si no tiene uno. El PIN se toma del
+    reparto de PIN libres en la misma transaccion que crea el juego, de
+    modo que si falla la creacion el PIN vuelve a estar libre.
+    """
     def save(self, *args, **kwargs):
-        if not self.publicId:
-            while True:
-                self.publicId = random.randint(1, 10**6)
-                if not Game.objects.filter(publicId=self.publicId).exists():
-                    break
-        super(Game, self).save(*args, **kwargs)
+        from .pins import allocator
+        with transaction.atomic():
+            if self._state.adding:
+                if not self.publicId:
+                    self.publicId = allocator.allocate()
+                else:
+                    allocator.reserve(self.publicId)
+            super(Game, self).save(*args, **kwargs)
     """
     Devuelve un string con el publicId del juego representado 
     por el modelo
@@ -86,11 +213,53 @@ class Game(models.Model):
         return str(self.publicId)
 
 
+class FreePublicId(models.Model):
+    """PIN libre, listo para asignarse a un juego nuevo"""
+    publicId = models.IntegerField(primary_key=True)
+
+
+class PublicIdCursor(models.Model):
+    """Siguiente bloque de PIN que se añadira al reparto"""
+    segment = models.IntegerField(default=0)
+
+
+class ParticipantQuerySet(models.QuerySet):
+    def add_points(self, points):
+        """
+        Suma puntos a varios participantes con un unico UPDATE atomico.
+
+        El incremento se hace en la base de datos
+        (``points = points + CASE id WHEN ... END``), por lo que respuestas
+        concurrentes del mismo participante no pierden puntos.
+
+        :param points: Diccionario id de participante -> puntos a sumar
+
+        :return: Numero de participantes actualizados
+        """
+        points = {pk: value for pk, value in points.items() if value}
+        if not points:
+            return 0
+        delta = Case(*[When(pk=pk, then=Value(value))
+                       for pk, value in points.items()],
+                     default=Value(0), output_field=IntegerField())
+        return self.filter(pk__in=points).update(points=F('points') + delta)
+
+
 class Participant(models.Model):
-    game = models.ForeignKey(Game, on_delete=models.CASCADE)
+    # el indice (game, alias) sirve tambien para filtrar por partida
+    game = models.ForeignKey(Game, on_delete=models.CASCADE, db_index=False)
     alias = models.CharField(max_length=255, default="Anonymous")
     points = models.IntegerField(default=0)
-    uuidP = models.UUIDField(default=uuid.uuid4, editable=False)
+    uuidP = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
+
+    objects = ParticipantQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # participantes de una partida y comprobacion del alias al unirse
+            models.Index(fields=['game', 'alias'],
+                         name='participant_game_alias_idx'),
+        ]
     """
     Devuelve un string con el alias del participante representado 
     por el modelo
@@ -100,21 +269,61 @@ class Participant(models.Model):
 
 
 
+class GuessQuerySet(models.QuerySet):
+    def answer_counts(self, game_id, question_id):
+        """
+        Numero de respuestas de cada opcion de una pregunta en una partida,
+        con una unica consulta ``GROUP BY answer_id``.
+
+        :param game_id: Id de la partida
+        :param question_id: Id de la pregunta
+
+        :return: Diccionario id de respuesta -> numero de respuestas
+        """
+        return dict(
+            self.filter(game_id=game_id, question_id=question_id)
+            .order_by().values('answer_id')
+            .annotate(count=Count('id')).values_list('answer_id', 'count'))
+
+
 class Guess(models.Model):
     """Modelo que representa una respuesta a una pregunta"""
-    participant = models.ForeignKey(Participant, on_delete=models.CASCADE)
-    game = models.ForeignKey(Game, on_delete=models.CASCADE)
+    # los indices compuestos de Meta empiezan por participant y por game:
+    # los de una sola columna solo encarecerian cada INSERT
+    participant = models.ForeignKey(Participant, on_delete=models.CASCADE,
+                                    db_index=False)
+    game = models.ForeignKey(Game, on_delete=models.CASCADE, db_index=False)
     question = models.ForeignKey(Question, on_delete=models.CASCADE)
     answer = models.ForeignKey(Answer, on_delete=models.CASCADE)
+
+    objects = GuessQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # respuestas a una pregunta de una partida y su reparto
+            models.Index(fields=['game', 'question', 'answer'],
+                         name='guess_game_question_idx'),
+        ]
+        constraints = [
+            # una respuesta por participante y pregunta, tambien entre
+            # workers: la base de datos rechaza la repetida
+            models.UniqueConstraint(fields=['participant', 'question'],
+                                    name='unique_guess_participant'),
+        ]
+
     """
-    Guarda la respuesta y suma los puntos al participante
+    Guarda la respuesta y suma los puntos al participante. La suma se hace
+    con un incremento atomico en la base de datos, no leyendo y
+    reescribiendo el participante, y solo al crear la respuesta.
     """
     def save(self, *args, **kwargs):
-        self.participant.points += (self.question.value
-                                    if self.answer.correct else 0)
-
-        self.participant.save()
-        super(Guess, self).save(*args, **kwargs)
+        points = 0
+        if self._state.adding:
+            points = self.question.value if self.answer.correct else 0
+        with transaction.atomic():
+            super(Guess, self).save(*args, **kwargs)
+            Participant.objects.add_points({self.participant_id: points})
+        self.participant.points += points
     """
     Devuelve un string con la respuesta representada por el modelo
     """
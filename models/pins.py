@@ -0,0 +1,171 @@
+"""
+Reparto de PIN (``Game.publicId``) en tiempo constante.
+
+Los PIN libres se guardan en la tabla ``FreePublicId``. Asignar un PIN es
+tomar una fila cualquiera de esa tabla y borrarla, en la misma transaccion
+que crea el juego. Con ``SELECT ... FOR UPDATE SKIP LOCKED`` varios
+procesos pueden asignar PIN a la vez sin esperarse ni repetir PIN.
+
+La tabla no contiene todo el espacio de PIN sino un bloque de
+``SEGMENT_SIZE`` PIN barajados. Cuando se vacia, un unico proceso (el que
+bloquea ``PublicIdCursor``) la rellena con los PIN libres del siguiente
+bloque. Antes de hacerlo recupera los PIN de las partidas terminadas hace
+mas de ``REUSE_AFTER`` segundos y de las abandonadas (sin terminar y sin
+actividad desde hace mas de ``ABANDON_AFTER`` segundos): esas partidas se
+quedan sin PIN y sus PIN vuelven al reparto. El tiempo se cuenta desde la
+ultima actividad de la partida (``Game.updated_at``), no desde su
+creacion.
+
+Los bloques se recorren en un orden salteado y en ciclo, de modo que los
+PIN recuperados que no caben en el reparto se vuelven a usar cuando se
+llega de nuevo a su bloque.
+"""
+import random
+from datetime import timedelta
+from math import gcd
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .constants import LEADERBOARD
+from .models import FreePublicId, Game, PublicIdCursor
+
+DEFAULTS = {
+    'MAX': 10**6,
+    'SEGMENT_SIZE': 1000,
+    'REUSE_AFTER': 24 * 3600,
+    'ABANDON_AFTER': 7 * 24 * 3600,
+}
+
+# paso con el que se recorren los bloques (primo con el numero de bloques)
+SEGMENT_STRIDE = 379
+
+
+class PublicIdsExhausted(Exception):
+    """No queda ningun PIN libre"""
+
+
+class PublicIdAllocator:
+    """
+    Asigna PIN libres a los juegos nuevos.
+
+    :param max_id: Mayor PIN posible (el menor es 1)
+    :param segment_size: PIN que se añaden al reparto de cada vez
+    :param reuse_after: Segundos tras los que se recupera el PIN de una
+        partida terminada
+    :param abandon_after: Segundos sin actividad tras los que se recupera
+        el PIN de una partida sin terminar
+    """
+
+    def __init__(self, max_id=None, segment_size=None, reuse_after=None,
+                 abandon_after=None):
+        self._max = max_id
+        self._segment_size = segment_size
+        self._reuse_after = reuse_after
+        self._abandon_after = abandon_after
+
+    def option(self, name):
+        value = getattr(self, '_' + name.lower())
+        if value is None:
+            options = getattr(settings, 'PUBLIC_IDS', {})
+            value = options.get(name, DEFAULTS[name])
+        return value
+
+    @property
+    def segments(self):
+        return -(-self.option('MAX') // self.option('SEGMENT_SIZE'))
+
+    def allocate(self):
+        """
+        Toma un PIN libre.
+
+        Debe llamarse dentro de la transaccion que crea el juego.
+
+        :return: PIN
+        :raises PublicIdsExhausted: si no queda ningun PIN libre
+        """
+        while True:
+            free = list(FreePublicId.objects.select_for_update(
+                skip_locked=True).order_by()
+                .values_list('publicId', flat=True)[:1])
+            if free:
+                # otro proceso sin bloqueo por filas (SQLite) puede haberlo
+                # tomado entre la lectura y el borrado
+                if FreePublicId.objects.filter(pk=free[0]).delete()[0]:
+                    return free[0]
+            elif not self.refill():
+                raise PublicIdsExhausted('no free game PIN left')
+
+    def reserve(self, publicId):
+        """Retira del reparto un PIN elegido a mano"""
+        FreePublicId.objects.filter(pk=publicId).delete()
+
+    def refill(self):
+        """
+        Rellena el reparto si esta vacio.
+
+        :return: False si no queda ningun PIN libre
+        """
+        with transaction.atomic():
+            segments = self.segments
+            # el primer bloque se elige al azar
+            PublicIdCursor.objects.get_or_create(
+                pk=1, defaults={'segment': random.randrange(segments)})
+            cursor = PublicIdCursor.objects.select_for_update().get(pk=1)
+            # otro proceso puede haberlo rellenado mientras esperabamos
+            if FreePublicId.objects.exists() or self.reclaim():
+                return True
+            stride = SEGMENT_STRIDE if gcd(SEGMENT_STRIDE, segments) == 1 \
+                else 1
+            for _ in range(segments):
+                segment = cursor.segment * stride % segments
+                cursor.segment = (cursor.segment + 1) % segments
+                free = self.free_in_segment(segment)
+                if free:
+                    random.shuffle(free)
+                    FreePublicId.objects.bulk_create(
+                        [FreePublicId(publicId=pin) for pin in free],
+                        ignore_conflicts=True)
+                    cursor.save(update_fields=['segment'])
+                    return True
+            return False
+
+    def free_in_segment(self, segment):
+        size = self.option('SEGMENT_SIZE')
+        first = segment * size + 1
+        last = min(first + size - 1, self.option('MAX'))
+        used = set(Game.objects.filter(publicId__range=(first, last))
+                   .values_list('publicId', flat=True))
+        return [pin for pin in range(first, last + 1) if pin not in used]
+
+    def reclaim(self):
+        """
+        Devuelve al reparto los PIN de las partidas terminadas hace mas de
+        ``REUSE_AFTER`` segundos y de las que llevan mas de
+        ``ABANDON_AFTER`` segundos sin actividad.
+
+        :return: Numero de PIN recuperados
+        """
+        now = timezone.now()
+        finished = Q(state=LEADERBOARD, updated_at__lt=now - timedelta(
+            seconds=self.option('REUSE_AFTER')))
+        abandoned = Q(updated_at__lt=now - timedelta(
+            seconds=self.option('ABANDON_AFTER')))
+        reclaimable = Game.objects.filter(
+            finished | abandoned,
+            publicId__isnull=False).select_for_update(skip_locked=True)
+        with transaction.atomic():
+            pins = list(reclaimable.values_list('publicId', flat=True)
+                        [:self.option('SEGMENT_SIZE')])
+            if pins:
+                Game.objects.filter(publicId__in=pins).update(publicId=None)
+                random.shuffle(pins)
+                FreePublicId.objects.bulk_create(
+                    [FreePublicId(publicId=pin) for pin in pins],
+                    ignore_conflicts=True)
+        return len(pins)
+
+
+allocator = PublicIdAllocator()
@@ -0,0 +1,83 @@
+"""
+Receptores de señales de los modelos de los cuestionarios.
+
+Los borrados se contabilizan aqui y no en ``delete()``: las señales se
+emiten tambien al borrar con un queryset (``filter(...).delete()``, la
+accion de borrado de la administracion) y en cascada (al borrar un
+cuestionario o su usuario), que no llaman al ``delete()`` de cada
+instancia.
+
+En un mismo borrado Django emite todas las ``pre_delete`` antes de borrar
+nada y las ``post_delete`` despues de borrar cada modelo, empezando por las
+respuestas. Cada cuestionario se recuenta y cada version se incrementa una
+sola vez por borrado, sin depender del numero de filas: las ``pre_delete``
+olvidan lo ya hecho en borrados anteriores y las ``post_delete`` anotan lo
+que hacen en ``_handled``.
+"""
+import threading
+
+from django.db.models.signals import post_delete, pre_delete
+from django.dispatch import receiver
+
+from .models import Answer, Question, Questionnaire
+
+# cuestionarios y preguntas ya atendidos en el borrado en curso, por hilo;
+# las marcas de las filas borradas se quitan al terminar, de modo que solo
+# quedan, como mucho, las de cuestionarios y preguntas que aun existen
+_local = threading.local()
+
+
+def _handled():
+    if not hasattr(_local, 'handled'):
+        _local.handled = set()
+    return _local.handled
+
+
+@receiver(pre_delete, sender=Answer, dispatch_uid='models_answer_deleting')
+def answer_deleting(sender, instance, **kwargs):
+    _handled().discard((Question, instance.question_id))
+
+
+@receiver(pre_delete, sender=Question,
+          dispatch_uid='models_question_deleting')
+def question_deleting(sender, instance, **kwargs):
+    handled = _handled()
+    handled.discard((Questionnaire, instance.questionnaire_id))
+    # las respuestas borradas en cascada no cambian la version: la cambia
+    # el recuento del cuestionario
+    handled.add((Question, instance.pk))
+
+
+@receiver(pre_delete, sender=Questionnaire,
+          dispatch_uid='models_questionnaire_deleting')
+def questionnaire_deleting(sender, instance, **kwargs):
+    # sus preguntas se borran con el: no hay que recontarlas
+    _handled().add((Questionnaire, instance.pk))
+
+
+@receiver(post_delete, sender=Question,
+          dispatch_uid='models_question_deleted')
+def question_deleted(sender, instance, **kwargs):
+    """Recuenta las preguntas del cuestionario y cierra el hueco"""
+    handled = _handled()
+    handled.discard((Question, instance.pk))
+    key = (Questionnaire, instance.questionnaire_id)
+    if key not in handled:
+        handled.add(key)
+        Question.objects.compact(instance.questionnaire_id)
+
+
+@receiver(post_delete, sender=Questionnaire,
+          dispatch_uid='models_questionnaire_deleted')
+def questionnaire_deleted(sender, instance, **kwargs):
+    _handled().discard((Questionnaire, instance.pk))
+
+
+@receiver(post_delete, sender=Answer, dispatch_uid='models_answer_deleted')
+def answer_deleted(sender, instance, **kwargs):
+    """Incrementa la version del cuestionario de la respuesta"""
+    handled = _handled()
+    key = (Question, instance.question_id)
+    if key not in handled:
+        handled.add(key)
+        instance.questionnaire_changed()
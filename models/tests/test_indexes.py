@@ -0,0 +1,83 @@
+from unittest import skipUnless
+
+from django.db import connection
+from django.db.models import Count
+from django.test import TestCase
+
+from models.models import (Answer, Game, Guess, Participant, Question,
+                           Questionnaire, User)
+
+GAMES = 200
+PARTICIPANTS = 50
+QUESTIONS = 5
+
+
+@skipUnless(connection.vendor == 'postgresql',
+            'los planes de EXPLAIN son los de PostgreSQL')
+class IndexTests(TestCase):
+    """El planificador usa los indices de los accesos del juego"""
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user(username='a', password='a')
+        questionnaire = Questionnaire.objects.create(title='q', user=user)
+        questions = [Question.objects.create(question='q%d' % n,
+                                             questionnaire=questionnaire)
+                     for n in range(QUESTIONS)]
+        answers = [Answer.objects.create(answer='a', question=question,
+                                         correct=True)
+                   for question in questions]
+        games = Game.objects.bulk_create([
+            Game(questionnaire=questionnaire, publicId=n + 1)
+            for n in range(GAMES)])
+        participants = Participant.objects.bulk_create([
+            Participant(game=game, alias='p%d' % n)
+            for game in games for n in range(PARTICIPANTS)])
+        Guess.objects.bulk_create([
+            Guess(participant=participant, game_id=participant.game_id,
+                  question=question, answer=answer)
+            for participant in participants
+            for question, answer in zip(questions, answers)])
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        cls.game = games[GAMES // 2]
+        cls.question = questions[2]
+        cls.participant = participants[len(participants) // 2]
+
+    def assertUsesIndex(self, queryset, index):
+        plan = queryset.explain()
+        self.assertIn(index, plan)
+        self.assertNotIn('Seq Scan', plan)
+
+    def test01_guesses_of_question(self):
+        "respuestas y reparto de una pregunta de una partida"
+        self.assertUsesIndex(
+            Guess.objects.filter(game=self.game, question=self.question),
+            'guess_game_question_idx')
+        self.assertUsesIndex(
+            Guess.objects.filter(game=self.game, question=self.question)
+            .order_by().values('answer_id').annotate(
+                count=Count('id')),
+            'guess_game_question_idx')
+
+    def test02_participants_of_game(self):
+        "participantes de una partida y comprobacion del alias"
+        self.assertUsesIndex(
+            Participant.objects.filter(game=self.game).order_by(),
+            'participant_game_alias_idx')
+        self.assertUsesIndex(
+            Participant.objects.filter(game=self.game, alias='p1'),
+            'participant_game_alias_idx')
+
+    def test03_participant_by_uuid(self):
+        "participante por su uuid"
+        self.assertUsesIndex(
+            Participant.objects.filter(uuidP=self.participant.uuidP),
+            'uuidP')
+
+    def test04_unique_guess(self):
+        "una respuesta por participante y pregunta, con su indice"
+        self.assertUsesIndex(
+            Guess.objects.filter(participant=self.participant,
+                                 question=self.question),
+            'unique_guess_participant')
@@ -0,0 +1,116 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import skipIf
+
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from models.constants import LEADERBOARD, QUESTION
+from models.models import FreePublicId, Game, Questionnaire, User
+from models.pins import PublicIdsExhausted
+
+SMALL_SPACE = {'MAX': 50, 'SEGMENT_SIZE': 10, 'REUSE_AFTER': 3600}
+
+
+class PinsTests(TestCase):
+    """Reparto de PIN de las partidas"""
+
+    def setUp(self):
+        user = User.objects.create_user(username='a', password='a')
+        self.questionnaire = Questionnaire.objects.create(title='q',
+                                                          user=user)
+
+    def create_game(self, **kwargs):
+        return Game.objects.create(questionnaire=self.questionnaire,
+                                   **kwargs)
+
+    def test01_unique_until_exhausted(self):
+        "se asignan todos los PIN del espacio sin repetir"
+        with self.settings(PUBLIC_IDS=SMALL_SPACE):
+            pins = [self.create_game().publicId for _ in range(50)]
+            self.assertEqual(sorted(pins), list(range(1, 51)))
+            with self.assertRaises(PublicIdsExhausted):
+                self.create_game()
+
+    def test02_constant_queries(self):
+        "asignar un PIN no depende de cuantos esten ocupados"
+        with self.settings(PUBLIC_IDS=SMALL_SPACE):
+            self.create_game()
+            with CaptureQueriesContext(connection) as first:
+                self.create_game()
+            for _ in range(6):
+                self.create_game()
+            with CaptureQueriesContext(connection) as later:
+                self.create_game()
+        self.assertEqual(len(first), len(later))
+
+    def test03_explicit_pin(self):
+        "un PIN elegido a mano se retira del reparto"
+        with self.settings(PUBLIC_IDS=SMALL_SPACE):
+            pin = self.create_game().publicId
+            free = FreePublicId.objects.values_list('publicId', flat=True)
+            chosen = free[0]
+            self.create_game(publicId=chosen)
+            self.assertNotIn(chosen, list(free))
+            self.assertNotEqual(pin, chosen)
+
+    def test04_reclaim_finished(self):
+        "los PIN de las partidas terminadas hace tiempo se reutilizan"
+        with self.settings(PUBLIC_IDS=SMALL_SPACE):
+            games = [self.create_game() for _ in range(50)]
+            old = games[0]
+            Game.objects.filter(pk__in=[old.pk, games[1].pk]).update(
+                updated_at=timezone.now() - timedelta(hours=2))
+            Game.objects.filter(pk=old.pk).update(state=LEADERBOARD)
+            game = self.create_game()
+        self.assertEqual(game.publicId, old.publicId)
+        old.refresh_from_db()
+        self.assertIsNone(old.publicId)
+
+    def test05_reclaim_by_activity(self):
+        "se cuenta desde la ultima actividad y se recuperan las abandonadas"
+        space = dict(SMALL_SPACE, ABANDON_AFTER=5 * 3600)
+        with self.settings(PUBLIC_IDS=space):
+            games = [self.create_game() for _ in range(50)]
+            now = timezone.now()
+            # partida larga: creada hace mucho pero terminada ahora mismo
+            Game.objects.filter(pk=games[0].pk).update(
+                state=LEADERBOARD, created_at=now - timedelta(hours=10))
+            # partida abandonada a mitad de pregunta
+            Game.objects.filter(pk=games[1].pk).update(
+                state=QUESTION, updated_at=now - timedelta(hours=6))
+            # sin terminar, pero con actividad reciente
+            Game.objects.filter(pk=games[2].pk).update(
+                state=QUESTION, updated_at=now - timedelta(hours=2))
+            game = self.create_game()
+        self.assertEqual(game.publicId, games[1].publicId)
+        self.assertEqual(
+            list(Game.objects.filter(publicId__isnull=True)
+                 .values_list('pk', flat=True)), [games[1].pk])
+
+
+@skipIf(connection.vendor == 'sqlite',
+        'SQLite en memoria no admite escrituras concurrentes')
+class ConcurrentPinsTests(TransactionTestCase):
+    """Reparto de PIN desde varias conexiones a la vez"""
+
+    GAMES = 200
+
+    def test01_concurrent_allocation(self):
+        "partidas creadas a la vez nunca comparten PIN"
+        user = User.objects.create_user(username='a', password='a')
+        questionnaire = Questionnaire.objects.create(title='q', user=user)
+
+        def create(_):
+            try:
+                return Game.objects.create(
+                    questionnaire=questionnaire).publicId
+            finally:
+                connection.close()
+
+        with self.settings(PUBLIC_IDS={'MAX': 1000, 'SEGMENT_SIZE': 50}):
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                pins = list(executor.map(create, range(self.GAMES)))
+        self.assertEqual(len(set(pins)), self.GAMES)
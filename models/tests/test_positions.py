@@ -0,0 +1,75 @@
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from models.models import Answer, Question, Questionnaire, User
+
+
+class PositionTests(TestCase):
+    """Orden explicito de las preguntas de un cuestionario"""
+
+    def setUp(self):
+        user = User.objects.create_user(username='a', password='a')
+        self.questionnaire = Questionnaire.objects.create(title='q',
+                                                          user=user)
+        self.questions = [
+            Question.objects.create(question='q%d' % n,
+                                    questionnaire=self.questionnaire)
+            for n in range(4)]
+
+    def positions(self):
+        return list(self.questionnaire.question_set.values_list(
+            'question', 'position'))
+
+    def test01_append(self):
+        "las preguntas nuevas van al final y se cuentan"
+        self.assertEqual(self.positions(), [
+            ('q0', 0), ('q1', 1), ('q2', 2), ('q3', 3)])
+        self.questionnaire.refresh_from_db()
+        self.assertEqual(self.questionnaire.question_count, 4)
+
+    def test02_reorder(self):
+        "reordenar renumera todas las preguntas con dos UPDATE"
+        ids = [question.id for question in reversed(self.questions)]
+        with CaptureQueriesContext(connection) as queries:
+            Question.objects.reorder(self.questionnaire.id, ids)
+        updates = [q for q in queries.captured_queries
+                   if q['sql'].startswith('UPDATE "models_question"')]
+        self.assertEqual(len(updates), 2)
+        self.assertEqual(self.positions(), [
+            ('q3', 0), ('q2', 1), ('q1', 2), ('q0', 3)])
+        with self.assertRaises(ValueError):
+            Question.objects.reorder(self.questionnaire.id, ids[:3])
+        with self.assertRaises(ValueError):
+            Question.objects.reorder(self.questionnaire.id, ids[:3] + ids[:1])
+
+    def test03_delete(self):
+        "al borrar una pregunta se cierra el hueco"
+        self.questions[1].delete()
+        self.assertEqual(self.positions(), [('q0', 0), ('q2', 1), ('q3', 2)])
+        Question.objects.create(question='q4',
+                                questionnaire=self.questionnaire)
+        self.questionnaire.refresh_from_db()
+        self.assertEqual(self.questionnaire.question_count, 4)
+        self.assertEqual(self.positions()[-1], ('q4', 3))
+
+    def test04_queryset_delete(self):
+        "borrar con un queryset tambien recuenta y cierra los huecos"
+        Question.objects.filter(
+            pk__in=[self.questions[0].pk, self.questions[2].pk]).delete()
+        self.assertEqual(self.positions(), [('q1', 0), ('q3', 1)])
+        self.questionnaire.refresh_from_db()
+        self.assertEqual(self.questionnaire.question_count, 2)
+        Question.objects.create(question='q4',
+                                questionnaire=self.questionnaire)
+        self.assertEqual(self.positions()[-1], ('q4', 2))
+
+    def test05_answer_queryset_delete(self):
+        "borrar respuestas con un queryset cambia la version"
+        Answer.objects.create(answer='a', question=self.questions[0],
+                              correct=True)
+        self.questionnaire.refresh_from_db()
+        version = self.questionnaire.version
+        Answer.objects.filter(question=self.questions[0]).delete()
+        self.questionnaire.refresh_from_db()
+        self.assertGreater(self.questionnaire.version, version)
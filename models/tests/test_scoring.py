@@ -0,0 +1,94 @@
+from concurrent.futures import ThreadPoolExecutor
+from unittest import skipIf
+
+from django.db import connection
+from django.test import TransactionTestCase
+
+from models.models import (Answer, Game, Guess, Participant, Question,
+                           Questionnaire, User)
+
+
+class ScoringTests(TransactionTestCase):
+    """Puntuacion atomica de las respuestas"""
+
+    GUESSES = 2000
+    PARTICIPANTS = 10
+    THREADS = 16
+
+    def setUp(self):
+        user = User.objects.create_user(username='a', password='a')
+        questionnaire = Questionnaire.objects.create(title='q', user=user)
+        self.question = Question.objects.create(
+            question='q', questionnaire=questionnaire, value=3)
+        self.right = Answer.objects.create(
+            answer='right', question=self.question, correct=True)
+        self.wrong = Answer.objects.create(
+            answer='wrong', question=self.question, correct=False)
+        self.game = Game.objects.create(questionnaire=questionnaire)
+        self.participants = [
+            Participant.objects.create(game=self.game, alias='p%d' % n)
+            for n in range(self.PARTICIPANTS)]
+
+    def test01_add_points(self):
+        "un unico UPDATE suma puntos distintos a varios participantes"
+        first, second = self.participants[:2]
+        with self.assertNumQueries(1):
+            Participant.objects.add_points({first.id: 5, second.id: 7})
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual((first.points, second.points), (5, 7))
+        with self.assertNumQueries(0):
+            Participant.objects.add_points({first.id: 0})
+
+    def test02_guess_does_not_rewrite_participant(self):
+        "Guess.save no sobrescribe el participante con valores obsoletos"
+        stale = Participant.objects.get(pk=self.participants[0].pk)
+        Guess.objects.create(participant=self.participants[0],
+                             game=self.game, question=self.question,
+                             answer=self.right)
+        # una respuesta por pregunta: la segunda es a otra pregunta
+        question = Question.objects.create(
+            question='q2', questionnaire=self.question.questionnaire,
+            value=3)
+        right = Answer.objects.create(answer='right', question=question,
+                                      correct=True)
+        Guess.objects.create(participant=stale, game=self.game,
+                             question=question, answer=right)
+        stale.refresh_from_db()
+        self.assertEqual(stale.points, 6)
+
+    @skipIf(connection.vendor == 'sqlite',
+            'SQLite en memoria no admite escrituras concurrentes')
+    def test03_concurrent_guesses(self):
+        "miles de respuestas en paralelo no pierden puntos"
+        # cada participante responde una vez a cada pregunta
+        answers = [(self.right, self.wrong)]
+        for n in range(1, self.GUESSES // self.PARTICIPANTS):
+            question = Question.objects.create(
+                question='q%d' % n,
+                questionnaire=self.question.questionnaire, value=3)
+            answers.append((
+                Answer.objects.create(answer='right', question=question,
+                                      correct=True),
+                Answer.objects.create(answer='wrong', question=question,
+                                      correct=False)))
+
+        def guess(n):
+            try:
+                participant = Participant.objects.get(
+                    pk=self.participants[n % self.PARTICIPANTS].pk)
+                right, wrong = answers[n // self.PARTICIPANTS]
+                answer = right if n // self.PARTICIPANTS % 2 == 0 else wrong
+                Guess.objects.create(participant=participant, game=self.game,
+                                     question=answer.question, answer=answer)
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=self.THREADS) as executor:
+            list(executor.map(guess, range(self.GUESSES)))
+
+        self.assertEqual(Guess.objects.count(), self.GUESSES)
+        right_per_participant = self.GUESSES // self.PARTICIPANTS // 2
+        for participant in Participant.objects.all():
+            self.assertEqual(participant.points,
+                             right_per_participant * self.question.value)
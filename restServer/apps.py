@@ -3,4 +3,4 @@ from django.apps import AppConfig
 
 class RestserverConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'vueClient'
+    name = 'restServer'
@@ -0,0 +1,191 @@
+"""
+Vistas asincronas de juego para los participantes.
+
+Son las mismas operaciones que la API de ``restServer.views`` que usan los
+participantes (unirse, responder, consultar la partida y el podio), como
+vistas asincronas nativas: bajo ASGI (``kahootclone.asgi``) un proceso
+atiende la rafaga de uniones de una partida grande sin un hilo por
+peticion. DRF 3.13 no admite vistas asincronas, asi que se sirven en
+``/api/play/`` y la API de DRF sigue igual.
+
+La sesion de la partida se lee en el bucle de eventos; lo que necesita la
+base de datos pasa por el grupo acotado de hilos de ``services.executor``:
+las uniones se escriben por lotes (``JoinBatcher``) y las respuestas con
+la ingesta por lotes de ``services.ingestion``.
+
+Las peticiones y las respuestas (JSON, codigos de estado y errores) son
+las de la API de DRF. Como en ella, los participantes se identifican con
+su token de partida (``Authorization: Bearer``) y no se usa la sesion de
+Django ni, por tanto, CSRF.
+"""
+import json
+from functools import wraps
+
+from django.http import Http404, HttpResponseNotAllowed, JsonResponse
+from rest_framework import status
+from rest_framework.exceptions import (APIException, NotFound, ParseError,
+                                       PermissionDenied, ValidationError)
+
+from services import tokens
+from services.engine import aget_session_or_404
+from services.executor import joins
+from services.ingestion import GuessRejected, ingestor
+from services.views import state_response
+
+from .serializers import (GuessCreateSerializer, GuessSerializer,
+                          ParticipantCreateSerializer, ParticipantSerializer)
+from .views import (PARTICIPANT_ALIAS_ERROR, PARTICIPANT_GAME_ERROR,
+                    GameTokenAuthentication, check_token, guess_player,
+                    guess_rejected, leaderboard_data)
+
+
+def play_view(*methods):
+    """
+    Decorador de las vistas asincronas de juego: admite solo ``methods`` y
+    convierte los errores de DRF en respuestas JSON como las de la API.
+
+    ``csrf_exempt`` de Django 3.2 no conserva las vistas asincronas, asi
+    que la marca se pone directamente.
+    """
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                return HttpResponseNotAllowed(methods)
+            try:
+                return await view(request, *args, **kwargs)
+            except Http404:
+                return error_response(NotFound())
+            except APIException as error:
+                return error_response(error)
+        wrapper.csrf_exempt = True
+        return wrapper
+    return decorator
+
+
+def error_response(error):
+    """Respuesta de un error de DRF, con el formato de su manejador"""
+    if isinstance(error.detail, (list, dict)):
+        data = error.detail
+    else:
+        data = {'detail': error.detail}
+    response = JsonResponse(data, status=error.status_code, safe=False)
+    if error.status_code == status.HTTP_401_UNAUTHORIZED:
+        response['WWW-Authenticate'] = GameTokenAuthentication.keyword
+    return response
+
+
+def get_token(request, publicId=None):
+    """
+    Token de partida de la peticion, o None si no lleva.
+
+    :param request: Petición HTTP
+    :param publicId: PIN al que debe pertenecer el token
+
+    :return: ``GameToken`` o None
+    """
+    credentials = GameTokenAuthentication().authenticate(request)
+    return check_token(credentials[1] if credentials else None, publicId)
+
+
+def get_data(request, serializer_class):
+    """
+    Valida el cuerpo (JSON o formulario) de la peticion.
+
+    :return: Datos validados
+    """
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError as error:
+            raise ParseError('JSON parse error - %s' % error)
+    else:
+        data = request.POST
+    serializer = serializer_class(data=data)
+    serializer.is_valid(raise_exception=True)
+    return serializer.validated_data
+
+
+@play_view('POST')
+async def join(request):
+    """
+    Une un participante a la partida y le entrega su token.
+
+    El alias se reserva en la sesion en memoria y el participante se
+    escribe en el lote de uniones en curso.
+
+    :param request: Petición HTTP con ``game`` y ``alias``
+
+    :return: Respuesta JSON con el participante y su token
+    """
+    data = get_data(request, ParticipantCreateSerializer)
+    try:
+        session = await aget_session_or_404(data['game'])
+    except Http404:
+        raise ValidationError({'game': PARTICIPANT_GAME_ERROR})
+    if not session.reserve_alias(data['alias']):
+        raise PermissionDenied(PARTICIPANT_ALIAS_ERROR)
+    try:
+        participant = await joins.join(session.game, data['alias'])
+    except BaseException:
+        session.release_alias(data['alias'])
+        raise
+    data = dict(ParticipantSerializer(participant).data)
+    data['token'] = tokens.issue(session.publicId, tokens.PARTICIPANT,
+                                 participant.uuidP)
+    return JsonResponse(data, status=status.HTTP_201_CREATED)
+
+
+@play_view('POST')
+async def guess(request):
+    """
+    Registra la respuesta de un participante a la pregunta actual.
+
+    :param request: Petición HTTP con ``answer`` y el token del
+        participante (o ``uuidp`` y ``game``)
+
+    :return: Respuesta JSON con la respuesta registrada
+    """
+    data = get_data(request, GuessCreateSerializer)
+    publicId, uuidP = guess_player(data, get_token(request, data.get('game')))
+    session = await aget_session_or_404(publicId)
+    try:
+        guess = await ingestor.submit_async(session, uuidP, data['answer'])
+    except GuessRejected as rejected:
+        raise guess_rejected(rejected)
+    return JsonResponse(GuessSerializer(guess).data,
+                        status=status.HTTP_201_CREATED)
+
+
+@play_view('GET', 'HEAD')
+async def state(request, publicId):
+    """
+    Estado compacto de la partida con su version como ``ETag`` (ver
+    ``services.views.GameState``). Con el token del anfitrion incluye las
+    respuestas correctas de la pregunta en curso.
+
+    :param request: Petición HTTP
+    :param publicId: PIN de la partida
+
+    :return: Respuesta JSON o 304
+    """
+    session = await aget_session_or_404(publicId)
+    token = get_token(request, session.publicId)
+    return state_response(request, session,
+                          token.role if token else tokens.PARTICIPANT)
+
+
+@play_view('GET', 'HEAD')
+async def leaderboard(request, publicId):
+    """
+    Podio de la partida y posicion del participante (ver
+    ``restServer.views.leaderboard_data``).
+
+    :param request: Petición HTTP
+    :param publicId: PIN de la partida
+
+    :return: Respuesta JSON con el podio
+    """
+    session = await aget_session_or_404(publicId)
+    return JsonResponse(leaderboard_data(
+        session, get_token(request, session.publicId), request.GET))
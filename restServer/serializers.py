@@ -1,27 +1,60 @@
-from .models import *
+"""
+Serializadores de la API de juego.
+
+Son ``Serializer`` con los campos escritos a mano, no ``ModelSerializer``:
+no introspeccionan el modelo en cada peticion y las relaciones se leen por
+su columna (``participant_id``, ``game.publicId`` con la partida ya
+cargada), sin consultas adicionales.
+"""
 from rest_framework import serializers
 
-class UserSerializer(serializers.ModelSerializer):
-    class Meta:
-        model = User
-        fields = '__all__'
-        
-class AnswersSerializer(serializers.ModelSerializer):
-    class Meta:
-        model = Answers
-        fields = '__all__'
-        
-class GamesSerializer(serializers.ModelSerializer):
-    class Meta:
-        model = Games
-        fields = '__all__'
-        
-class ParticipantSerializer(serializers.ModelSerializer):
-    class Meta:
-        model = Participant
-        fields = '__all__'
-        
-class GuessSerializer(serializers.ModelSerializer):
-    class Meta:
-        model = Guess
-        fields = '__all__'
\ No newline at end of file
+
+class GameSerializer(serializers.Serializer):
+    publicId = serializers.IntegerField(read_only=True)
+    questionnaire = serializers.IntegerField(source='questionnaire_id',
+                                             read_only=True)
+    state = serializers.IntegerField(read_only=True)
+    questionNo = serializers.IntegerField(read_only=True)
+    countdownTime = serializers.IntegerField(read_only=True)
+    created_at = serializers.DateTimeField(read_only=True)
+
+
+class ParticipantSerializer(serializers.Serializer):
+    # los participantes se identifican ante el publico por el PIN
+    id = serializers.IntegerField(read_only=True)
+    game = serializers.IntegerField(source='game.publicId', read_only=True)
+    alias = serializers.CharField(read_only=True)
+    points = serializers.IntegerField(read_only=True)
+    uuidP = serializers.UUIDField(read_only=True)
+
+
+class ParticipantCreateSerializer(serializers.Serializer):
+    """Union a una partida: PIN y alias"""
+    game = serializers.IntegerField()
+    alias = serializers.CharField(max_length=255)
+
+
+class GuessSerializer(serializers.Serializer):
+    id = serializers.IntegerField(read_only=True)
+    participant = serializers.IntegerField(source='participant_id',
+                                           read_only=True)
+    game = serializers.IntegerField(source='game_id', read_only=True)
+    question = serializers.IntegerField(source='question_id', read_only=True)
+    answer = serializers.IntegerField(source='answer_id', read_only=True)
+
+
+class GuessCreateSerializer(serializers.Serializer):
+    """
+    Respuesta de un participante: su uuid, el PIN y el indice elegido. Con
+    el token del participante basta con el indice.
+    """
+    uuidp = serializers.UUIDField(required=False)
+    game = serializers.IntegerField(required=False)
+    answer = serializers.IntegerField(min_value=0)
+
+
+class LeaderboardEntrySerializer(serializers.Serializer):
+    rank = serializers.IntegerField()
+    id = serializers.IntegerField()
+    alias = serializers.CharField()
+    points = serializers.IntegerField()
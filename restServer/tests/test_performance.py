@@ -0,0 +1,77 @@
+from rest_framework import status
+from rest_framework.reverse import reverse
+from rest_framework.test import APIClient
+
+from models.constants import QUESTION
+from services import tokens
+from services.engine import sessions
+from services.tests.test_performance import PARTICIPANTS, QueryBudgetTestCase
+
+
+class RestBudgetTests(QueryBudgetTestCase):
+    """Presupuestos de consultas de la API REST"""
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_login(self.user)
+        self.player = APIClient()
+        self.player.credentials(HTTP_AUTHORIZATION='Bearer ' + tokens.issue(
+            self.game.publicId, tokens.PARTICIPANT, self.participant.uuidP))
+
+    def call(self, name, budget, request, code=status.HTTP_200_OK):
+        response = self.assertQueryBudget(name, budget, request)
+        self.assertEqual(response.status_code, code, response.content)
+        return response
+
+    def test01_games(self):
+        "lista y detalle de partidas"
+        self.call('api games list', 3,
+                  lambda: self.client.get(reverse('game-list')))
+        # la primera consulta carga la sesion de la partida
+        detail = reverse('game-detail', args=[self.game.publicId])
+        self.call('api games detail load', 4,
+                  lambda: self.player.get(detail))
+        self.call('api games detail', 0, lambda: self.player.get(detail))
+
+    def test02_leaderboard(self):
+        "podio de 1000 participantes desde la sesion en memoria"
+        sessions.get(self.game.publicId)
+        url = reverse('game-leaderboard', args=[self.game.publicId])
+        response = self.call('api leaderboard', 0,
+                             lambda: self.player.get(url, {'top': 100}))
+        self.assertEqual(response.data['participants'], PARTICIPANTS)
+        self.assertIn('participant', response.data)
+
+    def test03_participants(self):
+        "lista de 1000 participantes y union a la partida"
+        response = self.call('api participants list', 3, lambda: (
+            self.client.get(reverse('participant-list'))))
+        self.assertEqual(len(response.data), PARTICIPANTS)
+        # con la sesion de la partida en memoria unirse es un INSERT
+        sessions.get(self.game.publicId)
+        self.call('api participants create', 1, lambda: self.player.post(
+            reverse('participant-list'),
+            {'game': self.game.publicId, 'alias': 'newcomer'},
+            format='json'), status.HTTP_201_CREATED)
+
+    def test04_guesses(self):
+        "lista de 1000 respuestas y respuesta con token"
+        response = self.call('api guesses list', 3, lambda: (
+            self.client.get(reverse('guess-list'))))
+        self.assertEqual(len(response.data), PARTICIPANTS)
+        session = sessions.get(self.game.publicId)
+        session.advance()
+        self.assertEqual(session.state, QUESTION)
+        players = self.game.participant_set.order_by('-id')[:2]
+        # la primera respuesta carga el reparto de respuestas; despues solo
+        # se escribe el lote (INSERT y puntos)
+        for name, budget, participant in (('load', 5, players[0]),
+                                          ('', 4, players[1])):
+            player = APIClient()
+            player.credentials(HTTP_AUTHORIZATION='Bearer ' + tokens.issue(
+                self.game.publicId, tokens.PARTICIPANT, participant.uuidP))
+            self.call(('api guesses create ' + name).strip(), budget,
+                      lambda: player.post(reverse('guess-list'),
+                                          {'answer': 0}, format='json'),
+                      status.HTTP_201_CREATED)
@@ -0,0 +1,198 @@
+import asyncio
+import json
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.db import IntegrityError, connection
+from django.test import AsyncClient, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from kahootclone import middleware
+from rest_framework import status
+
+from models.constants import QUESTION
+from models.models import Guess, Participant
+from services import tokens
+from services.engine import sessions
+from services.executor import create_participants, executor
+from services.tests.fixtures import GameFixtures
+
+
+class PlayTests(GameFixtures, TestCase):
+    """Vistas asincronas de juego"""
+
+    def setUp(self):
+        super().setUp()
+        self.create_game(answers=('a', 'b'), state=QUESTION)
+
+    def post(self, name, data, **extra):
+        return self.client.post(reverse(name), json.dumps(data),
+                                content_type='application/json', **extra)
+
+    def join(self, alias):
+        return self.post('play-join',
+                         {'game': self.game.publicId, 'alias': alias})
+
+    def test01_join(self):
+        "unirse devuelve el participante y su token"
+        response = self.join('luis')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        data = response.json()
+        participant = Participant.objects.get(id=data['id'])
+        self.assertEqual(data['alias'], 'luis')
+        self.assertEqual(data['game'], self.game.publicId)
+        self.assertEqual(tokens.verify(data['token']).uuidP,
+                         participant.uuidP)
+        # el alta llega a la sesion por la señal, aunque sea por lotes
+        self.assertIn(participant.id, sessions.get(self.game.publicId)
+                      .leaderboard)
+
+    def test02_join_errors(self):
+        "mismos errores que la API de DRF"
+        self.join('luis')
+        response = self.join('luis')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertIn('detail', response.json())
+        response = self.post('play-join', {'game': self.game.publicId + 1,
+                                           'alias': 'ana'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('game', response.json())
+        response = self.post('play-join', {'game': self.game.publicId})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('alias', response.json())
+        response = self.client.post(reverse('play-join'), '{',
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(reverse('play-join'))
+        self.assertEqual(response.status_code,
+                         status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    def test03_guess(self):
+        "responder con el token; la repeticion se rechaza"
+        token = self.join('luis').json()['token']
+        auth = {'HTTP_AUTHORIZATION': 'Bearer ' + token}
+        response = self.post('play-guess', {'answer': 0}, **auth)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        guess = Guess.objects.get()
+        self.assertEqual(response.json()['id'], guess.id)
+        self.assertEqual(Participant.objects.get().points, 1)
+        response = self.post('play-guess', {'answer': 1}, **auth)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        response = self.post('play-guess', {'answer': 5}, **auth)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.post('play-guess', {'answer': 0})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.post('play-guess', {'answer': 0},
+                             HTTP_AUTHORIZATION='Bearer x')
+        self.assertEqual(response.status_code,
+                         status.HTTP_401_UNAUTHORIZED)
+
+    def test04_state_and_leaderboard(self):
+        "estado con ETag y podio con la posicion del participante"
+        token = self.join('luis').json()['token']
+        url = reverse('play-state', args=[self.game.publicId])
+        response = self.client.get(url)
+        self.assertEqual(response.json()['participants'], 1)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        response = self.client.get(
+            reverse('play-leaderboard', args=[self.game.publicId]),
+            HTTP_AUTHORIZATION='Bearer ' + token)
+        data = response.json()
+        self.assertEqual(data['participants'], 1)
+        self.assertEqual(data['participant']['alias'], 'luis')
+        response = self.client.get(
+            reverse('play-leaderboard', args=[self.game.publicId + 1]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test05_join_burst(self):
+        "las uniones simultaneas se escriben con un unico INSERT (uno por "
+        "union si la base de datos no devuelve los ids del lote)"
+        client = AsyncClient()
+        sessions.get(self.game.publicId)
+
+        async def burst():
+            return await asyncio.gather(*[client.post(
+                reverse('play-join'),
+                {'game': self.game.publicId, 'alias': 'p%d' % n},
+                content_type='application/json') for n in range(50)])
+
+        with CaptureQueriesContext(connection) as queries:
+            responses = async_to_sync(burst)()
+        self.assertEqual([response.status_code for response in responses],
+                         [status.HTTP_201_CREATED] * 50)
+        inserts = [query for query in queries.captured_queries
+                   if query['sql'].startswith('INSERT')]
+        self.assertEqual(
+            len(inserts),
+            1 if connection.features.can_return_rows_from_bulk_insert
+            else 50)
+        self.assertEqual(len(sessions.get(self.game.publicId).leaderboard),
+                         50)
+
+    def test06_inline_middleware(self):
+        "el middleware solo salta de hilo si la peticion usa la sesion"
+        client = AsyncClient()
+        client.force_login(self.user)
+
+        async def get(path):
+            return await client.get(path)
+
+        with mock.patch.object(middleware, 'sync_to_async',
+                               wraps=middleware.sync_to_async) as hop:
+            response = async_to_sync(get)(
+                reverse('play-state', args=[self.game.publicId]))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            hop.assert_not_called()
+            response = async_to_sync(get)(reverse('home'))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(hop.called)
+
+    def test07_join_batch_errors(self):
+        "un alta erronea no hace fallar a las demas del lote"
+        existing = Participant.objects.create(game=self.game, alias='luis')
+        results = create_participants([
+            Participant(game=self.game, alias='a'),
+            Participant(game=self.game, alias='b', uuidP=existing.uuidP),
+            Participant(game=self.game, alias='c')])
+        self.assertIsInstance(results[1], IntegrityError)
+        self.assertEqual([results[0].alias, results[2].alias], ['a', 'c'])
+        self.assertEqual(
+            sorted(Participant.objects.filter(game=self.game)
+                   .values_list('alias', flat=True)), ['a', 'c', 'luis'])
+
+
+class PlayExecutorTests(GameFixtures, TransactionTestCase):
+    """Las vistas asincronas con el grupo de hilos de la base de datos"""
+
+    def setUp(self):
+        super().setUp()
+        self.create_game(state=QUESTION)
+
+    def tearDown(self):
+        executor.shutdown()
+
+    async def test01_join_and_guess(self):
+        "uniones y respuestas simultaneas con dos hilos"
+        client = AsyncClient()
+        with self.settings(GAME_ASYNC={'THREADS': 2}):
+            responses = await asyncio.gather(*[client.post(
+                reverse('play-join'),
+                {'game': self.game.publicId, 'alias': 'p%d' % n},
+                content_type='application/json') for n in range(40)])
+            self.assertEqual(
+                [response.status_code for response in responses],
+                [status.HTTP_201_CREATED] * 40)
+            responses = await asyncio.gather(*[client.post(
+                reverse('play-guess'), {'answer': 0},
+                content_type='application/json',
+                **{'Authorization': 'Bearer ' + response.json()['token']})
+                for response in responses])
+            self.assertEqual(
+                [response.status_code for response in responses],
+                [status.HTTP_201_CREATED] * 40)
+            counts = await executor.run(
+                lambda: (Participant.objects.filter(points=1).count(),
+                         Guess.objects.count()))
+        self.assertEqual(counts, (40, 40))
@@ -0,0 +1,88 @@
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework import status
+from rest_framework.reverse import reverse
+from rest_framework.test import APIClient, APITestCase
+
+from models.constants import QUESTION
+from models.models import Guess, Participant
+from services import tokens
+from services.tests.fixtures import GameFixtures
+
+
+class TokenTests(GameFixtures, APITestCase):
+    """Tokens firmados de los participantes"""
+
+    def setUp(self):
+        super().setUp()
+        self.create_game(state=QUESTION)
+        self.client = APIClient()
+        # navegador con sesion de Django: sin token se leeria en cada
+        # peticion
+        self.client.force_login(self.user)
+
+    def session_queries(self, queries):
+        return [query for query in queries.captured_queries
+                if 'django_session' in query['sql']]
+
+    def test01_verify(self):
+        "el token se comprueba en memoria y se rechaza si se altera"
+        participant = Participant(game=self.game, alias='x')
+        token = tokens.issue(self.game.publicId, tokens.PARTICIPANT,
+                             participant.uuidP)
+        self.assertEqual(tokens.verify(token), tokens.GameToken(
+            self.game.publicId, participant.uuidP, tokens.PARTICIPANT))
+        with self.assertRaises(tokens.InvalidToken):
+            tokens.verify(token[:-2])
+        with self.settings(GAME_TOKENS={'TTL': -10}):
+            expired = tokens.issue(self.game.publicId, tokens.HOST)
+        with self.assertRaises(tokens.InvalidToken):
+            tokens.verify(expired)
+
+    def test02_no_session_queries(self):
+        "unirse, responder y consultar la partida no leen la sesion"
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                reverse('participant-list'),
+                {'game': self.game.publicId, 'alias': 'luis'},
+                format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.session_queries(queries), [])
+        token = response.data['token']
+        self.assertEqual(tokens.verify(token).uuidP,
+                         Participant.objects.get(alias='luis').uuidP)
+
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + token)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('guess-list'),
+                                        {'answer': 0}, format='json')
+            self.client.get(reverse('game-detail',
+                                    args=[self.game.publicId]))
+            leaderboard = self.client.get(reverse(
+                'game-leaderboard', args=[self.game.publicId]))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.session_queries(queries), [])
+        self.assertEqual(Guess.objects.count(), 1)
+        self.assertEqual(leaderboard.data['participant']['alias'], 'luis')
+
+    def test03_invalid_token(self):
+        "un token alterado o de otra partida se rechaza"
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer nope')
+        response = self.client.post(reverse('guess-list'), {'answer': 0},
+                                    format='json')
+        self.assertEqual(response.status_code,
+                         status.HTTP_401_UNAUTHORIZED)
+        participant = Participant.objects.create(game=self.game, alias='x')
+        token = tokens.issue(self.game.publicId, tokens.PARTICIPANT,
+                             participant.uuidP)
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + token)
+        response = self.client.post(
+            reverse('guess-list'),
+            {'answer': 0, 'game': self.game.publicId + 1}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test04_non_numeric_pin(self):
+        "un PIN no numerico no existe"
+        for url in ('/api/games/abc/', '/api/games/abc/leaderboard/'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
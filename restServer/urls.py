@@ -0,0 +1,19 @@
+from django.urls import path
+from rest_framework.routers import DefaultRouter
+
+from . import play, views
+
+router = DefaultRouter()
+router.register(r'games', views.GameViewSet, basename='game')
+router.register(r'participants', views.ParticipantViewSet,
+                basename='participant')
+router.register(r'guesses', views.GuessViewSet, basename='guess')
+
+# vistas asincronas de juego (restServer.play)
+urlpatterns = [
+    path('play/join/', play.join, name='play-join'),
+    path('play/guess/', play.guess, name='play-guess'),
+    path('play/<int:publicId>/state/', play.state, name='play-state'),
+    path('play/<int:publicId>/leaderboard/', play.leaderboard,
+         name='play-leaderboard'),
+] + router.urls
@@ -1,22 +1,279 @@
-from django.shortcuts import render
-from .models import *
-from rest_framework import viewsets
-from .serializers import *
-
-# Create your views here.
-class UserViewSet(viewsets.ModelViewSet):
-    queryset = User.objects.all()
-    serializer_class = UserSerializer
-    
-class AnswersViewSet(viewsets.ModelViewSet):
-    queryset = Answers.objects.all()
-    serializer_class = AnswersSerializer
-    
-class GamesViewSet(viewsets.ModelViewSet):
-    queryset = Games.objects.all()
-    serializer_class = GamesSerializer
-
-class ParticipantViewSet(viewsets.ModelViewSet):
-    queryset = Participant.objects.all()
+from uuid import UUID
+
+from django.contrib.auth.models import AnonymousUser
+from django.http import Http404
+from rest_framework import (authentication, mixins, permissions, status,
+                            viewsets)
+from rest_framework.decorators import action
+from rest_framework.exceptions import (AuthenticationFailed, NotFound,
+                                       PermissionDenied, ValidationError)
+from rest_framework.response import Response
+
+from models.models import Game, Guess, Participant
+from services import tokens
+from services.engine import get_session_or_404
+from services.ingestion import GuessRejected, ingestor
+
+from .serializers import (GameSerializer, GuessCreateSerializer,
+                          GuessSerializer, LeaderboardEntrySerializer,
+                          ParticipantCreateSerializer, ParticipantSerializer)
+
+LEADERBOARD_MAX_SIZE = 100
+
+PARTICIPANT_ALIAS_ERROR = 'alias already in use in this game'
+PARTICIPANT_GAME_ERROR = 'game not found'
+GUESS_TOKEN_ERROR = 'a participant token or uuidp and game are required'
+TOKEN_GAME_ERROR = 'the token belongs to another game'
+
+
+class IsAuthenticatedOrPublicAction(permissions.BasePermission):
+    """
+    Permite a cualquiera las acciones de juego listadas en
+    ``public_actions`` (consultar la partida, unirse, responder) y exige
+    autenticacion para el resto.
+    """
+
+    def has_permission(self, request, view):
+        if view.action in view.public_actions:
+            return True
+        return bool(request.user and request.user.is_authenticated)
+
+
+class GameTokenAuthentication(authentication.BaseAuthentication):
+    """
+    Identifica a participantes y anfitriones por su token de partida
+    (``Authorization: Bearer <token>``, ver ``services.tokens``).
+
+    El token se comprueba en memoria; ``request.auth`` es el ``GameToken``
+    y ``request.user`` un usuario anonimo.
+    """
+    keyword = 'Bearer'
+
+    def authenticate(self, request):
+        header = authentication.get_authorization_header(request).split()
+        if not header or header[0].decode().lower() != self.keyword.lower():
+            return None
+        if len(header) != 2:
+            raise AuthenticationFailed('invalid token header')
+        try:
+            token = tokens.verify(header[1].decode())
+        except (tokens.InvalidToken, UnicodeError) as error:
+            raise AuthenticationFailed('invalid token: %s' % error)
+        return AnonymousUser(), token
+
+    def authenticate_header(self, request):
+        return self.keyword
+
+
+def check_token(token, publicId=None):
+    """
+    Comprueba que el token de partida de una peticion es de la partida.
+
+    :param token: ``request.auth`` de la peticion
+    :param publicId: PIN al que debe pertenecer el token
+
+    :return: ``GameToken`` o None si la peticion no lleva
+    :raises PermissionDenied: si el token es de otra partida
+    """
+    if not isinstance(token, tokens.GameToken):
+        return None
+    if publicId is not None and token.publicId != publicId:
+        raise PermissionDenied(TOKEN_GAME_ERROR)
+    return token
+
+
+def leaderboard_data(session, token, query_params):
+    """
+    Podio de la partida (``?top=N``) y, con ``?uuidp=`` o con el token de
+    un participante, la posicion del participante.
+
+    :param session: Sesion de la partida
+    :param token: Token de partida de la peticion o None
+    :param query_params: Parametros de la peticion
+
+    :return: Datos de la respuesta
+    """
+    leaderboard = session.leaderboard
+    try:
+        top = int(query_params.get('top', 10))
+    except ValueError:
+        raise ValidationError({'top': 'must be an integer'})
+    if top < 0:
+        # top(-1) seria un corte de la lista: todos menos el ultimo
+        raise ValidationError({'top': 'must not be negative'})
+    top = min(top, LEADERBOARD_MAX_SIZE)
+    data = {
+        'participants': len(leaderboard),
+        'top': LeaderboardEntrySerializer(leaderboard.top(top),
+                                          many=True).data,
+    }
+    uuidP = token.uuidP if token is not None else None
+    if 'uuidp' in query_params:
+        try:
+            uuidP = UUID(query_params['uuidp'])
+        except ValueError:
+            raise ValidationError({'uuidp': 'must be a valid UUID'})
+    if uuidP is not None:
+        participant_id = session.uuids.get(uuidP)
+        entry = (leaderboard.entry(participant_id)
+                 if participant_id is not None else None)
+        if entry is None:
+            raise NotFound('participant not found in this game')
+        data['participant'] = LeaderboardEntrySerializer(entry).data
+    return data
+
+
+def guess_player(data, token):
+    """
+    Partida y participante de una respuesta: los del token del participante
+    o, sin el, los de ``game`` y ``uuidp``.
+
+    :param data: Datos validados por ``GuessCreateSerializer``
+    :param token: Token de partida de la peticion o None
+
+    :return: Tupla (publicId, uuidP)
+    """
+    if token is not None and token.role == tokens.PARTICIPANT:
+        return token.publicId, token.uuidP
+    if 'game' in data and 'uuidp' in data:
+        return data['game'], data['uuidp']
+    raise ValidationError(GUESS_TOKEN_ERROR)
+
+
+def guess_rejected(rejected):
+    """Error de la API para una respuesta rechazada por el ingestor"""
+    if rejected.reason == 'participant':
+        return NotFound(rejected.message)
+    if rejected.reason == 'answer':
+        return ValidationError({'answer': rejected.message})
+    return PermissionDenied(rejected.message)
+
+
+class GameTokenMixin:
+    """
+    Las acciones de ``public_actions`` solo aceptan el token de partida,
+    de modo que no leen la sesion de Django (``django_session``); el resto
+    usa la autenticacion por defecto.
+    """
+
+    def get_authenticators(self):
+        # self.action aun no esta fijado cuando DRF crea los autenticadores
+        action = self.action_map.get(self.request.method.lower()) \
+            if getattr(self, 'action_map', None) else None
+        if action in self.public_actions:
+            return [GameTokenAuthentication()]
+        return super().get_authenticators()
+
+    def get_token(self, publicId=None):
+        """
+        Token de partida de la peticion, o None si no lleva.
+
+        :param publicId: PIN al que debe pertenecer el token
+
+        :return: ``GameToken`` o None
+        :raises PermissionDenied: si el token es de otra partida
+        """
+        return check_token(self.request.auth, publicId)
+
+
+class GameViewSet(GameTokenMixin,
+                  mixins.RetrieveModelMixin,
+                  mixins.ListModelMixin,
+                  viewsets.GenericViewSet):
+    serializer_class = GameSerializer
+    lookup_field = 'publicId'
+    # un PIN no numerico no llega a la vista (404)
+    lookup_value_regex = r'\d+'
+    permission_classes = [IsAuthenticatedOrPublicAction]
+    public_actions = ('retrieve', 'leaderboard')
+
+    def get_queryset(self):
+        return Game.objects.filter(questionnaire__user=self.request.user)
+
+    def get_object(self):
+        # la partida se sirve desde la sesion en memoria
+        return get_session_or_404(int(self.kwargs['publicId'])).game
+
+    @action(detail=True)
+    def leaderboard(self, request, publicId=None):
+        """
+        Podio de la partida (``?top=N``) y, con ``?uuidp=`` o con el token
+        de un participante, la posicion del participante.
+        """
+        session = get_session_or_404(int(publicId))
+        return Response(leaderboard_data(
+            session, self.get_token(session.publicId), request.query_params))
+
+
+class ParticipantViewSet(GameTokenMixin,
+                         mixins.CreateModelMixin,
+                         mixins.RetrieveModelMixin,
+                         mixins.ListModelMixin,
+                         viewsets.GenericViewSet):
     serializer_class = ParticipantSerializer
-    
\ No newline at end of file
+    permission_classes = [IsAuthenticatedOrPublicAction]
+    public_actions = ('create',)
+
+    def get_queryset(self):
+        # el serializador muestra el PIN de la partida de cada participante
+        return Participant.objects.filter(
+            game__questionnaire__user=self.request.user).select_related(
+                'game')
+
+    def create(self, request, *args, **kwargs):
+        """
+        Une un participante a la partida y le entrega su token, con el que
+        se identifica en el resto de peticiones de la partida.
+
+        La partida y los alias en uso salen de la sesion en memoria, de
+        modo que unirse cuesta un unico INSERT.
+        """
+        serializer = ParticipantCreateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        try:
+            session = get_session_or_404(data['game'])
+        except Http404:
+            raise ValidationError({'game': PARTICIPANT_GAME_ERROR})
+        if not session.reserve_alias(data['alias']):
+            raise PermissionDenied(PARTICIPANT_ALIAS_ERROR)
+        try:
+            participant = Participant.objects.create(game=session.game,
+                                                     alias=data['alias'])
+        except BaseException:
+            session.release_alias(data['alias'])
+            raise
+        data = dict(ParticipantSerializer(participant).data)
+        data['token'] = tokens.issue(session.publicId, tokens.PARTICIPANT,
+                                     participant.uuidP)
+        return Response(data, status=status.HTTP_201_CREATED)
+
+
+class GuessViewSet(GameTokenMixin,
+                   mixins.CreateModelMixin,
+                   mixins.RetrieveModelMixin,
+                   mixins.ListModelMixin,
+                   viewsets.GenericViewSet):
+    serializer_class = GuessSerializer
+    permission_classes = [IsAuthenticatedOrPublicAction]
+    public_actions = ('create',)
+
+    def get_queryset(self):
+        return Guess.objects.filter(
+            game__questionnaire__user=self.request.user)
+
+    def create(self, request, *args, **kwargs):
+        serializer = GuessCreateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        # el token del participante sustituye a uuidp y game
+        publicId, uuidP = guess_player(data, self.get_token(data.get('game')))
+
+        # se valida contra la sesion en memoria y se escribe por lotes
+        session = get_session_or_404(publicId)
+        try:
+            guess = ingestor.submit(session, uuidP, data['answer'])
+        except GuessRejected as rejected:
+            raise guess_rejected(rejected)
+        return Response(GuessSerializer(guess).data,
+                        status=status.HTTP_201_CREATED)
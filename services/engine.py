@@ -0,0 +1,722 @@
+"""
+Motor de partidas en memoria.
+
+Cada proceso mantiene un ``GameSession`` por partida activa con el estado,
+la pregunta actual, los plazos y la puntuacion de los participantes. Las
+transiciones del juego (la maquina de estados de ``CountDown``) se aplican
+en memoria en tiempo constante y solo se escriben en ``models.Game`` en los
+puntos de control:
+
+- al empezar cada pregunta (WAITING -> QUESTION y ANSWER -> QUESTION),
+- al terminar la partida (ANSWER -> LEADERBOARD),
+- al expulsar la sesion del registro.
+
+El paso QUESTION -> ANSWER queda solo en memoria; si el proceso se
+reinicia, la partida se retoma desde el ultimo punto de control.
+
+Las fases con tiempo (la cuenta atras y la pregunta) tienen un plazo en el
+servidor (``services.timers``): al vencer, la partida avanza sola.
+
+Cada proceso (worker) tiene su propia copia de la sesion. Los cambios se
+publican en el bus de la partida (``services.events``) y las copias de los
+demas procesos los aplican sin consultar ``Game``. El plazo de cada fase lo
+vigila solo el proceso que hizo la transicion; si la siguiente transicion
+ocurre en otro proceso, el temporizador anterior se cancela al recibirla.
+Si el bus pierde eventos (``resync``), las sesiones se vuelven a cargar
+desde el ultimo punto de control, como tras un reinicio.
+
+Las vistas de ``services`` y la API de ``restServer`` son clientes de este
+motor: ninguna consulta ``Game`` directamente durante la partida.
+"""
+import threading
+import time
+import uuid
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict, namedtuple
+from functools import partial
+
+from django.conf import settings
+from django.http import Http404
+from django.utils import timezone
+
+from models.constants import WAITING, QUESTION, ANSWER, LEADERBOARD
+from models.models import Game, Guess
+
+from .events import bus, publish_state
+from .executor import executor
+from .ingestion import ingestor
+from .leaderboard import Leaderboard
+from .responses import StateCache
+from .snapshot import compile_questionnaire, get_snapshot
+from .timers import timers
+
+COUNTDOWN_TEMPLATE = 'services/game_countdown.html'
+QUESTION_TEMPLATE = 'services/game_question.html'
+ANSWER_TEMPLATE = 'services/game_answer.html'
+LEADERBOARD_TEMPLATE = 'services/game_leaderboard.html'
+
+# pantalla que muestra el anfitrion tras la ultima transicion: plantilla,
+# estado y pregunta con los que se construye (los de antes de la
+# transicion) y fase a la que ha pasado la partida ("estado-pregunta")
+Screen = namedtuple('Screen', ['template', 'state', 'questionNo', 'phase'])
+# eventos tras los que hay que volver a cargar la sesion
+RELOAD = ('changed', 'resync')
+# plantilla de la pantalla segun el estado anterior a la transicion
+SCREENS = {
+    WAITING: COUNTDOWN_TEMPLATE,
+    QUESTION: QUESTION_TEMPLATE,
+    ANSWER: ANSWER_TEMPLATE,
+    LEADERBOARD: LEADERBOARD_TEMPLATE,
+}
+
+
+class GameSession:
+    """
+    Estado autoritativo de una partida en memoria.
+
+    :param game: Instancia de ``Game``; su ``state`` y ``questionNo`` se
+        actualizan en memoria y se usan directamente en las plantillas.
+    :param questions: Cuestionario compilado (``services.snapshot``)
+    :param participants: Lista de tuplas (id, alias, points, uuidP)
+    """
+
+    def __init__(self, game, questions, participants):
+        self.game = game
+        self.questions = questions
+        participants = list(participants)
+        self.uuids = {uuidP: participant_id
+                      for participant_id, _, _, uuidP in participants}
+        self.leaderboard = Leaderboard(
+            participant[:3] for participant in participants)
+        # alias en uso, para unirse sin consultar la base de datos
+        self.aliases = {alias for _, alias, _, _ in participants}
+        # ids de los participantes en orden, para la sala de espera
+        self._joined = sorted(participant_id
+                              for participant_id, _, _, _ in participants)
+        # puntos por participante, compartidos con la clasificacion
+        self.scores = self.leaderboard.scores
+        self._answered = {}
+        self._counts = {}
+        # cuerpos ya codificados de la respuesta de estado de esta version
+        self.responses = StateCache()
+        self.deadline = None
+        self.screen = None
+        self.subscription = None
+        self._timer = None
+        self.dirty = False
+        self.used = time.monotonic()
+        self.lock = threading.RLock()
+        # ordena las transiciones y los puntos de control, que escriben y
+        # publican sin retener ``lock``
+        self._advancing = threading.Lock()
+
+    @classmethod
+    def load(cls, publicId):
+        """
+        Construye la sesion de una partida a partir de la base de datos.
+
+        :param publicId: PIN de la partida
+
+        :return: Sesion de la partida
+        :raises Game.DoesNotExist: si no existe la partida
+        """
+        game = Game.objects.select_related('questionnaire').get(
+            publicId=publicId)
+        questions = compile_questionnaire(game.questionnaire)
+        participants = game.participant_set.values_list(
+            'id', 'alias', 'points', 'uuidP')
+        return cls(game, questions, participants)
+
+    @property
+    def publicId(self):
+        return self.game.publicId
+
+    @property
+    def state(self):
+        return self.game.state
+
+    @property
+    def questionNo(self):
+        return self.game.questionNo
+
+    @property
+    def question(self):
+        """Pregunta actual o None si el cuestionario esta vacio"""
+        if self.game.questionNo < len(self.questions):
+            return self.questions[self.game.questionNo]
+        return None
+
+    @property
+    def question_id(self):
+        """Id de la pregunta actual o None si el cuestionario esta vacio"""
+        question = self.question
+        return question.id if question is not None else None
+
+    @property
+    def question_value(self):
+        """Puntos de la pregunta actual"""
+        return self.question.value
+
+    def answers(self, question_id):
+        """
+        Respuestas de una pregunta, sin consultar la base de datos.
+
+        :param question_id: Id de la pregunta
+
+        :return: Tupla ordenada de ``AnswerSnapshot``
+        """
+        return self.questions.by_id[question_id].answers
+
+    def answered(self, question_id):
+        """
+        Participantes que han respondido a una pregunta desde que se cargo
+        la sesion, sin consultar la base de datos: una respuesta anterior a
+        la carga que se repita la rechaza la restriccion unica de ``Guess``
+        al escribirla (``services.ingestion``).
+
+        :param question_id: Id de la pregunta
+
+        :return: Conjunto de ids de participante
+        """
+        with self.lock:
+            return self._answered.setdefault(question_id, set())
+
+    def answer_counts(self, question_id):
+        """
+        Contadores de respuestas por opcion de una pregunta.
+
+        Se inicializan con una consulta ``GROUP BY`` la primera vez y despues
+        se incrementan en memoria con cada respuesta aceptada. La consulta
+        se hace sin ``lock``, para que las demas peticiones no la esperen;
+        quien necesite los contadores con el cerrojo adquirido debe
+        cargarlos antes (``has_counts``).
+
+        :param question_id: Id de la pregunta
+
+        :return: ``Counter`` id de respuesta -> numero de respuestas
+        """
+        counts = self._counts.get(question_id)
+        if counts is None:
+            loaded = Counter(
+                Guess.objects.answer_counts(self.game.pk, question_id))
+            with self.lock:
+                # otro hilo puede haberlos cargado mientras tanto
+                counts = self._counts.setdefault(question_id, loaded)
+        return counts
+
+    def has_counts(self, question_id):
+        """True si los contadores de la pregunta ya estan en memoria"""
+        return question_id in self._counts
+
+    def record_guess(self, question_id, participant_id, answer_id):
+        """
+        Anota la respuesta de un participante en los contadores.
+
+        :param question_id: Id de la pregunta
+        :param participant_id: Id del participante
+        :param answer_id: Id de la respuesta elegida
+
+        :return: False si el participante ya habia respondido
+        """
+        counts = self.answer_counts(question_id)
+        with self.lock:
+            answered = self.answered(question_id)
+            if participant_id in answered:
+                return False
+            answered.add(participant_id)
+            counts[answer_id] += 1
+            return True
+
+    def reject_guess(self, question_id, answer_id, participant_id, points):
+        """
+        Descuenta una respuesta anotada que la base de datos ha rechazado
+        por repetida. El participante sigue contando como respondido.
+
+        :param question_id: Id de la pregunta
+        :param answer_id: Id de la respuesta elegida
+        :param participant_id: Id del participante
+        :param points: Puntos que se le sumaron
+        """
+        with self.lock:
+            counts = self._counts.get(question_id)
+            if counts is not None and counts[answer_id] > 0:
+                counts[answer_id] -= 1
+            if points:
+                self.add_points(participant_id, -points)
+
+    def distribution(self, question_id):
+        """
+        Reparto de respuestas de una pregunta, sin recorrer ``Guess``.
+
+        :param question_id: Id de la pregunta
+
+        :return: Lista ordenada de tuplas (``AnswerSnapshot``, count)
+        """
+        counts = self.answer_counts(question_id)
+        with self.lock:
+            return [(answer, counts[answer.id])
+                    for answer in self.answers(question_id)]
+
+    @property
+    def phase(self):
+        """Fase actual de la partida ("estado-pregunta")"""
+        return '%d-%d' % (self.game.state, self.game.questionNo)
+
+    @property
+    def version(self):
+        """
+        Version del estado de la partida, sin consultar la base de datos.
+
+        Es la suma del numero de transiciones hechas (WAITING = 0, cada
+        pregunta pasa por QUESTION y ANSWER, LEADERBOARD al final) y del
+        numero de participantes. Ambos solo crecen, asi que la version
+        crece con cada cambio; y como solo depende del estado, todos los
+        procesos que han aplicado los mismos eventos dan la misma.
+        """
+        with self.lock:
+            state = self.game.state
+            if state == WAITING:
+                transitions = 0
+            elif state == LEADERBOARD:
+                transitions = 2 * len(self.questions) + 1
+            else:
+                transitions = 2 * self.game.questionNo + state - WAITING
+            return transitions + len(self.leaderboard)
+
+    def is_late(self):
+        """True si ha vencido el plazo de la fase actual"""
+        deadline = self.deadline
+        return deadline is not None and time.monotonic() > deadline
+
+    def is_last_question(self):
+        return self.game.questionNo >= len(self.questions) - 1
+
+    def advance(self):
+        """
+        Aplica la siguiente transicion de la partida.
+
+        Devuelve la plantilla que debe mostrar el anfitrion, igual que hacia
+        ``CountDown.get_template_names``:
+
+        - WAITING: cuenta atras y pasa a QUESTION.
+        - QUESTION: pregunta y pasa a ANSWER.
+        - ANSWER: respuesta y pasa a la siguiente pregunta o a LEADERBOARD.
+        - LEADERBOARD: podio, sin cambios.
+
+        La pantalla resultante queda en ``screen``. La transicion se aplica
+        con ``lock``; el punto de control y el ultimo lote de respuestas se
+        escriben y la transicion se publica despues de soltarlo.
+
+        :return: Nombre de la plantilla
+        """
+        with self._advancing:
+            return self._advance()
+
+    def _advance(self):
+        checkpoint = flush = False
+        with self.lock:
+            game = self.game
+            state, questionNo = game.state, game.questionNo
+            now = time.monotonic()
+            if game.state == WAITING:
+                game.state = QUESTION
+                self.deadline = now + game.countdownTime
+                template = COUNTDOWN_TEMPLATE
+                checkpoint = True
+            elif game.state == QUESTION:
+                # ya no se aceptan respuestas: las pendientes se escriben
+                # antes de publicar la correccion
+                flush = True
+                game.state = ANSWER
+                self.deadline = now + self.question.answerTime \
+                    if self.question is not None else None
+                self.dirty = True
+                template = QUESTION_TEMPLATE
+            elif game.state == ANSWER:
+                if self.is_last_question():
+                    game.state = LEADERBOARD
+                else:
+                    game.questionNo += 1
+                    game.state = QUESTION
+                self.deadline = None
+                template = ANSWER_TEMPLATE
+                checkpoint = True
+            else:
+                self.screen = Screen(LEADERBOARD_TEMPLATE, state, questionNo,
+                                     self.phase)
+                return LEADERBOARD_TEMPLATE
+            self.screen = Screen(template, state, questionNo, self.phase)
+            self._schedule()
+            remaining = self.deadline - now \
+                if self.deadline is not None else None
+        if checkpoint:
+            self._checkpoint()
+        if flush:
+            ingestor.flush(game.publicId)
+        publish_state(game, (state, questionNo), remaining)
+        return template
+
+    def expire(self, phase):
+        """
+        Avanza la partida si sigue en la fase ``phase``.
+
+        La llaman el temporizador de la fase y la pagina del anfitrion al
+        agotarse su cuenta atras; el que llegue segundo no vuelve a avanzar.
+
+        :param phase: Fase que ha vencido ("estado-pregunta")
+
+        :return: Nombre de la plantilla de la pantalla actual
+        """
+        with self._advancing:
+            with self.lock:
+                if phase != self.phase and self.screen is not None:
+                    return self.screen.template
+            return self._advance()
+
+    def _schedule(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self.deadline is not None:
+            self._timer = timers.schedule(
+                self.deadline, partial(self.expire, self.phase))
+
+    def apply(self, event):
+        """
+        Aplica un evento de la partida publicado por otro proceso.
+
+        :param event: Evento de ``services.events`` (``state``,
+            ``participant`` o ``guess``)
+        """
+        kind = event['type']
+        if kind == 'guess':
+            # los contadores se cargan antes de tomar el cerrojo
+            self.answer_counts(event['question'])
+        with self.lock:
+            if kind == 'state':
+                game = self.game
+                game.state, game.questionNo = event['state'], \
+                    event['questionNo']
+                state, questionNo = event['screen']
+                self.screen = Screen(SCREENS[state], state, questionNo,
+                                     self.phase)
+                remaining = event['remaining']
+                self.deadline = time.monotonic() + remaining \
+                    if remaining is not None else None
+                # el proceso que hizo la transicion vigila el plazo y
+                # guarda el punto de control
+                self.dirty = False
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            elif kind == 'participant':
+                self.add_participant(event['id'], event['alias'],
+                                     event['points'],
+                                     uuid.UUID(event['uuidP']))
+            elif kind == 'guess':
+                if self.record_guess(event['question'], event['participant'],
+                                     event['answer']):
+                    self.add_points(event['participant'], event['points'])
+
+    def close(self):
+        """Cancela el temporizador y la suscripcion de la partida"""
+        with self.lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            subscription, self.subscription = self.subscription, None
+        if subscription is not None:
+            bus.unsubscribe(subscription)
+
+    def checkpoint(self):
+        """Guarda el estado y la ultima actividad de la partida (UPDATE)"""
+        with self._advancing:
+            self._checkpoint()
+
+    def _checkpoint(self):
+        # el estado se lee con ``lock`` y se escribe sin el; ``_advancing``
+        # evita que se escriba un estado anterior despues de uno posterior
+        with self.lock:
+            state, questionNo = self.game.state, self.game.questionNo
+            self.dirty = False
+        try:
+            # update() no rellena los campos auto_now
+            Game.objects.filter(pk=self.game.pk).update(
+                state=state, questionNo=questionNo,
+                updated_at=timezone.now())
+        except BaseException:
+            self.dirty = True
+            raise
+
+    def add_participant(self, participant_id, alias, points=0, uuidP=None):
+        with self.lock:
+            joined = self._joined
+            # los eventos de otros procesos pueden llegar desordenados
+            position = bisect_left(joined, participant_id)
+            if position == len(joined) or joined[position] != participant_id:
+                joined.insert(position, participant_id)
+            self.leaderboard.add(participant_id, alias, points)
+            self.aliases.add(alias)
+            if uuidP is not None:
+                self.uuids[uuidP] = participant_id
+
+    def joined_after(self, after, limit):
+        """
+        Participantes que se han unido despues de otro, sin consultar la
+        base de datos.
+
+        :param after: Id del ultimo participante que ya tiene el cliente
+            (0 para empezar)
+        :param limit: Numero maximo de participantes que se devuelven
+
+        :return: Tupla (lista de (id, alias) por orden de id, total de
+            participantes)
+        """
+        with self.lock:
+            joined = self._joined
+            start = bisect_right(joined, after)
+            aliases = self.leaderboard.aliases
+            return ([(participant_id, aliases[participant_id])
+                     for participant_id in joined[start:start + limit]],
+                    len(joined))
+
+    def reserve_alias(self, alias):
+        """
+        Reserva un alias para un participante que se esta uniendo.
+
+        :param alias: Alias pedido
+
+        :return: False si ya lo usa otro participante de la partida
+        """
+        with self.lock:
+            if alias in self.aliases:
+                return False
+            self.aliases.add(alias)
+            return True
+
+    def release_alias(self, alias):
+        """Libera un alias reservado si no llega a crearse el participante"""
+        with self.lock:
+            self.aliases.discard(alias)
+
+    def add_points(self, participant_id, points):
+        self.leaderboard.add_points(participant_id, points)
+
+
+class SessionRegistry:
+    """
+    Registro de las sesiones de partida del proceso.
+
+    Las sesiones se cargan bajo demanda y se expulsan por antiguedad de uso
+    cuando se supera ``GAME_SESSIONS_MAX``; al expulsarlas se guarda su
+    estado si tenia cambios pendientes.
+
+    Una sesion sin usar durante ``GAME_SESSIONS_IDLE`` segundos se vuelve a
+    cargar: el PIN de una partida terminada puede haberse asignado a otra
+    (``models.pins``) sin que este proceso se entere.
+    """
+
+    def __init__(self, max_sessions=None):
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        self._max_sessions = max_sessions
+        # cargas en curso por partida y eventos recibidos durante ellas
+        self._loaders = Counter()
+        self._pending = {}
+
+    @property
+    def max_sessions(self):
+        if self._max_sessions is None:
+            return getattr(settings, 'GAME_SESSIONS_MAX', 1000)
+        return self._max_sessions
+
+    @property
+    def max_idle(self):
+        return getattr(settings, 'GAME_SESSIONS_IDLE', 3600)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, publicId):
+        """
+        Devuelve la sesion de la partida, cargandola si no esta en memoria.
+
+        :param publicId: PIN de la partida
+
+        :return: Sesion de la partida
+        :raises Game.DoesNotExist: si no existe la partida
+        """
+        now = time.monotonic()
+        evicted = []
+        with self._lock:
+            session = self._sessions.get(publicId)
+            if session is not None:
+                if now - session.used <= self.max_idle:
+                    session.used = now
+                    self._sessions.move_to_end(publicId)
+                    return session
+                evicted.append(self._sessions.pop(publicId))
+        for old in evicted:
+            old.close()
+            if old.dirty:
+                old.checkpoint()
+        # los eventos de la partida que llegan mientras se carga se
+        # guardan y se aplican despues, para no perder, p.ej., un
+        # participante que se une justo entonces
+        with self._lock:
+            self._loaders[publicId] += 1
+            self._pending.setdefault(publicId, [])
+        subscription = bus.subscribe(publicId,
+                                     partial(self._on_event, publicId))
+        try:
+            loaded = GameSession.load(publicId)
+        except BaseException:
+            bus.unsubscribe(subscription)
+            with self._lock:
+                self._loaded(publicId)
+            raise
+        with self._lock:
+            # otro hilo puede haberla cargado mientras tanto
+            session = self._sessions.get(publicId)
+            pending = None
+            if session is None:
+                session = self._sessions[publicId] = loaded
+                session.subscription, subscription = subscription, None
+                pending = self._pending.pop(publicId, [])
+                # los eventos nuevos esperan a que se apliquen los pendientes
+                session.lock.acquire()
+            self._loaded(publicId)
+            session.used = now
+            self._sessions.move_to_end(publicId)
+            evicted = []
+            while len(self._sessions) > self.max_sessions:
+                evicted.append(self._sessions.popitem(last=False)[1])
+        if subscription is not None:
+            bus.unsubscribe(subscription)
+        if pending is not None:
+            try:
+                for event in pending:
+                    if event['type'] not in RELOAD:
+                        session.apply(event)
+            finally:
+                session.lock.release()
+            if any(event['type'] in RELOAD for event in pending):
+                # se ha modificado durante la carga: se recargara
+                self.discard(publicId)
+        for old in evicted:
+            old.close()
+            if old.dirty:
+                old.checkpoint()
+        return session
+
+    def _loaded(self, publicId):
+        """Termina una carga de la partida; se llama con ``_lock``"""
+        self._loaders[publicId] -= 1
+        if not self._loaders[publicId]:
+            del self._loaders[publicId]
+            self._pending.pop(publicId, None)
+
+    def _on_event(self, publicId, event):
+        """
+        Aplica a la sesion los eventos publicados por otros procesos.
+
+        Las altas de participantes se aplican tambien si son del propio
+        proceso: asi llegan a la sesion aunque se este cargando.
+
+        Con ``changed`` (partida modificada fuera del motor) y ``resync``
+        (el bus puede haber perdido eventos) se olvida la sesion, que se
+        vuelve a cargar de la base de datos en la siguiente peticion; con
+        ``resync`` se guarda antes lo que solo estaba en memoria.
+        """
+        kind = event['type']
+        if event['origin'] == bus.origin and kind != 'participant':
+            return
+        with self._lock:
+            session = self._sessions.get(publicId)
+            if session is None:
+                pending = self._pending.get(publicId)
+                if pending is not None:
+                    pending.append(event)
+                return
+            if kind in RELOAD:
+                del self._sessions[publicId]
+        if kind in RELOAD:
+            session.close()
+            if kind == 'resync' and session.dirty:
+                session.checkpoint()
+        else:
+            session.apply(event)
+
+    def cached(self, publicId):
+        """
+        Como ``get``, pero solo si la sesion esta en memoria y no ha
+        caducado; no consulta la base de datos.
+
+        :param publicId: PIN de la partida
+
+        :return: Sesion de la partida o None si habria que cargarla
+        """
+        now = time.monotonic()
+        with self._lock:
+            session = self._sessions.get(publicId)
+            if session is None or now - session.used > self.max_idle:
+                return None
+            session.used = now
+            self._sessions.move_to_end(publicId)
+            return session
+
+    def peek(self, publicId):
+        """Devuelve la sesion si ya esta en memoria, sin cargarla"""
+        with self._lock:
+            return self._sessions.get(publicId)
+
+    def discard(self, publicId):
+        """Olvida la sesion (p.ej. porque la partida se ha modificado)"""
+        with self._lock:
+            session = self._sessions.pop(publicId, None)
+        if session is not None:
+            session.close()
+
+    def clear(self):
+        """Olvida todas las sesiones y los cuestionarios compilados"""
+        with self._lock:
+            dropped = list(self._sessions.values())
+            self._sessions.clear()
+        for session in dropped:
+            session.close()
+        get_snapshot.cache_clear()
+
+
+sessions = SessionRegistry()
+
+
+def get_session_or_404(publicId):
+    """
+    Devuelve la sesion de la partida o lanza Http404 si no existe.
+
+    :param publicId: PIN de la partida
+
+    :return: Sesion de la partida
+    """
+    if publicId is None:
+        raise Http404('No Game matches the given query.')
+    try:
+        return sessions.get(publicId)
+    except Game.DoesNotExist:
+        raise Http404('No Game matches the given query.')
+
+
+async def aget_session_or_404(publicId):
+    """
+    Version asincrona de ``get_session_or_404``: con la sesion en memoria
+    no sale del bucle de eventos; si hay que cargarla, la carga en el grupo
+    de hilos de ``services.executor``.
+
+    :param publicId: PIN de la partida
+
+    :return: Sesion de la partida
+    """
+    session = sessions.cached(publicId) if publicId is not None else None
+    if session is None:
+        session = await executor.run(get_session_or_404, publicId)
+    return session
@@ -0,0 +1,733 @@
+"""
+Bus de eventos de las partidas.
+
+Con varios workers (``kahootclone.wsgi`` bajo gunicorn) la peticion de un
+participante suele llegar a un proceso distinto del que atiende al
+anfitrion. Cada cambio de una partida (transicion de estado, participante
+nuevo, respuesta registrada...) se publica en el canal de su ``publicId``
+y lo reciben todos los procesos suscritos: las sesiones en memoria
+(``services.engine``) lo aplican sin volver a consultar ``Game`` y los
+WebSocket (``services.realtime``) lo reenvian a sus clientes.
+
+El transporte entre procesos es intercambiable (``BACKENDS``):
+
+- ``local``: solo dentro del proceso; para un unico worker y los tests.
+- ``unix``: entre los workers de una misma maquina a traves de un socket
+  Unix. El primer proceso que consigue el cerrojo ``<PATH>.lock`` hace de
+  concentrador; si cae, otro ocupa su lugar y los demas se reconectan.
+  Los eventos que se pierden mientras tanto no se repiten: los
+  suscriptores reciben un evento ``resync`` y vuelven a cargar la partida
+  de la base de datos.
+
+Cada proceso se suscribe una sola vez por canal al transporte y reparte
+los eventos entre sus suscriptores: un evento se serializa una vez al
+publicarlo y se decodifica una vez por proceso. Los suscriptores se
+ejecutan en el hilo que entrega el evento y deben ser rapidos. Publicar no
+espera nunca a otro proceso, pero con ``local`` los suscriptores se
+ejecutan en el hilo que publica: no se debe publicar con el cerrojo de una
+sesion (``GameSession.lock``) adquirido.
+
+La configuracion esta en ``settings.GAME_EVENTS``:
+
+- ``BACKEND``: ``local`` o ``unix``.
+- ``PATH``: ruta del socket Unix.
+"""
+import errno
+import fcntl
+import json
+import logging
+import os
+import selectors
+import socket
+import struct
+import threading
+import uuid
+from collections import defaultdict
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'BACKEND': 'local',
+    'PATH': '/tmp/kahootclone-events.sock',
+}
+
+# cabecera de cada trama del socket: longitud del canal y de los datos
+FRAME = struct.Struct('!HI')
+SUBSCRIBE = b'+'
+UNSUBSCRIBE = b'-'
+# respuesta del concentrador a SUBSCRIBE
+SUBSCRIBED = b'!'
+# pide a los procesos suscritos que resincronicen la partida
+RESYNC = b'='
+# bytes que puede acumular la cola de salida de una conexion
+MAX_BUFFER = 1 << 22
+# segundos entre intentos de reconexion al concentrador
+RECONNECT_DELAY = 0.1
+# segundos que se espera la primera conexion antes de publicar
+CONNECT_TIMEOUT = 1
+
+
+class LocalBackend:
+    """
+    Transporte dentro del proceso: los eventos se entregan en el mismo hilo
+    que los publica.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._channels = {}
+
+    def subscribe(self, channel, deliver):
+        """
+        Entrega a ``deliver(channel, data)`` los eventos del canal.
+
+        :param channel: Nombre del canal
+        :param deliver: Funcion que recibe el canal y los datos (str)
+        """
+        with self._lock:
+            self._channels[channel] = deliver
+
+    def unsubscribe(self, channel):
+        """Deja de recibir los eventos del canal"""
+        with self._lock:
+            self._channels.pop(channel, None)
+
+    def publish(self, channel, data):
+        """
+        Publica un evento ya serializado.
+
+        :param channel: Nombre del canal
+        :param data: Evento serializado (str)
+        """
+        with self._lock:
+            deliver = self._channels.get(channel)
+        if deliver is not None:
+            deliver(channel, data)
+
+    def close(self):
+        with self._lock:
+            self._channels.clear()
+
+
+def _frame(channel, data):
+    channel = channel.encode()
+    return FRAME.pack(len(channel), len(data)) + channel + data
+
+
+class _Reader:
+    """Separa en tramas los bytes recibidos por un socket"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        frames = []
+        while len(self.buffer) >= FRAME.size:
+            channel_size, data_size = FRAME.unpack_from(self.buffer)
+            end = FRAME.size + channel_size + data_size
+            if len(self.buffer) < end:
+                break
+            channel = bytes(self.buffer[FRAME.size:FRAME.size + channel_size])
+            data = bytes(self.buffer[FRAME.size + channel_size:end])
+            del self.buffer[:end]
+            frames.append((channel.decode(), data))
+        return frames
+
+
+class _Connection:
+    """Conexion del concentrador con un proceso y su cola de salida"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = _Reader()
+        self.outbox = bytearray()
+        self.channels = set()
+        self.closed = False
+
+
+class Hub:
+    """
+    Concentrador del transporte ``unix``.
+
+    Guarda que conexiones (una por proceso) estan suscritas a cada canal y
+    reenvia cada evento, tal cual, a todas salvo a la que lo publico. Las
+    tramas cuyos datos son ``SUBSCRIBE`` o ``UNSUBSCRIBE`` gestionan las
+    suscripciones; cada ``SUBSCRIBE`` se confirma con ``SUBSCRIBED``.
+
+    Ninguna escritura bloquea: lo que no cabe en el socket de un proceso
+    espera en su cola de salida y se envia cuando el socket lo admite. Si
+    la cola supera ``MAX_BUFFER`` el proceso no da abasto; se cierra su
+    conexion y, al reconectar, resincroniza sus partidas.
+
+    :param path: Ruta del socket Unix
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._selector = selectors.DefaultSelector()
+        self._channels = defaultdict(set)
+        self._server = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            # socket de un concentrador anterior que ya no tiene el cerrojo
+            os.unlink(self.path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self.path)
+        self._server.listen(128)
+        self._server.setblocking(False)
+        self._selector.register(self._server, selectors.EVENT_READ)
+        thread = threading.Thread(target=self._run, name='game-events-hub',
+                                  daemon=True)
+        thread.start()
+
+    def _run(self):
+        while True:
+            for key, mask in self._selector.select():
+                if key.fileobj is self._server:
+                    self._accept()
+                    continue
+                conn = key.data
+                if mask & selectors.EVENT_READ and not conn.closed:
+                    self._read(conn)
+                if mask & selectors.EVENT_WRITE and not conn.closed:
+                    self._flush(conn)
+
+    def _accept(self):
+        try:
+            sock, _ = self._server.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        self._selector.register(sock, selectors.EVENT_READ,
+                                _Connection(sock))
+
+    def _read(self, conn):
+        try:
+            chunk = conn.sock.recv(1 << 16)
+        except BlockingIOError:
+            return
+        except OSError:
+            chunk = b''
+        if not chunk:
+            self._drop(conn)
+            return
+        for channel, data in conn.reader.feed(chunk):
+            if data == SUBSCRIBE:
+                self._channels[channel].add(conn)
+                conn.channels.add(channel)
+                self._send(conn, _frame(channel, SUBSCRIBED))
+                if conn.closed:
+                    return
+            elif data == UNSUBSCRIBE:
+                self._channels[channel].discard(conn)
+                conn.channels.discard(channel)
+                if not self._channels[channel]:
+                    del self._channels[channel]
+            else:
+                frame = _frame(channel, data)
+                for target in list(self._channels.get(channel, ())):
+                    if target is not conn:
+                        self._send(target, frame)
+
+    def _send(self, conn, frame):
+        if len(conn.outbox) + len(frame) > MAX_BUFFER:
+            logger.warning('game events subscriber too slow, disconnecting')
+            self._drop(conn)
+            return
+        was_empty = not conn.outbox
+        conn.outbox += frame
+        if was_empty:
+            self._flush(conn)
+
+    def _flush(self, conn):
+        """Envia lo que admita el socket de la cola de salida"""
+        try:
+            sent = conn.sock.send(conn.outbox)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self._drop(conn)
+            return
+        del conn.outbox[:sent]
+        events = selectors.EVENT_READ
+        if conn.outbox:
+            events |= selectors.EVENT_WRITE
+        self._selector.modify(conn.sock, events, conn)
+
+    def _drop(self, conn):
+        if conn.closed:
+            return
+        conn.closed = True
+        for channel in conn.channels:
+            self._channels[channel].discard(conn)
+            if not self._channels[channel]:
+                del self._channels[channel]
+        try:
+            self._selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        conn.sock.close()
+
+
+class UnixSocketBackend:
+    """
+    Transporte entre los procesos de una maquina a traves de un socket Unix.
+
+    Cada evento se envia al concentrador, que lo reenvia a los demas
+    procesos, y se entrega directamente a los suscriptores del propio
+    proceso.
+
+    Publicar nunca bloquea: la trama se escribe en el socket sin esperar y
+    lo que no cabe queda en una cola de salida acotada (``MAX_BUFFER``).
+    Un hilo por proceso vacia esa cola, lee los eventos que llegan del
+    concentrador y se encarga de conectar, reconectar y, si no hay
+    concentrador, ocupar su lugar. ``subscribe`` espera a que el
+    concentrador confirme la suscripcion, para que no se pierdan los
+    eventos que se publiquen justo despues.
+
+    Mientras no hay conexion los eventos publicados se pierden; al
+    reconectar, el proceso pide a los demas que resincronicen sus partidas
+    (trama ``RESYNC``) y resincroniza las suyas, porque tambien puede
+    haberse perdido los de ellos. A los suscriptores se les entrega
+    entonces ``None`` en lugar de los datos.
+
+    :param path: Ruta del socket Unix
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._channels = {}
+        # socket conectado (None sin conexion) y su cola de salida
+        self._sock = None
+        self._outbox = bytearray()
+        self._broken = False
+        self._closed = False
+        # suscripciones que esperan la confirmacion del concentrador
+        self._waiting = {}
+        self._hub = None
+        self._lockfile = None
+        self._thread = None
+        # se activa tras el primer intento de conexion
+        self._started = threading.Event()
+        self._wakeup, self._waker = socket.socketpair()
+        self._wakeup.setblocking(False)
+        self._waker.setblocking(False)
+
+    def subscribe(self, channel, deliver):
+        self._start()
+        ready = threading.Event()
+        with self._lock:
+            self._channels[channel] = deliver
+            if self._sock is not None:
+                self._waiting[channel] = ready
+                self._send(_frame(channel, SUBSCRIBE))
+            else:
+                ready.set()
+        # una vez confirmada no se pierde ningun evento del canal
+        ready.wait(CONNECT_TIMEOUT)
+
+    def unsubscribe(self, channel):
+        with self._lock:
+            if self._channels.pop(channel, None) is not None:
+                self._send(_frame(channel, UNSUBSCRIBE))
+
+    def publish(self, channel, data):
+        self._start()
+        with self._lock:
+            deliver = self._channels.get(channel)
+            self._send(_frame(channel, data.encode()))
+        if deliver is not None:
+            deliver(channel, data)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._channels.clear()
+        self._wake()
+
+    def _start(self):
+        """Arranca el hilo del transporte y espera a su primera conexion"""
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run, name='game-events', daemon=True)
+                    self._thread.start()
+        self._started.wait(CONNECT_TIMEOUT)
+
+    def _wake(self):
+        try:
+            self._waker.send(b'\0')
+        except OSError:
+            # ya hay un aviso pendiente
+            pass
+
+    def _send(self, frame):
+        """
+        Escribe una trama sin bloquear; se llama con ``_lock`` adquirido.
+
+        Lo que no cabe en el socket se encola para el hilo del transporte.
+        Sin conexion la trama se pierde.
+        """
+        if self._sock is None or self._broken:
+            return
+        if not self._outbox:
+            try:
+                sent = self._sock.send(frame)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                sent = None
+            if sent is None:
+                self._broken = True
+                self._wake()
+                return
+            if sent == len(frame):
+                return
+            frame = frame[sent:]
+            self._wake()
+        if len(self._outbox) + len(frame) > MAX_BUFFER:
+            # el concentrador no da abasto: se reconecta y resincroniza
+            logger.warning('game events hub too slow, reconnecting')
+            self._broken = True
+            self._wake()
+            return
+        self._outbox += frame
+
+    def _run(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self._wakeup, selectors.EVENT_READ)
+        resync = False
+        while not self._closed:
+            sock = self._connect()
+            if sock is None:
+                self._started.set()
+                # sin concentrador: se reintenta sin retener ningun cerrojo
+                selector.select(RECONNECT_DELAY)
+                self._drain()
+                continue
+            self._serve(selector, sock, resync)
+            resync = True
+        selector.close()
+        self._wakeup.close()
+        self._waker.close()
+
+    def _drain(self):
+        try:
+            while self._wakeup.recv(1024):
+                pass
+        except OSError:
+            pass
+
+    def _connect(self):
+        """
+        Conecta con el concentrador, ocupando su lugar si no hay ninguno.
+
+        :return: Socket conectado o None
+        """
+        for _ in range(2):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+            except OSError:
+                sock.close()
+                if not self._become_hub():
+                    return None
+                continue
+            sock.setblocking(False)
+            return sock
+        return None
+
+    def _become_hub(self):
+        """Intenta ser el concentrador; False si ya lo es otro proceso"""
+        if self._hub is not None:
+            return False
+        lockfile = open(self.path + '.lock', 'a')
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as error:
+            lockfile.close()
+            if error.errno in (errno.EAGAIN, errno.EACCES):
+                # otro proceso lo es pero aun no escucha
+                return False
+            raise
+        self._lockfile = lockfile
+        self._hub = Hub(self.path)
+        self._hub.start()
+        return True
+
+    def _serve(self, selector, sock, resync):
+        """
+        Atiende una conexion hasta que se cierra.
+
+        Al conectar se repiten las suscripciones del proceso y, si es una
+        reconexion, se resincronizan las partidas de todos los procesos.
+        """
+        with self._lock:
+            self._sock = sock
+            channels = dict(self._channels)
+            for channel in channels:
+                self._send(_frame(channel, SUBSCRIBE))
+            if resync:
+                for channel in channels:
+                    self._send(_frame(channel, RESYNC))
+        self._started.set()
+        if resync:
+            for channel, deliver in channels.items():
+                deliver(channel, None)
+        selector.register(sock, selectors.EVENT_READ)
+        reader = _Reader()
+        try:
+            while True:
+                with self._lock:
+                    if self._closed or self._broken:
+                        return
+                    events = selectors.EVENT_READ
+                    if self._outbox:
+                        events |= selectors.EVENT_WRITE
+                selector.modify(sock, events)
+                for key, mask in selector.select():
+                    if key.fileobj is self._wakeup:
+                        self._drain()
+                        continue
+                    if mask & selectors.EVENT_WRITE:
+                        self._flush(sock)
+                    if mask & selectors.EVENT_READ and \
+                            not self._receive(sock, reader):
+                        return
+        finally:
+            selector.unregister(sock)
+            with self._lock:
+                self._sock = None
+                self._outbox = bytearray()
+                self._broken = False
+                waiting, self._waiting = self._waiting, {}
+            sock.close()
+            for ready in waiting.values():
+                ready.set()
+
+    def _flush(self, sock):
+        with self._lock:
+            try:
+                sent = sock.send(self._outbox)
+            except BlockingIOError:
+                return
+            except OSError:
+                self._broken = True
+                return
+            del self._outbox[:sent]
+
+    def _receive(self, sock, reader):
+        """
+        Entrega los eventos que llegan del concentrador.
+
+        :return: False si el concentrador ha cerrado la conexion
+        """
+        try:
+            chunk = sock.recv(1 << 16)
+        except BlockingIOError:
+            return True
+        except OSError:
+            chunk = b''
+        if not chunk:
+            return False
+        for channel, data in reader.feed(chunk):
+            if data == SUBSCRIBED:
+                with self._lock:
+                    ready = self._waiting.pop(channel, None)
+                if ready is not None:
+                    ready.set()
+                continue
+            # sin cerrojo: los suscriptores pueden tardar
+            deliver = self._channels.get(channel)
+            if deliver is not None:
+                deliver(channel, None if data == RESYNC else data.decode())
+        return True
+
+
+BACKENDS = {
+    'local': lambda path: LocalBackend(),
+    'unix': UnixSocketBackend,
+}
+
+
+class Subscription:
+    """Suscripcion a un canal devuelta por ``EventBus.subscribe``"""
+    __slots__ = ('channel', 'callback')
+
+    def __init__(self, channel, callback):
+        self.channel = channel
+        self.callback = callback
+
+
+class EventBus:
+    """
+    Publicacion y suscripcion de eventos por partida.
+
+    Los eventos son diccionarios serializables a JSON; ``publish`` les
+    añade ``origin``, el identificador del proceso que los publica, para
+    que los suscriptores distingan los eventos propios de los remotos.
+
+    :param backend: ``local`` o ``unix``
+    :param path: Ruta del socket Unix
+    """
+
+    def __init__(self, backend=None, path=None):
+        self._backend = backend
+        self._path = path
+        self._lock = threading.Lock()
+        self._transport = None
+        self._subscribers = {}
+        self.origin = uuid.uuid4().hex
+
+    def option(self, name):
+        value = getattr(self, '_' + name.lower(), None)
+        if value is None:
+            options = getattr(settings, 'GAME_EVENTS', {})
+            value = options.get(name, DEFAULTS[name])
+        return value
+
+    @property
+    def transport(self):
+        with self._lock:
+            if self._transport is None:
+                self._transport = BACKENDS[self.option('BACKEND')](
+                    self.option('PATH'))
+            return self._transport
+
+    @staticmethod
+    def channel(publicId):
+        return 'game.%s' % publicId
+
+    def subscribe(self, publicId, callback):
+        """
+        Llama a ``callback(event)`` con cada evento de la partida.
+
+        :param publicId: PIN de la partida
+        :param callback: Funcion que recibe el evento (dict)
+
+        :return: ``Subscription`` que se pasa a ``unsubscribe``
+        """
+        transport = self.transport
+        subscription = Subscription(self.channel(publicId), callback)
+        with self._lock:
+            group = self._subscribers.get(subscription.channel)
+            first = group is None
+            # copia al escribir: el reparto recorre la tupla sin cerrojo
+            self._subscribers[subscription.channel] = \
+                (group or ()) + (subscription,)
+        if first:
+            transport.subscribe(subscription.channel, self._deliver)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Elimina una suscripcion creada con ``subscribe``.
+
+        :param subscription: Suscripcion devuelta por ``subscribe``
+        """
+        with self._lock:
+            group = self._subscribers.get(subscription.channel, ())
+            group = tuple(s for s in group if s is not subscription)
+            if group:
+                self._subscribers[subscription.channel] = group
+                return
+            self._subscribers.pop(subscription.channel, None)
+        self.transport.unsubscribe(subscription.channel)
+
+    def subscribers(self, publicId):
+        """Numero de suscriptores de la partida en este proceso"""
+        return len(self._subscribers.get(self.channel(publicId), ()))
+
+    def publish(self, publicId, event):
+        """
+        Publica un evento de la partida en todos los procesos.
+
+        :param publicId: PIN de la partida
+        :param event: Diccionario serializable a JSON
+        """
+        event = dict(event, origin=self.origin)
+        self.transport.publish(self.channel(publicId), json.dumps(event))
+
+    def _deliver(self, channel, data):
+        group = self._subscribers.get(channel)
+        if not group:
+            return
+        # sin datos: el transporte puede haber perdido eventos del canal
+        event = json.loads(data) if data is not None else RESYNC_EVENT
+        for subscription in group:
+            try:
+                subscription.callback(event)
+            except Exception:
+                logger.exception('game event subscriber failed')
+
+    def close(self):
+        """Cierra el transporte y olvida todas las suscripciones"""
+        with self._lock:
+            transport, self._transport = self._transport, None
+            self._subscribers.clear()
+        if transport is not None:
+            transport.close()
+
+
+# evento que reciben los suscriptores cuando pueden haberse perdido
+# eventos de la partida; deben volver a cargarla de la base de datos
+RESYNC_EVENT = {'type': 'resync', 'origin': None}
+
+bus = EventBus()
+
+
+def publish_state(game, screen=None, remaining=None):
+    """
+    Publica una transicion de estado de la partida.
+
+    :param game: Partida con el estado nuevo
+    :param screen: (estado, pregunta) anteriores a la transicion, que
+        determinan la pantalla del anfitrion
+    :param remaining: Segundos que quedan del plazo de la fase o None
+    """
+    bus.publish(game.publicId, {
+        'type': 'state',
+        'state': game.state,
+        'questionNo': game.questionNo,
+        'screen': screen,
+        'remaining': remaining,
+    })
+
+
+def publish_participant(participant, publicId):
+    """Publica la llegada de un participante nuevo"""
+    bus.publish(publicId, {
+        'type': 'participant',
+        'id': participant.id,
+        'alias': participant.alias,
+        'points': participant.points,
+        'uuidP': str(participant.uuidP),
+    })
+
+
+def publish_guess(guess, publicId, points):
+    """
+    Publica que se ha registrado una respuesta.
+
+    :param guess: Respuesta guardada
+    :param publicId: PIN de la partida
+    :param points: Puntos que ha sumado el participante
+    """
+    bus.publish(publicId, {
+        'type': 'guess',
+        'question': guess.question_id,
+        'participant': guess.participant_id,
+        'answer': guess.answer_id,
+        'points': points,
+    })
+
+
+def publish_changed(publicId):
+    """Publica que la partida se ha modificado fuera del motor"""
+    bus.publish(publicId, {'type': 'changed'})
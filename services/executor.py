@@ -0,0 +1,193 @@
+"""
+Acceso a la base de datos desde las vistas asincronas.
+
+Bajo ASGI (``kahootclone.asgi``) las vistas asincronas de juego
+(``restServer.play``) no pueden consultar la base de datos desde el bucle
+de eventos. ``sync_to_async`` de Django 3.2 ejecuta ese codigo en un unico
+hilo por proceso, y un hilo por peticion agotaria los hilos (y las
+conexiones) en la rafaga de uniones de una partida grande.
+
+``executor.run`` lo ejecuta en un grupo acotado de ``THREADS`` hilos, cada
+uno con su propia conexion; las peticiones que no caben esperan en la cola
+del grupo sin ocupar ningun hilo. Las escrituras de la rafaga se agrupan
+antes de llegar aqui (``JoinBatcher`` y ``services.ingestion``), de modo
+que pocos hilos bastan.
+
+Como las peticiones de Django, cada tarea cierra al terminar la conexion
+que no deba conservarse (``CONN_MAX_AGE``) o que haya quedado rota.
+
+La configuracion esta en ``settings.GAME_ASYNC``:
+
+- ``THREADS``: hilos del grupo; con 0 se usa ``sync_to_async`` de Django
+  (un unico hilo, compartido con las vistas sincronas).
+- ``MAX_BATCH``: uniones que se escriben como mucho en un INSERT.
+- ``MAX_DELAY``: segundos que espera una union a que se llene su lote.
+"""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import (DatabaseError, close_old_connections, connection,
+                       transaction)
+from django.db.models.signals import post_save
+
+from models.models import Participant
+
+DEFAULTS = {
+    'THREADS': 8,
+    'MAX_BATCH': 200,
+    'MAX_DELAY': 0.01,
+}
+
+
+def option(name):
+    options = getattr(settings, 'GAME_ASYNC', {})
+    return options.get(name, DEFAULTS[name])
+
+
+def _call(func, args, kwargs):
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+class DatabaseExecutor:
+    """Grupo acotado de hilos para el codigo que usa la base de datos"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pool = None
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(
+                    max_workers=option('THREADS'),
+                    thread_name_prefix='kahootclone-db')
+            return self._pool
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Ejecuta ``func(*args, **kwargs)`` en el grupo de hilos.
+
+        :return: Lo que devuelva ``func``
+        """
+        if not option('THREADS'):
+            return await sync_to_async(func)(*args, **kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, _call, func, args,
+                                          kwargs)
+
+    def shutdown(self):
+        """Espera a las tareas en curso y cierra el grupo"""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown()
+
+
+executor = DatabaseExecutor()
+
+
+def create_participants(participants):
+    """
+    Escribe las altas de un lote con un unico INSERT.
+
+    ``bulk_create`` no emite ``post_save``; se emite a mano por cada
+    participante para que sus receptores (``services.signals``) publiquen
+    la union como si se hubiera guardado uno a uno.
+
+    Solo se usa ``bulk_create`` si la base de datos devuelve los ids del
+    INSERT (PostgreSQL); si no, o si falla el lote, cada alta se guarda por
+    separado, de modo que un alta erronea no hace fallar a las demas.
+
+    :param participants: Instancias de ``Participant`` sin guardar
+
+    :return: Lista con el participante guardado o la excepcion de cada
+        alta, en el mismo orden
+    """
+    if connection.features.can_return_rows_from_bulk_insert:
+        try:
+            with transaction.atomic():
+                Participant.objects.bulk_create(participants)
+        except DatabaseError:
+            pass
+        else:
+            for participant in participants:
+                post_save.send(sender=Participant, instance=participant,
+                               created=True, update_fields=None, raw=False,
+                               using=participant._state.db)
+            return list(participants)
+    return [_create_participant(participant) for participant in participants]
+
+
+def _create_participant(participant):
+    try:
+        with transaction.atomic():
+            participant.save()
+    except DatabaseError as error:
+        return error
+    return participant
+
+
+class JoinBatcher:
+    """
+    Agrupa las uniones a las partidas que llegan a la vez.
+
+    Las uniones esperan en el bucle de eventos hasta ``MAX_DELAY`` segundos
+    o hasta reunir ``MAX_BATCH``, y cada lote se escribe con un unico
+    INSERT en el grupo de hilos. Cada bucle de eventos tiene sus lotes.
+    """
+
+    def __init__(self):
+        self._batches = {}
+
+    async def join(self, game, alias):
+        """
+        Une un participante a la partida.
+
+        :param game: Partida (``Game``)
+        :param alias: Alias, ya reservado en la sesion de la partida
+
+        :return: Participante guardado
+        """
+        loop = asyncio.get_running_loop()
+        entry = self._batches.get(loop)
+        if entry is None:
+            timer = loop.call_later(option('MAX_DELAY'), self._flush, loop)
+            entry = self._batches[loop] = ([], timer)
+        batch = entry[0]
+        future = loop.create_future()
+        batch.append((Participant(game=game, alias=alias), future))
+        if len(batch) >= option('MAX_BATCH'):
+            self._flush(loop)
+        return await future
+
+    def _flush(self, loop):
+        entry = self._batches.pop(loop, None)
+        if entry is not None:
+            batch, timer = entry
+            timer.cancel()
+            loop.create_task(self._write(batch))
+
+    async def _write(self, batch):
+        try:
+            results = await executor.run(
+                create_participants, [participant for participant, _ in batch])
+        except Exception as error:
+            results = [error] * len(batch)
+        for result, (_, future) in zip(results, batch):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+joins = JoinBatcher()
@@ -0,0 +1,442 @@
+"""
+Ingesta de respuestas por lotes.
+
+Todos los participantes responden en los mismos pocos segundos. En lugar
+de un INSERT (y un UPDATE de ``Participant``) por respuesta, las respuestas
+se validan contra los datos de la sesion en memoria (``services.engine``) y
+se acumulan por partida; cada lote se escribe con un unico INSERT y un
+unico ``Participant.objects.add_points``.
+
+La base de datos rechaza las respuestas repetidas (restriccion unica
+participante-pregunta de ``Guess``): el INSERT las descarta con
+``ON CONFLICT DO NOTHING`` y solo suma los puntos de las que escribe. Asi
+se detecta, sin consultas previas, la repeticion que la sesion en memoria
+no puede ver (una sesion recargada a mitad de pregunta u otro worker); la
+sesion descuenta la respuesta (``GameSession.reject_guess``) y, salvo con
+``async``, la peticion recibe el rechazo.
+
+Un lote se escribe cuando alcanza ``MAX_BATCH`` respuestas, cuando pasan
+``MAX_DELAY`` segundos desde su primera respuesta o cuando la partida deja
+de aceptar respuestas. La durabilidad se configura en
+``settings.GUESS_INGESTION['DURABILITY']``:
+
+- ``immediate``: cada respuesta se escribe antes de contestar (sin lotes).
+- ``batch``: la peticion espera a que se confirme el lote que contiene su
+  respuesta (*group commit*). Es duradero y la espera esta acotada por
+  ``MAX_DELAY``.
+- ``async``: se contesta en cuanto la respuesta entra en el lote; si el
+  proceso cae se pierden como mucho ``MAX_DELAY`` segundos de respuestas.
+
+``submit_async`` es la version para las vistas asincronas
+(``restServer.play``): espera al lote en el bucle de eventos, sin ocupar
+un hilo, y lo escribe en el grupo de hilos de ``services.executor``.
+"""
+import asyncio
+import logging
+import threading
+from collections import Counter
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from models.constants import QUESTION
+from models.models import Guess, Participant
+
+from . import events
+from .executor import executor
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+IMMEDIATE = 'immediate'
+BATCH = 'batch'
+ASYNC = 'async'
+
+DEFAULTS = {
+    'DURABILITY': BATCH,
+    'MAX_BATCH': 100,
+    'MAX_DELAY': 0.02,
+}
+
+GUESS_ERROR = 'wait until the question is shown'
+GUESS_LATE_ERROR = 'the time to answer is over'
+GUESS_REPEATED_ERROR = 'this question has already been answered'
+GUESS_PARTICIPANT_ERROR = 'participant not found in this game'
+GUESS_ANSWER_ERROR = 'invalid answer'
+
+
+class GuessRejected(Exception):
+    """
+    Respuesta no aceptada.
+
+    :param message: Mensaje para el cliente
+    :param reason: ``state``, ``late``, ``repeated``, ``participant`` o
+        ``answer``
+    """
+
+    def __init__(self, message, reason):
+        super().__init__(message)
+        self.message = message
+        self.reason = reason
+
+
+class CountsMissing(Exception):
+    """
+    Los contadores de la pregunta no estan cargados en la sesion.
+
+    :param question_id: Id de la pregunta
+    """
+
+    def __init__(self, question_id):
+        super().__init__(question_id)
+        self.question_id = question_id
+
+
+class Batch:
+    """Respuestas pendientes de escribir de una partida"""
+
+    def __init__(self, session):
+        self.session = session
+        self.publicId = session.publicId
+        self.guesses = []
+        self.points = Counter()
+        self.taken = False
+        self.done = threading.Event()
+        self.error = None
+        # participantes cuya respuesta ha rechazado la base de datos
+        self.rejected = set()
+        # funciones a llamar al terminar, de quien espera en un bucle
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def add(self, guess, points):
+        self.guesses.append(guess)
+        if points:
+            self.points[guess.participant_id] += points
+
+    def finish(self):
+        """Marca el lote como escrito (o fallido) y avisa a quien espera"""
+        with self._lock:
+            self.done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    async def wait_async(self, timeout=None):
+        """
+        Espera a que se escriba el lote sin bloquear el bucle de eventos.
+
+        :param timeout: Segundos maximos de espera o None
+
+        :return: True si se ha escrito
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            try:
+                loop.call_soon_threadsafe(_resolve, future)
+            except RuntimeError:
+                # el bucle ya se ha cerrado
+                pass
+
+        with self._lock:
+            if self.done.is_set():
+                return True
+            self._callbacks.append(wake)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class GuessIngestor:
+    """
+    Acumula y escribe por lotes las respuestas de todas las partidas.
+
+    :param durability: ``immediate``, ``batch`` o ``async``
+    :param max_batch: Tamaño maximo de un lote
+    :param max_delay: Segundos maximos que espera un lote
+    """
+
+    def __init__(self, durability=None, max_batch=None, max_delay=None):
+        self._durability = durability
+        self._max_batch = max_batch
+        self._max_delay = max_delay
+        self._lock = threading.Lock()
+        self._batches = {}
+
+    def option(self, name):
+        value = getattr(self, '_' + name.lower())
+        if value is None:
+            options = getattr(settings, 'GUESS_INGESTION', {})
+            value = options.get(name, DEFAULTS[name])
+        return value
+
+    def submit(self, session, uuidP, answer_index):
+        """
+        Valida una respuesta contra la sesion y la encola.
+
+        :param session: Sesion de la partida (``services.engine``)
+        :param uuidP: uuid del participante
+        :param answer_index: Posicion de la respuesta elegida
+
+        :return: Instancia de ``Guess`` (sin id si aun no se ha escrito)
+        :raises GuessRejected: si la respuesta no se acepta
+        """
+        try:
+            guess = self._submit(session, uuidP, answer_index)
+        except GuessRejected as rejected:
+            metrics.inc('guesses_rejected_total', reason=rejected.reason)
+            raise
+        metrics.inc('guesses_total')
+        return guess
+
+    def _submit(self, session, uuidP, answer_index):
+        while True:
+            try:
+                guess, batch, leader, full = self._accept(session, uuidP,
+                                                          answer_index)
+                break
+            except CountsMissing as missing:
+                # la primera respuesta de la pregunta carga sus contadores,
+                # sin el cerrojo de la sesion
+                session.answer_counts(missing.question_id)
+        durability = self.option('DURABILITY')
+        if full or durability == IMMEDIATE:
+            self._write(batch)
+        elif leader:
+            if durability == ASYNC:
+                self._write_later(batch)
+            else:
+                batch.done.wait(self.option('MAX_DELAY'))
+                if self._take(batch):
+                    self._write(batch)
+        if durability != ASYNC:
+            batch.done.wait()
+            self._check(batch, guess)
+        return guess
+
+    async def submit_async(self, session, uuidP, answer_index):
+        """
+        Como ``submit``, pero espera al lote en el bucle de eventos y lo
+        escribe en el grupo de hilos de ``services.executor``.
+
+        :param session: Sesion de la partida (``services.engine``)
+        :param uuidP: uuid del participante
+        :param answer_index: Posicion de la respuesta elegida
+
+        :return: Instancia de ``Guess`` (sin id si aun no se ha escrito)
+        :raises GuessRejected: si la respuesta no se acepta
+        """
+        try:
+            guess = await self._submit_async(session, uuidP, answer_index)
+        except GuessRejected as rejected:
+            metrics.inc('guesses_rejected_total', reason=rejected.reason)
+            raise
+        metrics.inc('guesses_total')
+        return guess
+
+    async def _submit_async(self, session, uuidP, answer_index):
+        while True:
+            try:
+                guess, batch, leader, full = self._accept(session, uuidP,
+                                                          answer_index)
+                break
+            except CountsMissing as missing:
+                # la primera respuesta de la pregunta carga sus contadores
+                await executor.run(session.answer_counts,
+                                   missing.question_id)
+        durability = self.option('DURABILITY')
+        if full or durability == IMMEDIATE:
+            await executor.run(self._write, batch)
+        elif leader:
+            if durability == ASYNC:
+                self._write_later(batch)
+            else:
+                await batch.wait_async(self.option('MAX_DELAY'))
+                if self._take(batch):
+                    await executor.run(self._write, batch)
+        if durability != ASYNC:
+            await batch.wait_async()
+            self._check(batch, guess)
+        return guess
+
+    def _accept(self, session, uuidP, answer_index):
+        """
+        Valida la respuesta contra la sesion, la anota y la encola.
+
+        :return: Tupla (guess, lote, si es el primero del lote, si el lote
+            esta lleno)
+        :raises CountsMissing: si aun no se han cargado los contadores de
+            la pregunta; no se cargan aqui para no consultar la base de
+            datos con el cerrojo de la sesion
+        """
+        with session.lock:
+            if session.state != QUESTION:
+                raise GuessRejected(GUESS_ERROR, 'state')
+            if session.is_late():
+                raise GuessRejected(GUESS_LATE_ERROR, 'late')
+            participant_id = session.uuids.get(uuidP)
+            if participant_id is None:
+                raise GuessRejected(GUESS_PARTICIPANT_ERROR, 'participant')
+            question_id = session.question_id
+            answers = session.answers(question_id)
+            if answer_index >= len(answers):
+                raise GuessRejected(GUESS_ANSWER_ERROR, 'answer')
+            answered = session.answered(question_id)
+            if participant_id in answered:
+                raise GuessRejected(GUESS_REPEATED_ERROR, 'repeated')
+            if not session.has_counts(question_id):
+                raise CountsMissing(question_id)
+
+            answer = answers[answer_index]
+            points = session.question_value if answer.correct else 0
+            session.record_guess(question_id, participant_id, answer.id)
+            session.add_points(participant_id, points)
+            guess = Guess(participant_id=participant_id,
+                          game_id=session.game.pk,
+                          question_id=question_id, answer_id=answer.id)
+            # se encola con la sesion bloqueada para que un cambio de estado
+            # (que vacia los lotes) no deje esta respuesta fuera
+            return (guess,) + self._enqueue(session, guess, points)
+
+    def _check(self, batch, guess):
+        """Propaga el fallo del lote o el rechazo de la respuesta"""
+        if batch.error is not None:
+            raise batch.error
+        if guess.participant_id in batch.rejected:
+            raise GuessRejected(GUESS_REPEATED_ERROR, 'repeated')
+
+    def flush(self, publicId):
+        """Escribe ya el lote pendiente de la partida, si lo hay"""
+        with self._lock:
+            batch = self._batches.get(publicId)
+        if batch is not None and self._take(batch):
+            self._write(batch)
+
+    def pending(self, publicId):
+        """Numero de respuestas de la partida pendientes de escribir"""
+        with self._lock:
+            batch = self._batches.get(publicId)
+            return len(batch.guesses) if batch is not None else 0
+
+    def _enqueue(self, session, guess, points):
+        publicId = session.publicId
+        if self.option('DURABILITY') == IMMEDIATE:
+            batch = Batch(session)
+            batch.add(guess, points)
+            batch.taken = True
+            return batch, True, False
+        with self._lock:
+            batch = self._batches.get(publicId)
+            leader = batch is None
+            if leader:
+                batch = self._batches[publicId] = Batch(session)
+            batch.add(guess, points)
+            full = len(batch.guesses) >= self.option('MAX_BATCH')
+            if full:
+                batch.taken = True
+                del self._batches[publicId]
+        return batch, leader, full
+
+    def _take(self, batch):
+        """Reserva el lote para escribirlo; False si otro hilo lo tiene"""
+        with self._lock:
+            if batch.taken:
+                return False
+            batch.taken = True
+            if self._batches.get(batch.publicId) is batch:
+                del self._batches[batch.publicId]
+            return True
+
+    def _write(self, batch):
+        written = []
+        try:
+            with transaction.atomic():
+                written = insert_guesses(batch.guesses)
+                Participant.objects.add_points({
+                    guess.participant_id: batch.points[guess.participant_id]
+                    for guess in written})
+        except Exception as error:
+            batch.error = error
+            logger.exception('could not write %d guesses of game %s',
+                             len(batch.guesses), batch.publicId)
+        else:
+            if len(written) < len(batch.guesses):
+                inserted = {guess.participant_id for guess in written}
+                for guess in batch.guesses:
+                    if guess.participant_id not in inserted:
+                        batch.rejected.add(guess.participant_id)
+                        batch.session.reject_guess(
+                            guess.question_id, guess.answer_id,
+                            guess.participant_id,
+                            batch.points[guess.participant_id])
+        finally:
+            batch.finish()
+        # un participante responde una sola vez por lote
+        for guess in written:
+            events.publish_guess(guess, batch.publicId,
+                                 batch.points[guess.participant_id])
+
+    def _write_later(self, batch):
+        """Escribe el lote en otro hilo al cabo de ``MAX_DELAY``"""
+        timer = threading.Timer(self.option('MAX_DELAY'),
+                                self._write_in_background, [batch])
+        timer.daemon = True
+        timer.start()
+
+    def _write_in_background(self, batch):
+        if self._take(batch):
+            try:
+                self._write(batch)
+            finally:
+                connection.close()
+
+
+def insert_guesses(guesses):
+    """
+    Inserta respuestas descartando las repetidas, con un unico INSERT.
+
+    :param guesses: Instancias de ``Guess`` sin guardar, de participantes
+        distintos
+
+    :return: Las respuestas insertadas, ya con su id
+    """
+    if not guesses:
+        return []
+    quote = connection.ops.quote_name
+    fields = [Guess._meta.get_field(name)
+              for name in ('participant', 'game', 'question', 'answer')]
+    columns = ', '.join(quote(field.column) for field in fields)
+    row = '(%s)' % ', '.join(['%s'] * len(fields))
+    sql = ('INSERT INTO %s (%s) VALUES %s ON CONFLICT (%s, %s) DO NOTHING '
+           'RETURNING %s, %s' % (
+               quote(Guess._meta.db_table), columns,
+               ', '.join([row] * len(guesses)), quote(fields[0].column),
+               quote(fields[2].column), quote(Guess._meta.pk.column),
+               quote(fields[0].column)))
+    params = [getattr(guess, field.attname)
+              for guess in guesses for field in fields]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        ids = dict((participant_id, pk)
+                   for pk, participant_id in cursor.fetchall())
+    written = []
+    for guess in guesses:
+        pk = ids.get(guess.participant_id)
+        if pk is not None:
+            guess.pk = pk
+            guess._state.adding = False
+            guess._state.db = connection.alias
+            written.append(guess)
+    return written
+
+
+ingestor = GuessIngestor()
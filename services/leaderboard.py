@@ -0,0 +1,115 @@
+"""
+Clasificacion incremental de una partida.
+
+Mantiene a los participantes ordenados por puntos a medida que cambian, de
+modo que el podio (``top``) y la posicion de un participante (``rank``) se
+obtienen sin cargar ni ordenar a todos los participantes.
+
+Las claves (-puntos, id) se guardan en una lista ordenada: las busquedas
+son binarias (O(log n)) y el podio es un corte de la lista. Insertar o
+mover a un participante desplaza la lista con un ``memmove``, que con los
+tamaños de una partida (miles de jugadores) es despreciable frente a una
+consulta a la base de datos.
+"""
+import threading
+from bisect import bisect_left, insort
+from collections import namedtuple
+
+Entry = namedtuple('Entry', ['rank', 'id', 'alias', 'points'])
+
+
+class Leaderboard:
+    """
+    Clasificacion ordenada por puntos.
+
+    Los empates comparten posicion (dos participantes con los mismos puntos
+    tienen el mismo ``rank``) y se listan por orden de llegada.
+
+    :param participants: Iterable de tuplas (id, alias, points)
+    """
+
+    def __init__(self, participants=()):
+        self.lock = threading.Lock()
+        self.scores = {}
+        self.aliases = {}
+        keys = []
+        for participant_id, alias, points in participants:
+            self.scores[participant_id] = points
+            self.aliases[participant_id] = alias
+            keys.append((-points, participant_id))
+        keys.sort()
+        self._keys = keys
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __contains__(self, participant_id):
+        return participant_id in self.scores
+
+    def add(self, participant_id, alias, points=0):
+        """Añade un participante; no hace nada si ya estaba"""
+        with self.lock:
+            if participant_id in self.scores:
+                return
+            self.scores[participant_id] = points
+            self.aliases[participant_id] = alias
+            insort(self._keys, (-points, participant_id))
+
+    def add_points(self, participant_id, points):
+        """
+        Suma puntos a un participante y lo recoloca en la clasificacion.
+
+        :param participant_id: Id del participante
+        :param points: Puntos a sumar
+        """
+        if not points:
+            return
+        with self.lock:
+            old = self.scores.get(participant_id)
+            if old is None:
+                self.scores[participant_id] = points
+                self.aliases.setdefault(participant_id, '')
+            else:
+                keys = self._keys
+                del keys[bisect_left(keys, (-old, participant_id))]
+                self.scores[participant_id] = old + points
+            insort(self._keys, (-self.scores[participant_id],
+                                participant_id))
+
+    def rank(self, participant_id):
+        """
+        Posicion de un participante (1 es el primero) o None si no existe.
+        """
+        entry = self.entry(participant_id)
+        return entry.rank if entry is not None else None
+
+    def entry(self, participant_id):
+        """Entrada de la clasificacion de un participante o None"""
+        with self.lock:
+            points = self.scores.get(participant_id)
+            if points is None:
+                return None
+            rank = bisect_left(self._keys, (-points,)) + 1
+            return Entry(rank, participant_id,
+                         self.aliases[participant_id], points)
+
+    def top(self, n=10):
+        """
+        Los ``n`` primeros participantes.
+
+        :param n: Numero de participantes
+
+        :return: Lista de ``Entry`` ordenada por puntos
+        """
+        with self.lock:
+            keys = self._keys[:n]
+            entries = []
+            rank = 0
+            previous = None
+            for position, (negative, participant_id) in enumerate(keys, 1):
+                if negative != previous:
+                    rank, previous = position, negative
+                entries.append(Entry(rank, participant_id,
+                                     self.aliases[participant_id],
+                                     -negative))
+            return entries
@@ -0,0 +1,403 @@
+# Microbenchmarks of the game hot paths
+#
+# execute python manage.py benchmark <target>
+#
+# Every target builds its own fixture inside a transaction that is rolled
+# back at the end, so it can be run against any database without leaving
+# data behind. Targets that hit the database from several threads need
+# committed data; they delete their fixture when they finish.
+import heapq
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from rest_framework.views import APIView
+
+from models.constants import WAITING, QUESTION, ANSWER, LEADERBOARD
+from models.models import (Answer, Game, Guess, Participant, Question,
+                           Questionnaire, User)
+from models.pins import PublicIdAllocator
+from restServer.views import GameTokenMixin
+from services.engine import sessions
+from services.events import EventBus
+from services.ingestion import GuessIngestor
+from services.timers import TimerWheel
+
+
+class Command(BaseCommand):
+    help = """benchmark the game hot paths
+           """
+
+    def add_arguments(self, parser):
+        targets = parser.add_subparsers(dest='target', required=True)
+
+        engine = targets.add_parser(
+            'engine', help='transitions/sec of GameSession vs the '
+                           'database-backed CountDown path')
+        engine.add_argument('--questions', type=int, default=50)
+        engine.add_argument('--games', type=int, default=20)
+
+        ingestion = targets.add_parser(
+            'ingestion', help='guess latency percentiles, one INSERT per '
+                              'guess vs batched ingestion')
+        ingestion.add_argument('--participants', type=int, nargs='+',
+                               default=[30, 300, 3000])
+        ingestion.add_argument('--threads', type=int, default=64)
+        ingestion.add_argument('--durability', default='batch')
+
+        pins = targets.add_parser(
+            'pins', help='PIN allocations/sec, random retry loop vs the '
+                         'free PIN pool, with the PIN space partly full')
+        pins.add_argument('--space', type=int, default=100000)
+        pins.add_argument('--occupancy', type=float, default=0.9)
+        pins.add_argument('--games', type=int, default=2000)
+
+        timer_parser = targets.add_parser(
+            'timers', help='schedule/cancel cost and per-tick overhead of '
+                           'the timer wheel vs a heap of deadlines')
+        timer_parser.add_argument('--timers', type=int, default=10000)
+        timer_parser.add_argument('--ticks', type=int, default=10000)
+
+        events = targets.add_parser(
+            'events', help='fan-out latency of the game event bus, one '
+                           'publisher and many subscribers')
+        events.add_argument('--subscribers', type=int, default=5000)
+        events.add_argument('--events', type=int, default=100)
+        events.add_argument('--workers', type=int, default=4)
+        events.add_argument('--backends', nargs='+',
+                            default=['local', 'unix'])
+
+        token_parser = targets.add_parser(
+            'tokens', help='queries per join/guess/poll request, Django '
+                           'session vs signed participant token')
+        token_parser.add_argument('--requests', type=int, default=200)
+
+    # targets that need committed data (their workers use other connections)
+    COMMITTED = ('ingestion',)
+
+    def handle(self, *args, **options):
+        target = options['target']
+        bench = getattr(self, 'bench_' + target)
+        if target in self.COMMITTED:
+            User.objects.filter(username='benchmark').delete()
+            try:
+                bench(**options)
+            finally:
+                User.objects.filter(username='benchmark').delete()
+        else:
+            with transaction.atomic():
+                bench(**options)
+                transaction.set_rollback(True)
+        sessions.clear()
+
+    def report(self, name, count, elapsed, unit):
+        self.stdout.write('%-28s %10d %s in %7.3f s  %12.1f %s/s' % (
+            name, count, unit, elapsed, count / elapsed, unit))
+
+    def report_latency(self, name, latencies):
+        latencies = sorted(latencies)
+        percentile = statistics.quantiles(latencies, n=100)
+        self.stdout.write('%-28s %10d calls  p50 %8.2f ms  p99 %8.2f ms' % (
+            name, len(latencies), percentile[49] * 1000,
+            percentile[98] * 1000))
+
+    def run_threads(self, function, items, threads):
+        "call function(item) from a thread pool, return the latencies"
+        def timed(item):
+            try:
+                start = time.perf_counter()
+                function(item)
+                return time.perf_counter() - start
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            return list(executor.map(timed, items))
+
+    def fixture(self, questions):
+        "questionnaire with the given number of questions"
+        user = User.objects.create_user(username='benchmark')
+        questionnaire = Questionnaire.objects.create(title='benchmark',
+                                                     user=user)
+        for n in range(questions):
+            question = Question.objects.create(
+                question='question %d' % n, questionnaire=questionnaire)
+            Answer.objects.bulk_create([
+                Answer(answer='answer %d' % i, question=question,
+                       correct=(i == 0)) for i in range(4)])
+        return questionnaire
+
+    # ---- engine ----
+    def bench_engine(self, questions, games, **kwargs):
+        questionnaire = self.fixture(questions)
+
+        # database path: what CountDown did before the in-memory engine,
+        # reload the game and walk question_set on every host click
+        publicIds = [Game.objects.create(questionnaire=questionnaire).publicId
+                     for _ in range(games)]
+        count = 0
+        start = time.perf_counter()
+        for publicId in publicIds:
+            while self.legacy_transition(publicId):
+                count += 1
+        self.report('CountDown (database)', count, time.perf_counter() - start,
+                    'transitions')
+
+        publicIds = [Game.objects.create(questionnaire=questionnaire).publicId
+                     for _ in range(games)]
+        count = 0
+        start = time.perf_counter()
+        for publicId in publicIds:
+            session = sessions.get(publicId)
+            while session.state != LEADERBOARD:
+                session.advance()
+                count += 1
+        self.report('GameSession (memory)', count,
+                    time.perf_counter() - start, 'transitions')
+
+    def legacy_transition(self, publicId):
+        game = Game.objects.get(publicId=publicId)
+        # context: current question, as get_context_data did
+        game.questionnaire.question_set.all()[game.questionNo]
+        if game.state == WAITING:
+            game.state = QUESTION
+        elif game.state == QUESTION:
+            game.state = ANSWER
+        elif game.state == ANSWER:
+            if game.questionNo == game.questionnaire.question_set.count()-1:
+                game.state = LEADERBOARD
+            else:
+                game.questionNo += 1
+                game.state = QUESTION
+        else:
+            return False
+        game.save()
+        return True
+
+    # ---- ingestion ----
+    def bench_ingestion(self, participants, threads, durability, **kwargs):
+        questionnaire = self.fixture(1)
+        question = questionnaire.question_set.get()
+        answers = list(question.answer_set.order_by('id'))
+        ingestor = GuessIngestor(durability=durability)
+
+        for size in participants:
+            # one INSERT + Participant UPDATE per guess
+            game = self.game_with_participants(questionnaire, size)
+            players = list(game.participant_set.all())
+            latencies = self.run_threads(
+                lambda participant: Guess(
+                    participant=participant, game=game, question=question,
+                    answer=answers[participant.id % 4]).save(),
+                players, threads)
+            self.report_latency('Guess.save (%d players)' % size, latencies)
+
+            game = self.game_with_participants(questionnaire, size)
+            session = sessions.get(game.publicId)
+            uuids = [uuidP for uuidP in session.uuids]
+            latencies = self.run_threads(
+                lambda uuidP: ingestor.submit(session, uuidP, 0),
+                uuids, threads)
+            ingestor.flush(game.publicId)
+            self.report_latency('%s ingestion (%d players)' % (
+                durability, size), latencies)
+
+    def game_with_participants(self, questionnaire, size):
+        game = Game.objects.create(questionnaire=questionnaire,
+                                   state=QUESTION)
+        Participant.objects.bulk_create([
+            Participant(game=game, alias='player %d' % n)
+            for n in range(size)])
+        return game
+
+    # ---- pins ----
+    def bench_pins(self, space, occupancy, games, **kwargs):
+        questionnaire = self.fixture(0)
+        # occupy the PIN space without going through Game.save
+        taken = random.sample(range(1, space + 1), int(space * occupancy))
+        for start in range(0, len(taken), 10000):
+            Game.objects.bulk_create([
+                Game(questionnaire=questionnaire, publicId=pin)
+                for pin in taken[start:start + 10000]])
+        self.stdout.write('%d of %d PINs in use' % (len(taken), space))
+
+        # what Game.save did: draw random PINs until one is free
+        start = time.perf_counter()
+        for _ in range(games):
+            while True:
+                pin = random.randint(1, space)
+                if not Game.objects.filter(publicId=pin).exists():
+                    break
+            Game.objects.bulk_create([Game(questionnaire=questionnaire,
+                                           publicId=pin)])
+        self.report('random retry loop', games, time.perf_counter() - start,
+                    'allocations')
+
+        allocator = PublicIdAllocator(max_id=space)
+        start = time.perf_counter()
+        for _ in range(games):
+            with transaction.atomic():
+                pin = allocator.allocate()
+                Game.objects.bulk_create([Game(questionnaire=questionnaire,
+                                               publicId=pin)])
+        self.report('free PIN pool', games, time.perf_counter() - start,
+                    'allocations')
+
+    # ---- timers ----
+    def bench_timers(self, timers, ticks, **kwargs):
+        # deadlines spread over the next ``ticks`` ticks, like the phases
+        # of many games started at different times
+        deadlines = [random.randint(1, ticks) for _ in range(timers)]
+
+        heap = []
+        start = time.perf_counter()
+        for n, deadline in enumerate(deadlines):
+            heapq.heappush(heap, (deadline, n))
+        self.report('heap schedule', timers, time.perf_counter() - start,
+                    'timers')
+        start = time.perf_counter()
+        for tick in range(1, ticks + 1):
+            while heap and heap[0][0] <= tick:
+                heapq.heappop(heap)
+        self.report('heap ticks', ticks, time.perf_counter() - start,
+                    'ticks')
+
+        wheel = TimerWheel()
+        start = time.perf_counter()
+        scheduled = [wheel.schedule(deadline, None)
+                     for deadline in deadlines]
+        self.report('wheel schedule', timers, time.perf_counter() - start,
+                    'timers')
+        start = time.perf_counter()
+        for timer in scheduled[::2]:
+            timer.cancel()
+        self.report('wheel cancel', len(scheduled[::2]),
+                    time.perf_counter() - start, 'timers')
+        start = time.perf_counter()
+        expired = 0
+        for tick in range(1, ticks + 1):
+            expired += len(wheel.advance(tick))
+        self.report('wheel ticks', ticks, time.perf_counter() - start,
+                    'ticks')
+        self.stdout.write('%d timers expired, %d cancelled' % (
+            expired, len(scheduled[::2])))
+
+    # ---- events ----
+    def bench_events(self, subscribers, events, workers, backends, **kwargs):
+        path = os.path.join(tempfile.mkdtemp(), 'events.sock')
+        for backend in backends:
+            # the publisher has its own bus; with the unix backend the
+            # subscribers are spread over ``workers`` buses, each with its
+            # own connection to the hub like separate gunicorn workers
+            publisher = EventBus(backend=backend, path=path)
+            if backend == 'local':
+                buses = [publisher]
+            else:
+                buses = [EventBus(backend=backend, path=path)
+                         for _ in range(workers)]
+            latencies = []
+            fanout = []
+            lock = threading.Lock()
+            state = {'pending': 0, 'done': threading.Event()}
+
+            def callback(event):
+                latency = time.perf_counter() - event['sent']
+                with lock:
+                    latencies.append(latency)
+                    state['pending'] -= 1
+                    if state['pending'] == 0:
+                        fanout.append(latency)
+                        state['done'].set()
+
+            for n in range(subscribers):
+                buses[n % len(buses)].subscribe(1, callback)
+            for _ in range(events):
+                state['pending'] = subscribers
+                state['done'].clear()
+                publisher.publish(1, {'type': 'state',
+                                      'sent': time.perf_counter()})
+                state['done'].wait(10)
+            self.report_latency('%s per subscriber' % backend, latencies)
+            self.report_latency('%s full fan-out (%d)' % (
+                backend, subscribers), fanout)
+            for bus in set(buses + [publisher]):
+                bus.close()
+
+    # ---- tokens ----
+    def bench_tokens(self, requests, **kwargs):
+        questionnaire = self.fixture(1)
+        # a browser with a Django session cookie, as the host's own device
+        client = Client(HTTP_HOST='localhost')
+        client.force_login(questionnaire.user)
+
+        authenticators = GameTokenMixin.get_authenticators
+        for name in ('session', 'token'):
+            game = Game.objects.create(questionnaire=questionnaire,
+                                       state=QUESTION)
+            sessions.get(game.publicId)
+            legacy = name == 'session'
+            if legacy:
+                # what the API did before: every action authenticated
+                # with the Django session
+                GameTokenMixin.get_authenticators = \
+                    APIView.get_authenticators
+            try:
+                self.token_requests(client, game, requests, name, legacy)
+            finally:
+                GameTokenMixin.get_authenticators = authenticators
+
+    def token_requests(self, client, game, requests, name, legacy):
+        "join, guess and poll ``requests`` times; report queries/request"
+        def measure(action, call):
+            total = session = 0
+            start = time.perf_counter()
+            for n in range(requests):
+                with CaptureQueriesContext(connection) as queries:
+                    call(n)
+                total += len(queries)
+                session += sum('django_session' in query['sql']
+                               for query in queries.captured_queries)
+            elapsed = time.perf_counter() - start
+            self.stdout.write(
+                '%-8s %-6s %6.2f queries/request  %6.2f django_session  '
+                '%7.3f ms/request' % (name, action, total / requests,
+                                      session / requests,
+                                      elapsed / requests * 1000))
+
+        joined = []
+
+        def join(n):
+            response = client.post('/api/participants/', {
+                'game': game.publicId, 'alias': 'player %d' % n})
+            joined.append(response.json())
+
+        def guess(n):
+            participant = joined[n]
+            if legacy:
+                client.post('/api/guesses/', {
+                    'game': game.publicId, 'uuidp': participant['uuidP'],
+                    'answer': 0})
+            else:
+                client.post('/api/guesses/', {'answer': 0},
+                            HTTP_AUTHORIZATION='Bearer ' +
+                            participant['token'])
+
+        def poll(n):
+            if legacy:
+                client.get('/api/games/%d/' % game.publicId)
+            else:
+                client.get('/api/games/%d/' % game.publicId,
+                           HTTP_AUTHORIZATION='Bearer ' +
+                           joined[n]['token'])
+
+        measure('join', join)
+        measure('guess', guess)
+        measure('poll', poll)
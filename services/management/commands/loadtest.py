@@ -0,0 +1,371 @@
+# Load test of a full game
+#
+# execute python manage.py loadtest [--participants N] [--output FILE]
+#
+# N simulated participants join a game, poll its state and answer every
+# question concurrently (asyncio, keep-alive HTTP/1.1 connections) while a
+# simulated host drives the game through the countdown view. By default
+# the requests go to a threaded WSGI server started inside this command;
+# --url points the test at a running server (gunicorn, uvicorn...) that
+# uses the same database.
+#
+# --api play uses the async participant endpoints under /api/play/
+# (restServer.play) instead of the DRF ones, to compare an ASGI deployment
+# (start.sh asgi) with the sync gunicorn one (start.sh wsgi).
+#
+# Throughput and p50/p95/p99 latency per endpoint are printed and written
+# as JSON to --output, so the capacity of each release can be tracked.
+# The questionnaire, game and participants are created under the user
+# 'loadtest' and deleted at the end.
+import asyncio
+import json
+import random
+import statistics
+import threading
+import time
+from collections import Counter, defaultdict
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.contrib.auth import (BACKEND_SESSION_KEY, HASH_SESSION_KEY,
+                                 SESSION_KEY)
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import (ThreadedWSGIServer,
+                                          WSGIRequestHandler)
+from django.core.wsgi import get_wsgi_application
+
+from models.constants import QUESTION, LEADERBOARD
+from models.models import (Answer, Game, Question, Questionnaire, User)
+from services import tokens
+
+USERNAME = 'loadtest'
+ANSWERS = 4
+
+# paths of the participant requests in each API
+APIS = {
+    'rest': {
+        'join': '/api/participants/',
+        'guess': '/api/guesses/',
+        'poll': '/api/games/%d/',
+        'leaderboard': '/api/games/%d/leaderboard/',
+    },
+    'play': {
+        'join': '/api/play/join/',
+        'guess': '/api/play/guess/',
+        'poll': '/api/play/%d/state/',
+        'leaderboard': '/api/play/%d/leaderboard/',
+    },
+}
+
+
+class QuietHandler(WSGIRequestHandler):
+    "request handler that does not log every request"
+
+    def log_message(self, *args):
+        pass
+
+
+class Connection:
+    "minimal keep-alive HTTP/1.1 client connection"
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = self.writer = None
+
+    async def request(self, method, path, body=None, headers=None):
+        "send a request, return (status, body); reconnect once if closed"
+        for attempt in range(2):
+            if self.writer is None:
+                self.reader, self.writer = await asyncio.open_connection(
+                    self.host, self.port)
+            try:
+                return await self._request(method, path, body, headers or {})
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.close()
+                if attempt:
+                    raise
+
+    async def _request(self, method, path, body, headers):
+        lines = ['%s %s HTTP/1.1' % (method, path),
+                 'Host: %s:%d' % (self.host, self.port),
+                 'Connection: keep-alive']
+        if body is not None:
+            body = json.dumps(body).encode()
+            lines += ['Content-Type: application/json',
+                      'Content-Length: %d' % len(body)]
+        lines += ['%s: %s' % item for item in headers.items()]
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() +
+                          (body or b''))
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError('connection closed by the server')
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while True:
+            line = (await self.reader.readline()).decode().strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            response_headers[name.lower()] = value.strip()
+        if 'content-length' in response_headers:
+            content = await self.reader.readexactly(
+                int(response_headers['content-length']))
+        elif response_headers.get('transfer-encoding') == 'chunked':
+            content = b''
+            while True:
+                size = int((await self.reader.readline()).strip(), 16)
+                chunk = await self.reader.readexactly(size + 2)
+                if not size:
+                    break
+                content += chunk[:-2]
+        else:
+            content = await self.reader.read()
+            response_headers['connection'] = 'close'
+        if response_headers.get('connection', '').lower() == 'close':
+            self.close()
+        return status, content
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+class Command(BaseCommand):
+    help = """drive a full game with simulated participants and report
+           latency percentiles per endpoint
+           """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--participants', type=int, default=100)
+        parser.add_argument('--questions', type=int, default=5)
+        parser.add_argument('--connections', type=int, default=50,
+                            help='keep-alive connections shared by the '
+                                 'participants')
+        parser.add_argument('--poll-interval', type=float, default=0.2)
+        parser.add_argument('--timeout', type=float, default=60,
+                            help='seconds the host waits for the answers '
+                                 'to a question')
+        parser.add_argument('--url', help='server to test; by default a '
+                                          'local test server is started')
+        parser.add_argument('--api', choices=sorted(APIS), default='rest',
+                            help='participant endpoints: DRF (rest) or '
+                                 'async (play)')
+        parser.add_argument('--output', default='loadtest.json')
+
+    def handle(self, *args, **options):
+        self.participants = options['participants']
+        self.questions = options['questions']
+        self.poll_interval = options['poll_interval']
+        self.timeout = options['timeout']
+        self.paths = APIS[options['api']]
+
+        server = None
+        if options['url']:
+            url = urlsplit(options['url'])
+            host, port = url.hostname, url.port or 80
+        else:
+            server = ThreadedWSGIServer(('127.0.0.1', 0), QuietHandler,
+                                        allow_reuse_address=True)
+            server.set_app(get_wsgi_application())
+            threading.Thread(target=server.serve_forever,
+                             daemon=True).start()
+            host, port = server.server_address[:2]
+
+        User.objects.filter(username=USERNAME).delete()
+        self.session = None
+        try:
+            game, cookies = self.fixture()
+            self.publicId = game.publicId
+            self.host_headers = {'Cookie': cookies}
+            start = time.perf_counter()
+            asyncio.run(self.run(host, port, options['connections']))
+            elapsed = time.perf_counter() - start
+        finally:
+            User.objects.filter(username=USERNAME).delete()
+            if self.session is not None:
+                self.session.delete()
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+
+        report = self.report(elapsed, options)
+        with open(options['output'], 'w') as output:
+            json.dump(report, output, indent=2)
+        self.stdout.write('results written to %s' % options['output'])
+
+    def fixture(self):
+        "game, and the cookies of its host (Django session + host token)"
+        user = User.objects.create_user(username=USERNAME)
+        questionnaire = Questionnaire.objects.create(title=USERNAME,
+                                                     user=user)
+        for n in range(self.questions):
+            # long phases: the host, not the server timers, drives the game
+            question = Question.objects.create(
+                question='question %d' % n, questionnaire=questionnaire,
+                answerTime=3600)
+            Answer.objects.bulk_create([
+                Answer(answer='answer %d' % i, question=question,
+                       correct=(i == 0)) for i in range(ANSWERS)])
+        game = Game.objects.create(questionnaire=questionnaire,
+                                   countdownTime=3600)
+
+        session = SessionStore()
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session['gameID'] = game.publicId
+        session.create()
+        self.session = session
+        cookies = '%s=%s; %s=%s' % (
+            settings.SESSION_COOKIE_NAME, session.session_key,
+            tokens.HOST_TOKEN_COOKIE,
+            tokens.issue(game.publicId, tokens.HOST))
+        return game, cookies
+
+    async def run(self, host, port, connections):
+        self.pool = asyncio.Queue()
+        for _ in range(connections):
+            self.pool.put_nowait(Connection(host, port))
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        # participants done with each question (or with the join)
+        self.done = Counter()
+        self.events = defaultdict(asyncio.Event)
+
+        tasks = [asyncio.ensure_future(self.participant(n))
+                 for n in range(self.participants)]
+        await self.host(Connection(host, port))
+        await asyncio.gather(*tasks)
+        while not self.pool.empty():
+            self.pool.get_nowait().close()
+
+    async def call(self, endpoint, method, path, body=None, headers=None,
+                   connection=None):
+        "timed request; returns the decoded JSON body or None on error"
+        pooled = connection is None
+        if pooled:
+            connection = await self.pool.get()
+        try:
+            start = time.perf_counter()
+            try:
+                status, content = await connection.request(
+                    method, path, body, headers)
+            except (OSError, asyncio.IncompleteReadError):
+                status, content = 0, b''
+            self.latencies[endpoint].append(time.perf_counter() - start)
+        finally:
+            if pooled:
+                self.pool.put_nowait(connection)
+        if not 200 <= status < 300:
+            self.errors[endpoint] += 1
+            return None
+        try:
+            return json.loads(content) if content else {}
+        except ValueError:
+            return {}
+
+    def finished(self, key):
+        self.done[key] += 1
+        if self.done[key] == self.participants:
+            self.events[key].set()
+
+    async def participant(self, n):
+        joined = await self.call('join', 'POST', self.paths['join'], {
+            'game': self.publicId, 'alias': '%s %d' % (USERNAME, n)})
+        self.finished('join')
+        if joined is None:
+            for questionNo in range(self.questions):
+                self.finished(questionNo)
+            return
+        headers = {'Authorization': 'Bearer ' + joined['token']}
+        game_path = self.paths['poll'] % self.publicId
+
+        for questionNo in range(self.questions):
+            while True:
+                game = await self.call('poll', 'GET', game_path,
+                                       headers=headers)
+                if game is not None and (
+                        game.get('state') == LEADERBOARD or (
+                            game.get('state') == QUESTION and
+                            game.get('questionNo') == questionNo)):
+                    break
+                await asyncio.sleep(self.poll_interval)
+            if game['state'] == QUESTION:
+                await self.call('guess', 'POST', self.paths['guess'],
+                                {'answer': random.randrange(ANSWERS)},
+                                headers=headers)
+            self.finished(questionNo)
+
+        while True:
+            game = await self.call('poll', 'GET', game_path,
+                                   headers=headers)
+            if game is not None and game.get('state') == LEADERBOARD:
+                break
+            await asyncio.sleep(self.poll_interval)
+        await self.call('leaderboard', 'GET',
+                        self.paths['leaderboard'] % self.publicId,
+                        headers=headers)
+
+    async def host(self, connection):
+        "start every question once everybody has answered the previous one"
+        async def advance():
+            await self.call('host', 'GET', '/services/gamecountdown',
+                            headers=self.host_headers,
+                            connection=connection)
+
+        await self.wait('join')
+        await advance()                     # WAITING -> QUESTION
+        for questionNo in range(self.questions):
+            await self.wait(questionNo)
+            await advance()                 # QUESTION -> ANSWER
+            await advance()                 # ANSWER -> QUESTION/LEADERBOARD
+        connection.close()
+
+    async def wait(self, key):
+        try:
+            await asyncio.wait_for(self.events[key].wait(), self.timeout)
+        except asyncio.TimeoutError:
+            self.stderr.write('timeout waiting for %s: %d of %d '
+                              'participants' % (key, self.done[key],
+                                                self.participants))
+
+    def report(self, elapsed, options):
+        endpoints = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            if len(latencies) > 1:
+                percentile = statistics.quantiles(latencies, n=100)
+            else:
+                percentile = latencies * 99
+            endpoints[endpoint] = {
+                'requests': len(latencies),
+                'errors': self.errors[endpoint],
+                'throughput': len(latencies) / elapsed,
+                'p50': percentile[49] * 1000,
+                'p95': percentile[94] * 1000,
+                'p99': percentile[98] * 1000,
+                'max': latencies[-1] * 1000,
+            }
+            self.stdout.write(
+                '%-12s %7d requests %5d errors %9.1f req/s  p50 %8.2f ms  '
+                'p95 %8.2f ms  p99 %8.2f ms' % (
+                    endpoint, len(latencies), self.errors[endpoint],
+                    len(latencies) / elapsed, percentile[49] * 1000,
+                    percentile[94] * 1000, percentile[98] * 1000))
+        if not endpoints:
+            raise CommandError('no requests were made')
+        return {
+            'participants': self.participants,
+            'questions': self.questions,
+            'connections': options['connections'],
+            'url': options['url'] or 'local',
+            'api': options['api'],
+            'elapsed': elapsed,
+            'unit': 'ms',
+            'endpoints': endpoints,
+        }
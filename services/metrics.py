@@ -0,0 +1,308 @@
+"""
+Metricas de las peticiones y del juego en formato Prometheus.
+
+``MetricsMiddleware`` mide cada peticion y la agrega en memoria por nombre
+de URL (``view_name`` de la ruta, no la ruta concreta, para acotar las
+series):
+
+- ``kahootclone_http_requests_total``: peticiones por vista, metodo y
+  codigo de respuesta.
+- ``kahootclone_http_request_duration_seconds``: histograma de latencia.
+- ``kahootclone_http_request_queries``: histograma de consultas SQL.
+- ``kahootclone_http_request_sql_seconds_total``: tiempo en SQL.
+- ``kahootclone_http_response_bytes``: histograma del tamaño de respuesta.
+
+Ademas se cuentan las uniones (``kahootclone_joins_total``) y las
+respuestas aceptadas y rechazadas (``kahootclone_guesses_total``,
+``kahootclone_guesses_rejected_total``); las uniones y respuestas por
+segundo son su ``rate()`` en Prometheus. Las partidas por estado y las
+sesiones en memoria se calculan al servir las metricas
+(``services.views.Metrics``).
+
+Cada proceso agrega sus propias peticiones: con varios workers cada uno
+expone las suyas. La vista ``Metrics`` solo las sirve a administradores (o
+con el token de ``settings.GAME_METRICS['TOKEN']``, para el servidor de
+Prometheus).
+
+La configuracion esta en ``settings.GAME_METRICS``:
+
+- ``ENABLED``: si el middleware mide las peticiones.
+- ``TOKEN``: token ``Bearer`` que permite leer las metricas sin sesion.
+"""
+import asyncio
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextvars import ContextVar
+
+from asgiref.sync import markcoroutinefunction
+from django.conf import settings
+from django.db import connection
+
+DEFAULTS = {
+    'ENABLED': True,
+    'TOKEN': None,
+}
+
+PREFIX = 'kahootclone_'
+
+# limites superiores de los cubos de cada histograma
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def option(name):
+    options = getattr(settings, 'GAME_METRICS', {})
+    return options.get(name, DEFAULTS[name])
+
+
+class Histogram:
+    """
+    Histograma con cubos fijos; ``counts[i]`` son las observaciones del
+    cubo ``i`` (el ultimo es ``+Inf``), sin acumular.
+    """
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Metrics:
+    """
+    Agregacion en memoria de contadores e histogramas con etiquetas.
+
+    Cada observacion toma un unico cerrojo y actualiza un diccionario: el
+    coste por peticion es de microsegundos.
+    """
+    HELP = {
+        'http_requests_total': 'Requests by view, method and status.',
+        'http_request_duration_seconds': 'Request latency by view.',
+        'http_request_queries': 'SQL queries per request by view.',
+        'http_request_sql_seconds_total': 'Time spent in SQL by view.',
+        'http_response_bytes': 'Response size by view.',
+        'joins_total': 'Participants that joined a game.',
+        'guesses_total': 'Guesses accepted.',
+        'guesses_rejected_total': 'Guesses rejected by reason.',
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            # nombre -> etiquetas (tupla de pares) -> valor
+            self.counters = defaultdict(lambda: defaultdict(float))
+            self.histograms = defaultdict(dict)
+
+    def inc(self, name, value=1, **labels):
+        """
+        Incrementa un contador.
+
+        :param name: Nombre de la metrica, sin prefijo
+        :param value: Incremento
+        :param labels: Etiquetas de la serie
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.counters[name][key] += value
+
+    def record_request(self, view, method, status, seconds, queries,
+                       sql_seconds, size):
+        """
+        Registra las medidas de una peticion; las que no se han podido
+        medir (``None``) no se registran.
+        """
+        labels = (('method', method), ('view', view))
+        with self._lock:
+            self.counters['http_requests_total'][
+                labels + (('status', str(status)),)] += 1
+            if sql_seconds is not None:
+                self.counters['http_request_sql_seconds_total'][labels] += \
+                    sql_seconds
+            for name, buckets, value in (
+                    ('http_request_duration_seconds', LATENCY_BUCKETS,
+                     seconds),
+                    ('http_request_queries', QUERY_BUCKETS, queries),
+                    ('http_response_bytes', SIZE_BUCKETS, size)):
+                if value is None:
+                    continue
+                histogram = self.histograms[name].get(labels)
+                if histogram is None:
+                    histogram = self.histograms[name][labels] = \
+                        Histogram(buckets)
+                histogram.observe(value)
+
+    def render(self, gauges=()):
+        """
+        Metricas en el formato de texto de Prometheus.
+
+        :param gauges: Iterable de (nombre, ayuda, [(etiquetas, valor)])
+            calculados al servir las metricas
+
+        :return: Texto (str)
+        """
+        lines = []
+        with self._lock:
+            for name in sorted(self.counters):
+                lines += self._header(name, 'counter',
+                                      self.HELP.get(name, name))
+                for labels, value in sorted(self.counters[name].items()):
+                    lines.append('%s%s%s %s' % (
+                        PREFIX, name, format_labels(labels),
+                        format_value(value)))
+            for name in sorted(self.histograms):
+                lines += self._header(name, 'histogram',
+                                      self.HELP.get(name, name))
+                for labels, histogram in sorted(
+                        self.histograms[name].items()):
+                    lines += self._histogram(name, labels, histogram)
+        for name, help, samples in gauges:
+            lines += self._header(name, 'gauge', help)
+            for labels, value in samples:
+                lines.append('%s%s%s %s' % (
+                    PREFIX, name, format_labels(labels), format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, name, kind, help):
+        return ['# HELP %s%s %s' % (PREFIX, name, help),
+                '# TYPE %s%s %s' % (PREFIX, name, kind)]
+
+    def _histogram(self, name, labels, histogram):
+        lines = []
+        total = 0
+        bounds = [format_value(bound) for bound in histogram.buckets]
+        for bound, count in zip(bounds + ['+Inf'], histogram.counts):
+            total += count
+            lines.append('%s%s_bucket%s %d' % (
+                PREFIX, name, format_labels(labels + (('le', bound),)),
+                total))
+        lines.append('%s%s_sum%s %s' % (PREFIX, name, format_labels(labels),
+                                        format_value(histogram.sum)))
+        lines.append('%s%s_count%s %d' % (PREFIX, name,
+                                          format_labels(labels), total))
+        return lines
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\')
+                     .replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in labels)
+
+
+def format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return '%d' % value
+    return repr(value)
+
+
+metrics = Metrics()
+
+
+class QueryCounter:
+    """Envoltorio de ``execute`` que cuenta las consultas y su tiempo"""
+    __slots__ = ('queries', 'seconds')
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.queries += 1
+
+
+# contador de la peticion en curso; ``sync_to_async`` lo lleva al hilo
+# que ejecuta las vistas sincronas bajo ASGI
+current_counter = ContextVar('current_counter', default=None)
+
+
+def count_query(execute, sql, params, many, context):
+    """
+    Envoltorio de ``execute`` de todas las conexiones: cuenta la consulta
+    en el contador de la peticion en curso, si lo hay.
+    """
+    counter = current_counter.get()
+    if counter is None:
+        return execute(sql, params, many, context)
+    return counter(execute, sql, params, many, context)
+
+
+def install_query_counter(connection):
+    """Añade ``count_query`` a una conexion (una sola vez)"""
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+
+class MetricsMiddleware:
+    """
+    Mide la latencia, las consultas SQL y el tamaño de respuesta de cada
+    peticion y las agrega en ``metrics`` por nombre de URL.
+
+    Bajo ASGI funciona en modo asincrono para no ocupar un hilo mientras
+    espera una vista asincrona (``services.views.game_wait``). En ese modo
+    las consultas se hacen en otro hilo, con su propia conexion: el
+    contador de la peticion se guarda en ``current_counter`` y lo usa
+    ``count_query``, instalado en cada conexion al abrirla
+    (``services.signals``). Asi se cuentan las consultas de las vistas
+    sincronas y de ``sync_to_async``; las del grupo de hilos de
+    ``services.executor`` no.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        if not option('ENABLED'):
+            return self.get_response(request)
+        counter = QueryCounter()
+        start = time.perf_counter()
+        with connection.execute_wrapper(counter):
+            response = self.get_response(request)
+        self.record(request, response, time.perf_counter() - start,
+                    counter.queries, counter.seconds)
+        return response
+
+    async def __acall__(self, request):
+        if not option('ENABLED'):
+            return await self.get_response(request)
+        counter = QueryCounter()
+        token = current_counter.set(counter)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_counter.reset(token)
+        self.record(request, response, time.perf_counter() - start,
+                    counter.queries, counter.seconds)
+        return response
+
+    def record(self, request, response, seconds, queries, sql_seconds):
+        match = request.resolver_match
+        view = match.view_name if match is not None else 'unmatched'
+        size = None if response.streaming else len(response.content)
+        metrics.record_request(view, request.method, response.status_code,
+                               seconds, queries, sql_seconds, size)
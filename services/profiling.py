@@ -0,0 +1,493 @@
+"""
+Perfilado bajo demanda de peticiones.
+
+``ProfilingMiddleware`` ejecuta las peticiones seleccionadas bajo
+``cProfile`` y registra sus consultas SQL con su duracion. Una peticion se
+perfila si:
+
+- trae la cabecera ``X-Profile`` con un valor firmado por ``sign()`` (lo
+  muestra la pagina de perfiles y caduca a los ``HEADER_MAX_AGE`` segundos),
+- o un administrador ha activado el perfilado desde la pagina de perfiles
+  (``enable()``); mientras dure se perfila una fraccion de las peticiones
+  de las vistas elegidas al activarlo (nombres de URL; vacio, todas). Por
+  defecto, la fraccion ``SAMPLE_RATE`` de las vistas de ``VIEWS``.
+
+Los perfiles se guardan en ``PATH`` como un anillo acotado de
+``MAX_PROFILES`` entradas: al escribir uno nuevo se borran los mas
+antiguos. Cada perfil son dos ficheros: ``<id>.pstats`` (se abre con
+``python -m pstats`` o snakeviz) y ``<id>.json`` con la peticion y el log
+SQL. ``collapsed_stacks()`` los exporta en el formato de pilas plegadas de
+``flamegraph.pl`` y speedscope.
+
+Sin cabecera ni activacion el coste por peticion es una busqueda en
+``request.META`` y, como mucho una vez por segundo, un ``stat`` del fichero
+de activacion (compartido por todos los workers).
+
+La configuracion esta en ``settings.GAME_PROFILING``:
+
+- ``ENABLED``: si el middleware atiende a la cabecera y a la activacion.
+- ``PATH``: directorio de los perfiles.
+- ``MAX_PROFILES``: perfiles que se conservan.
+- ``SAMPLE_RATE``: fraccion de peticiones que se perfila si no se indica
+  otra al activarlo.
+- ``VIEWS``: nombres de URL que se perfilan si no se indican otros al
+  activarlo.
+- ``HEADER_MAX_AGE``: segundos de validez de la cabecera firmada.
+"""
+import asyncio
+import cProfile
+import json
+import logging
+import marshal
+import os
+import pstats
+import random
+import re
+import threading
+import time
+
+from asgiref.sync import async_to_sync, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core import signing
+from django.db import connection
+from django.urls import Resolver404, get_resolver, resolve
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED': True,
+    'PATH': '/tmp/kahootclone-profiles',
+    'MAX_PROFILES': 100,
+    'SAMPLE_RATE': 0.1,
+    'VIEWS': (),
+    'HEADER_MAX_AGE': 3600,
+}
+
+HEADER = 'HTTP_X_PROFILE'
+SIGNING_SALT = 'services.profiling'
+TOGGLE_FILE = 'toggle.json'
+# segundos entre comprobaciones del fichero de activacion
+TOGGLE_CHECK = 1.0
+
+PROFILE_ID = re.compile(r'^\d{20}-\d+$')
+
+# un perfil a la vez por proceso (desde Python 3.12 cProfile usa un
+# gancho global y no admite dos perfiladores activos)
+_active = threading.Lock()
+
+
+def option(name):
+    options = getattr(settings, 'GAME_PROFILING', {})
+    return options.get(name, DEFAULTS[name])
+
+
+def sign():
+    """
+    Valor de la cabecera ``X-Profile`` que fuerza el perfilado.
+
+    :return: Valor firmado (str), valido ``HEADER_MAX_AGE`` segundos
+    """
+    return signing.dumps('profile', salt=SIGNING_SALT)
+
+
+def valid_header(value):
+    try:
+        return signing.loads(value, salt=SIGNING_SALT,
+                             max_age=option('HEADER_MAX_AGE')) == 'profile'
+    except signing.BadSignature:
+        return False
+
+
+class Toggle:
+    """
+    Activacion del perfilado por muestreo, guardada en ``PATH`` para que
+    la vean todos los workers. Se relee como mucho cada ``TOGGLE_CHECK``
+    segundos.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checked = float('-inf')
+        self.mtime = None
+        self.until = 0
+        self.rate = 0
+        self.views = ()
+
+    def path(self):
+        return os.path.join(option('PATH'), TOGGLE_FILE)
+
+    def rate_now(self):
+        """
+        Fraccion de peticiones que se perfila ahora.
+
+        :return: 0 si el perfilado no esta activado
+        """
+        now = time.monotonic()
+        if now - self.checked >= TOGGLE_CHECK:
+            with self._lock:
+                if now - self.checked >= TOGGLE_CHECK:
+                    self.checked = now
+                    self._reload()
+        if self.until and time.time() < self.until:
+            return self.rate
+        return 0
+
+    def _reload(self):
+        try:
+            mtime = os.stat(self.path()).st_mtime
+        except OSError:
+            self.mtime, self.until, self.rate, self.views = None, 0, 0, ()
+            return
+        if mtime == self.mtime:
+            return
+        try:
+            with open(self.path()) as toggle:
+                data = json.load(toggle)
+            self.until, self.rate = float(data['until']), float(data['rate'])
+            self.views = tuple(str(name) for name in data['views'])
+        except (OSError, ValueError, KeyError, TypeError):
+            self.until, self.rate, self.views = 0, 0, ()
+        self.mtime = mtime
+
+    def enable(self, minutes, rate=None, views=None):
+        """
+        Activa el perfilado por muestreo.
+
+        :param minutes: Minutos que dura la activacion
+        :param rate: Fraccion de peticiones; por defecto ``SAMPLE_RATE``
+        :param views: Nombres de URL que se perfilan (vacio, todas); por
+            defecto ``VIEWS``
+        """
+        if rate is None:
+            rate = option('SAMPLE_RATE')
+        if views is None:
+            views = option('VIEWS')
+        os.makedirs(option('PATH'), exist_ok=True)
+        tmp = self.path() + '.tmp'
+        with open(tmp, 'w') as toggle:
+            json.dump({'until': time.time() + minutes * 60,
+                       'rate': rate, 'views': list(views)}, toggle)
+        os.replace(tmp, self.path())
+        self.checked = float('-inf')
+
+    def disable(self):
+        """Desactiva el perfilado por muestreo"""
+        try:
+            os.remove(self.path())
+        except FileNotFoundError:
+            pass
+        self.checked = float('-inf')
+
+    def state(self):
+        """
+        Activacion actual.
+
+        :return: Diccionario con ``until`` (epoch, 0 si no esta activado),
+            ``rate`` y ``views``
+        """
+        rate = self.rate_now()
+        return {'until': self.until if rate else 0, 'rate': rate,
+                'views': self.views if rate else ()}
+
+
+toggle = Toggle()
+
+
+def known_view(name):
+    """
+    Comprueba que un nombre de URL existe, con o sin espacio de nombres
+    (``admin:index``).
+
+    :param name: Nombre de URL
+
+    :return: True si existe
+    """
+    resolver = get_resolver()
+    *namespaces, name = name.split(':')
+    for namespace in namespaces:
+        if namespace not in resolver.namespace_dict:
+            return False
+        resolver = resolver.namespace_dict[namespace][1]
+    return name in resolver.reverse_dict
+
+
+class SQLLog:
+    """Envoltorio de ``execute`` que guarda cada consulta y su duracion"""
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({
+                'sql': sql,
+                'ms': round((time.perf_counter() - start) * 1000, 3),
+            })
+
+
+class ProfilingMiddleware:
+    """
+    Perfila las peticiones con la cabecera firmada o, con el perfilado
+    activado, una muestra de las de las vistas elegidas.
+
+    Bajo ASGI, una peticion a una vista sincrona que se perfila se atiende
+    entera desde el hilo de las vistas sincronas (``sync_to_async``): el
+    perfilador y el log SQL se activan en ese hilo y el resto de la cadena
+    se ejecuta con ``async_to_sync``, que devuelve la vista al mismo hilo.
+    Las peticiones a vistas asincronas no se perfilan: ``cProfile`` mediria
+    todo lo que ejecuta el bucle de eventos mientras tanto, no solo la
+    peticion.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        trigger = self.trigger(request)
+        if trigger is not None:
+            return self.profile(request, trigger, self.get_response)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        trigger = self.trigger(request)
+        if trigger is not None and not self.async_view(request):
+            return await sync_to_async(self.profile)(
+                request, trigger, async_to_sync(self.get_response))
+        return await self.get_response(request)
+
+    def trigger(self, request):
+        """
+        Motivo por el que se perfila la peticion.
+
+        :return: ``header``, ``sample`` o None si no se perfila
+        """
+        if not option('ENABLED'):
+            return None
+        header = request.META.get(HEADER)
+        if header is not None:
+            return 'header' if valid_header(header) else None
+        rate = toggle.rate_now()
+        if rate and random.random() < rate and self.selected(request):
+            return 'sample'
+        return None
+
+    def async_view(self, request):
+        "si la peticion es de una vista asincrona"
+        try:
+            view = resolve(request.path_info).func
+        except Resolver404:
+            return False
+        return asyncio.iscoroutinefunction(view)
+
+    def selected(self, request):
+        "si la peticion es de una de las vistas elegidas al activarlo"
+        views = toggle.views
+        if not views:
+            return True
+        try:
+            return resolve(request.path_info).view_name in views
+        except Resolver404:
+            return False
+
+    def profile(self, request, trigger, get_response):
+        """
+        Atiende la peticion con el perfilador y el log SQL activos en el
+        hilo actual y guarda el perfil.
+
+        :param request: Petición HTTP
+        :param trigger: ``header`` o ``sample``
+        :param get_response: Resto de la cadena, sincrono
+
+        :return: Respuesta
+        """
+        if not _active.acquire(blocking=False):
+            return get_response(request)
+        try:
+            profiler = cProfile.Profile()
+            log = SQLLog()
+            start = time.perf_counter()
+            with connection.execute_wrapper(log):
+                profiler.enable()
+                try:
+                    response = get_response(request)
+                finally:
+                    profiler.disable()
+            elapsed = time.perf_counter() - start
+        finally:
+            _active.release()
+        match = request.resolver_match
+        view = match.view_name if match is not None else 'unmatched'
+        try:
+            save(profiler, {
+                'path': request.get_full_path(),
+                'method': request.method,
+                'view': view,
+                'status': response.status_code,
+                'trigger': trigger,
+                'time': time.time(),
+                'ms': round(elapsed * 1000, 3),
+                'sql_ms': round(sum(query['ms']
+                                    for query in log.queries), 3),
+                'queries': log.queries,
+            })
+        except OSError:
+            logger.exception('could not save the profile of %s',
+                             request.path)
+        return response
+
+
+def save(profiler, meta):
+    """
+    Guarda un perfil y borra los que pasan de ``MAX_PROFILES``.
+
+    :param profiler: ``cProfile.Profile`` ya detenido
+    :param meta: Datos de la peticion (JSON)
+
+    :return: Id del perfil
+    """
+    path = option('PATH')
+    os.makedirs(path, exist_ok=True)
+    profile_id = '%020d-%d' % (time.time_ns(), os.getpid())
+    profiler.dump_stats(os.path.join(path, profile_id + '.pstats'))
+    meta = dict(meta, id=profile_id)
+    tmp = os.path.join(path, profile_id + '.tmp')
+    with open(tmp, 'w') as output:
+        json.dump(meta, output)
+    # el .json aparece el ultimo: un perfil listado esta completo
+    os.replace(tmp, os.path.join(path, profile_id + '.json'))
+    for old in profile_ids()[option('MAX_PROFILES'):]:
+        for extension in ('.json', '.pstats'):
+            try:
+                os.remove(os.path.join(path, old + extension))
+            except FileNotFoundError:
+                pass
+    return profile_id
+
+
+def profile_ids():
+    """Ids de los perfiles guardados, del mas reciente al mas antiguo"""
+    try:
+        names = os.listdir(option('PATH'))
+    except FileNotFoundError:
+        return []
+    return sorted((name[:-5] for name in names
+                   if name.endswith('.json') and PROFILE_ID.match(name[:-5])),
+                  reverse=True)
+
+
+def load(profile_id):
+    """
+    Datos de un perfil guardado.
+
+    :param profile_id: Id del perfil
+
+    :return: Diccionario de la peticion y su log SQL
+    :raises KeyError: si no existe el perfil
+    """
+    if not PROFILE_ID.match(profile_id):
+        raise KeyError(profile_id)
+    try:
+        with open(os.path.join(option('PATH'),
+                               profile_id + '.json')) as meta:
+            return json.load(meta)
+    except (OSError, ValueError):
+        raise KeyError(profile_id)
+
+
+def load_stats(profile_id):
+    """
+    Estadisticas de ``cProfile`` de un perfil.
+
+    :param profile_id: Id del perfil
+
+    :return: ``pstats.Stats``
+    :raises KeyError: si no existe el perfil
+    """
+    if not PROFILE_ID.match(profile_id):
+        raise KeyError(profile_id)
+    try:
+        return pstats.Stats(os.path.join(option('PATH'),
+                                         profile_id + '.pstats'))
+    except (OSError, EOFError, ValueError, TypeError, marshal.error):
+        raise KeyError(profile_id)
+
+
+def function_name(function):
+    filename, line, name = function
+    if filename == '~':
+        # funciones integradas: '<built-in method ...>'
+        return name
+    return '%s:%d:%s' % (filename, line, name)
+
+
+def collapsed_stacks(stats, max_depth=64):
+    """
+    Pilas plegadas (``raiz;...;funcion microsegundos``) de un perfil.
+
+    ``cProfile`` solo guarda pares llamante-llamado, de modo que las pilas
+    se reconstruyen desde las raices repartiendo el tiempo de cada llamado
+    segun el peso de cada llamante: con funciones llamadas desde varios
+    sitios o recursivas el reparto es aproximado. Las raices son las
+    funciones sin llamante y, si quedan funciones sin recorrer (ciclos como
+    el de los middleware de Django), la de mas tiempo acumulado.
+
+    :param stats: ``pstats.Stats``
+    :param max_depth: Profundidad maxima de las pilas
+
+    :return: Lineas (list de str)
+    """
+    entries = stats.stats
+    callees = {}
+    for function, (_, _, _, _, callers) in entries.items():
+        for caller, edge in callers.items():
+            if caller != function:
+                callees.setdefault(caller, {})[function] = edge
+    totals = {}
+    visited = set()
+    # se descartan las ramas de menos del 0,01 % del tiempo total
+    threshold = max(1e-6, sum(entry[2] for entry in entries.values()) * 1e-4)
+
+    def walk(function, stack, fraction, depth):
+        visited.add(function)
+        # tiempo propio de la funcion en esta pila
+        own = entries[function][2] * fraction
+        if own > 0:
+            totals[stack] = totals.get(stack, 0) + own
+        if depth >= max_depth:
+            return
+        children = [(callee, fraction * edge[3])
+                    for callee, edge in callees.get(function, {}).items()
+                    if entries[callee][3]]
+        # en las recursiones los arcos suman mas que el tiempo de la
+        # funcion: se escalan para no repartir mas tiempo del que hay
+        spent = sum(seconds for _, seconds in children)
+        available = entries[function][3] * fraction - own
+        scale = min(1.0, available / spent) if spent > 0 else 0
+        for callee, seconds in children:
+            seconds *= scale
+            if seconds < threshold:
+                continue
+            walk(callee, stack + ';' + function_name(callee),
+                 seconds / entries[callee][3], depth + 1)
+
+    roots = [function for function, entry in entries.items()
+             if not set(entry[4]) - {function}]
+    others = sorted(entries, key=lambda function: -entries[function][3])
+    for function in roots + others:
+        if function not in visited:
+            walk(function, function_name(function), 1.0, 1)
+    lines = []
+    for stack, seconds in sorted(totals.items()):
+        microseconds = int(round(seconds * 1e6))
+        if microseconds:
+            lines.append('%s %d' % (stack, microseconds))
+    return lines
@@ -0,0 +1,259 @@
+"""
+Canal en tiempo real de las partidas.
+
+Los clientes (anfitrion y participantes) abren un WebSocket en
+``/ws/game/<publicId>/`` y reciben los cambios de la partida en cuanto se
+producen, en lugar de recargar la pagina o sondear
+``game-updateparticipant`` cada pocos segundos.
+
+Mensajes enviados al cliente (JSON):
+
+- ``snapshot``: estado completo al conectarse (estado, pregunta actual y,
+  solo al anfitrion, alias de los participantes).
+- ``state``: transicion de estado (WAITING -> QUESTION -> ANSWER ->
+  LEADERBOARD) junto con el numero de pregunta.
+- ``participant``: un participante nuevo se ha unido a la partida (con su
+  alias solo para el anfitrion).
+- ``guess``: se ha registrado una respuesta para la pregunta indicada.
+
+Los eventos llegan por el bus de la partida (``services.events``), de modo
+que un cliente recibe los cambios aunque los produzca otro worker; cada
+proceso reenvia a sus clientes solo los campos de ``CLIENT_FIELDS``, y al
+anfitrion ademas los de ``HOST_FIELDS``. Como en
+``services.views.LobbyParticipants``, es anfitrion quien trae el token de
+anfitrion de la partida o la sesion del propietario del cuestionario.
+"""
+import asyncio
+import json
+import re
+import threading
+from functools import partial
+from importlib import import_module
+from types import SimpleNamespace
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http.cookie import parse_cookie
+
+from .events import bus
+
+GAME_PATH = re.compile(r'^/ws/game/(?P<publicId>\d+)/?$')
+
+# campos de cada tipo de evento que se envian a los clientes; el resto
+# (uuid de los participantes, plazos...) solo interesa a los workers
+CLIENT_FIELDS = {
+    'state': ('state', 'questionNo'),
+    'participant': ('id',),
+    'guess': ('question',),
+}
+
+# campos que solo recibe el anfitrion de la partida
+HOST_FIELDS = {
+    'participant': ('alias',),
+}
+
+
+class GameChannels:
+    """
+    Registro de los clientes conectados a cada partida.
+
+    Cada suscripcion es una cola asyncio ligada al bucle de eventos que la
+    creo, de modo que ``publish`` puede llamarse desde cualquier hilo (las
+    vistas sincronas se ejecutan en un hilo aparte bajo ASGI). Mientras una
+    partida tiene clientes conectados, el registro esta suscrito a su canal
+    del bus.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._groups = {}
+        self._subscriptions = {}
+
+    def subscribe(self, publicId, host=False):
+        """
+        Suscribe al bucle de eventos actual a la partida ``publicId``.
+
+        :param publicId: PIN de la partida
+        :param host: Si recibe tambien los campos de ``HOST_FIELDS``
+
+        :return: Suscripcion (bucle, cola, anfitrion) que se pasa a
+            ``unsubscribe``
+        """
+        subscription = (asyncio.get_running_loop(), asyncio.Queue(), host)
+        with self._lock:
+            group = self._groups.setdefault(publicId, set())
+            group.add(subscription)
+            if publicId not in self._subscriptions:
+                self._subscriptions[publicId] = bus.subscribe(
+                    publicId, partial(self.forward, publicId))
+        return subscription
+
+    def unsubscribe(self, publicId, subscription):
+        """
+        Elimina una suscripcion creada con ``subscribe``.
+
+        :param publicId: PIN de la partida
+        :param subscription: Suscripcion devuelta por ``subscribe``
+        """
+        with self._lock:
+            group = self._groups.get(publicId)
+            if group is None:
+                return
+            group.discard(subscription)
+            if not group:
+                del self._groups[publicId]
+                bus.unsubscribe(self._subscriptions.pop(publicId))
+
+    def subscribers(self, publicId):
+        """Devuelve el numero de clientes conectados a la partida"""
+        with self._lock:
+            return len(self._groups.get(publicId, ()))
+
+    def publish(self, publicId, event, host_event=None):
+        """
+        Envia un evento a todos los clientes conectados a la partida.
+
+        El mensaje se serializa una sola vez y se reparte entre todas las
+        colas; los bucles ya cerrados se ignoran.
+
+        :param publicId: PIN de la partida
+        :param event: Diccionario serializable a JSON
+        :param host_event: Version del evento para el anfitrion, si es
+            distinta
+        """
+        with self._lock:
+            group = list(self._groups.get(publicId, ()))
+        if not group:
+            return
+        message = json.dumps(event)
+        host_message = json.dumps(host_event) \
+            if host_event is not None else message
+        for loop, queue, host in group:
+            try:
+                loop.call_soon_threadsafe(
+                    queue.put_nowait, host_message if host else message)
+            except RuntimeError:
+                # el bucle del cliente ya se ha cerrado
+                pass
+
+    def forward(self, publicId, event):
+        """
+        Reenvia a los clientes los campos publicos de un evento del bus.
+
+        :param publicId: PIN de la partida
+        :param event: Evento publicado en ``services.events``
+        """
+        fields = CLIENT_FIELDS.get(event['type'])
+        if fields is not None:
+            message = {'type': event['type']}
+            message.update((field, event[field]) for field in fields)
+            host_message = None
+            host_fields = HOST_FIELDS.get(event['type'])
+            if host_fields is not None:
+                host_message = dict(message)
+                host_message.update(
+                    (field, event[field]) for field in host_fields)
+            self.publish(publicId, message, host_message)
+
+
+channels = GameChannels()
+
+
+def _is_host(session, scope):
+    """
+    Si la conexion es del anfitrion de la partida: trae su token de
+    anfitrion o la sesion de Django del propietario del cuestionario.
+    """
+    from django.contrib.auth import get_user
+
+    from . import tokens
+    from .views import host_role
+
+    cookies = {}
+    for name, value in scope.get('headers', ()):
+        if name == b'cookie':
+            cookies.update(parse_cookie(value.decode('latin1')))
+    # peticion minima para las comprobaciones de las vistas
+    engine = import_module(settings.SESSION_ENGINE)
+    request = SimpleNamespace(COOKIES=cookies, session=engine.SessionStore(
+        cookies.get(settings.SESSION_COOKIE_NAME)))
+    if host_role(request, session.publicId) == tokens.HOST:
+        return True
+    return get_user(request).id == session.game.questionnaire.user_id
+
+
+def _snapshot(publicId, scope):
+    """
+    Construye el mensaje inicial de la partida o None si no existe.
+
+    Se ejecuta en el hilo de las vistas sincronas (``sync_to_async``) y
+    parte de la sesion en memoria de la partida (``services.engine``).
+
+    :return: Tupla (mensaje, si la conexion es del anfitrion) o None
+    """
+    from models.models import Game
+
+    from .engine import sessions
+
+    try:
+        session = sessions.get(publicId)
+    except Game.DoesNotExist:
+        return None
+    snapshot = {
+        'type': 'snapshot',
+        'state': session.state,
+        'questionNo': session.questionNo,
+    }
+    host = _is_host(session, scope)
+    if host:
+        leaderboard = session.leaderboard
+        with leaderboard.lock:
+            snapshot['participants'] = [
+                leaderboard.aliases[participant_id]
+                for participant_id in sorted(leaderboard.aliases)]
+    return snapshot, host
+
+
+async def websocket_application(scope, receive, send):
+    """
+    Aplicacion ASGI para las conexiones WebSocket de las partidas.
+
+    :param scope: Scope ASGI de la conexion
+    :param receive: Canal de entrada ASGI
+    :param send: Canal de salida ASGI
+    """
+    event = await receive()
+    if event['type'] != 'websocket.connect':
+        return
+    match = GAME_PATH.match(scope['path'])
+    found = None
+    if match is not None:
+        publicId = int(match.group('publicId'))
+        found = await sync_to_async(_snapshot)(publicId, scope)
+    if found is None:
+        await send({'type': 'websocket.close', 'code': 4404})
+        return
+    snapshot, host = found
+
+    await send({'type': 'websocket.accept'})
+    subscription = channels.subscribe(publicId, host)
+    queue = subscription[1]
+    try:
+        await send({'type': 'websocket.send', 'text': json.dumps(snapshot)})
+        incoming = asyncio.ensure_future(receive())
+        outgoing = asyncio.ensure_future(queue.get())
+        while True:
+            done, _ = await asyncio.wait(
+                {incoming, outgoing}, return_when=asyncio.FIRST_COMPLETED)
+            if outgoing in done:
+                await send({'type': 'websocket.send',
+                            'text': outgoing.result()})
+                outgoing = asyncio.ensure_future(queue.get())
+            if incoming in done:
+                if incoming.result()['type'] == 'websocket.disconnect':
+                    break
+                # los clientes no envian nada; se ignora cualquier mensaje
+                incoming = asyncio.ensure_future(receive())
+        outgoing.cancel()
+    finally:
+        channels.unsubscribe(publicId, subscription)
@@ -0,0 +1,141 @@
+"""
+Respuestas del estado de la partida ya codificadas.
+
+Cuando todos los participantes sondean a la vez el estado de la partida
+(``services.views.GameState`` y ``restServer.play.state``), cada peticion
+volveria a serializar la misma pregunta, sus respuestas y el plazo. El
+cuerpo solo cambia con la version de la partida (``GameSession.version``),
+asi que cada sesion guarda en ``StateCache`` el JSON ya codificado de la
+version actual, por papel (participante o anfitrion) y por codificacion
+(sin comprimir, gzip o brotli). Cada variante se construye una vez, con la
+primera peticion que la pide, y todas las demas peticiones de esa version
+reciben el mismo buffer. Al cambiar la version se descartan todas.
+
+Los participantes no ven que respuestas son correctas hasta la fase
+ANSWER; el anfitrion las ve siempre.
+"""
+import gzip
+import json
+import re
+import time
+
+import brotli
+
+from models.constants import ANSWER, QUESTION
+
+from . import tokens
+
+# por debajo de este tamaño la compresion no compensa (como GZipMiddleware)
+MIN_COMPRESS_SIZE = 200
+
+# codificaciones por orden de preferencia
+ENCODINGS = (
+    ('br', re.compile(r'\bbr\b')),
+    ('gzip', re.compile(r'\bgzip\b')),
+)
+
+COMPRESSORS = {
+    'br': lambda body: brotli.compress(body, mode=brotli.MODE_TEXT),
+    'gzip': lambda body: gzip.compress(body, mtime=0),
+}
+
+
+def accepted_encoding(request):
+    """
+    Codificacion preferida de las que acepta el cliente.
+
+    :param request: Petición HTTP
+
+    :return: ``br``, ``gzip`` o None
+    """
+    accept = request.META.get('HTTP_ACCEPT_ENCODING', '')
+    for encoding, pattern in ENCODINGS:
+        if pattern.search(accept):
+            return encoding
+    return None
+
+
+def state_payload(game_session, version, role):
+    """
+    Estado compacto de la partida, con la pregunta actual en las fases
+    QUESTION y ANSWER. Se llama con el cerrojo de la sesion.
+
+    :param game_session: Sesion de la partida
+    :param version: Version actual de la partida
+    :param role: ``tokens.PARTICIPANT`` o ``tokens.HOST``
+
+    :return: Diccionario serializable en JSON
+    """
+    deadline = game_session.deadline
+    question = game_session.question \
+        if game_session.state in (QUESTION, ANSWER) else None
+    if question is not None:
+        reveal = role == tokens.HOST or game_session.state == ANSWER
+        answers = []
+        for answer in question.answers:
+            data = {'id': answer.id, 'answer': answer.answer}
+            if reveal:
+                data['correct'] = answer.correct
+            answers.append(data)
+        question = {
+            'id': question.id,
+            'question': question.question,
+            'answerTime': question.answerTime,
+            'value': question.value,
+            'answers': answers,
+        }
+    return {
+        'publicId': game_session.publicId,
+        'version': version,
+        'state': game_session.state,
+        'questionNo': game_session.questionNo,
+        'questions': len(game_session.questions),
+        'participants': len(game_session.leaderboard),
+        'question': question,
+        # instante (epoch) en que vence la fase actual; no cambia durante
+        # la fase, a diferencia de lo que queda
+        'deadline': round(time.time() + deadline - time.monotonic(), 3)
+        if deadline is not None else None,
+    }
+
+
+class StateCache:
+    """
+    Cuerpos de la respuesta de estado de la version actual de una partida,
+    por papel y codificacion. Se usa con el cerrojo de la sesion.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.bodies = {}
+
+    def body(self, game_session, version, role, encoding=None):
+        """
+        Cuerpo de la respuesta, construido solo la primera vez.
+
+        :param game_session: Sesion de la partida
+        :param version: Version actual de la partida
+        :param role: ``tokens.PARTICIPANT`` o ``tokens.HOST``
+        :param encoding: ``br``, ``gzip`` o None
+
+        :return: Tupla (bytes, codificacion); la codificacion es None si
+            el cuerpo es demasiado pequeño para comprimirlo
+        """
+        if version != self.version:
+            # la partida ha avanzado: las variantes anteriores ya no sirven
+            self.version = version
+            self.bodies = {}
+        key = (role, encoding)
+        body = self.bodies.get(key)
+        if body is None:
+            if encoding is None:
+                body = (json.dumps(state_payload(game_session, version, role))
+                        .encode(), None)
+            else:
+                plain = self.body(game_session, version, role)[0]
+                if len(plain) < MIN_COMPRESS_SIZE:
+                    body = (plain, None)
+                else:
+                    body = (COMPRESSORS[encoding](plain), encoding)
+            self.bodies[key] = body
+        return body
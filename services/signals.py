@@ -0,0 +1,76 @@
+"""
+Receptores de señales de los modelos del juego.
+
+Mantienen al día las sesiones en memoria (``services.engine``) y publican
+los cambios en el bus de la partida (``services.events``), que los hace
+llegar a los demas workers y a los clientes conectados por WebSocket.
+Ademas instalan en cada conexion a la base de datos el contador de
+consultas de ``services.metrics``.
+"""
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from models.models import Game, Guess, Participant
+
+from . import events
+from .engine import sessions
+from .metrics import install_query_counter, metrics
+
+
+@receiver(connection_created, dispatch_uid='services_connection_created')
+def connection_opened(sender, connection, **kwargs):
+    """
+    Cuenta en ``services.metrics`` las consultas de cada conexion, tambien
+    las de los hilos de las vistas sincronas bajo ASGI.
+    """
+    install_query_counter(connection)
+
+
+@receiver(post_save, sender=Game, dispatch_uid='services_game_saved')
+@receiver(post_delete, sender=Game, dispatch_uid='services_game_deleted')
+def game_changed(sender, instance, **kwargs):
+    """
+    Descarta la sesion en memoria de una partida modificada fuera del motor.
+
+    El motor guarda sus puntos de control con ``update()``, que no emite
+    señales, de modo que esto solo ocurre con escrituras externas
+    (administracion, tests, etc.). Los demas procesos la descartan al
+    recibir el evento ``changed``.
+    """
+    sessions.discard(instance.publicId)
+    if instance.publicId is not None:
+        events.publish_changed(instance.publicId)
+
+
+@receiver(post_save, sender=Participant,
+          dispatch_uid='services_participant_joined')
+def participant_joined(sender, instance, created, **kwargs):
+    """
+    Publica la llegada del participante; las sesiones de todos los
+    procesos, incluido este, lo añaden al recibir el evento.
+    """
+    if created:
+        metrics.inc('joins_total')
+        events.publish_participant(instance, instance.game.publicId)
+
+
+@receiver(post_save, sender=Guess, dispatch_uid='services_guess_created')
+def guess_created(sender, instance, created, **kwargs):
+    """
+    Suma los puntos en la sesion y publica la respuesta.
+
+    Solo afecta a las respuestas guardadas una a una; las que llegan por
+    ``services.ingestion`` se escriben por lotes y las contabiliza
+    el propio ingestor.
+    """
+    if created:
+        metrics.inc('guesses_total')
+        publicId = instance.game.publicId
+        points = instance.question.value if instance.answer.correct else 0
+        session = sessions.peek(publicId)
+        if session is not None:
+            session.record_guess(instance.question_id,
+                                 instance.participant_id, instance.answer_id)
+            session.add_points(instance.participant_id, points)
+        events.publish_guess(instance, publicId, points)
@@ -0,0 +1,89 @@
+"""
+Cuestionarios compilados para jugar.
+
+Durante la partida las preguntas y respuestas no cambian, asi que se leen
+una sola vez (dos consultas) y se guardan en memoria como tuplas
+inmutables: preguntas en orden, cada una con su tiempo, su valor y sus
+respuestas.
+
+Cada cuestionario lleva un numero de version (``Questionnaire.version``)
+que se incrementa al guardar o borrar una de sus preguntas o respuestas
+(ver ``models.models``). La cache se indexa por (cuestionario, version):
+una version nueva se compila de nuevo y las antiguas salen de la cache por
+antiguedad de uso.
+"""
+from collections import namedtuple
+from functools import lru_cache
+
+from models.models import Answer, Question
+
+SNAPSHOT_CACHE_SIZE = 256
+
+
+class AnswerSnapshot(namedtuple('AnswerSnapshot',
+                                ['id', 'answer', 'correct'])):
+    __slots__ = ()
+
+    def __str__(self):
+        return self.answer
+
+
+class QuestionSnapshot(namedtuple('QuestionSnapshot', [
+        'id', 'position', 'question', 'answerTime', 'value', 'answers'])):
+    __slots__ = ()
+
+    def __str__(self):
+        return self.question
+
+
+class QuestionnaireSnapshot:
+    """
+    Preguntas de un cuestionario en el orden de juego.
+
+    :param questionnaire_id: Id del cuestionario
+    :param version: Version compilada
+    :param questions: Tupla ordenada de ``QuestionSnapshot``
+    """
+
+    def __init__(self, questionnaire_id, version, questions):
+        self.questionnaire_id = questionnaire_id
+        self.version = version
+        self.questions = questions
+        self.by_id = {question.id: question for question in questions}
+
+    def __len__(self):
+        return len(self.questions)
+
+    def __getitem__(self, position):
+        return self.questions[position]
+
+
+@lru_cache(maxsize=SNAPSHOT_CACHE_SIZE)
+def get_snapshot(questionnaire_id, version):
+    """
+    Devuelve el cuestionario compilado, compilandolo si no esta en cache.
+
+    :param questionnaire_id: Id del cuestionario
+    :param version: ``Questionnaire.version`` actual
+
+    :return: ``QuestionnaireSnapshot``
+    """
+    answers = {}
+    for answer in Answer.objects.filter(
+            question__questionnaire_id=questionnaire_id).order_by(
+            'id').values_list('id', 'question_id', 'answer', 'correct'):
+        answers.setdefault(answer[1], []).append(
+            AnswerSnapshot(answer[0], answer[2], answer[3]))
+    questions = tuple(
+        QuestionSnapshot(question_id, position, text, answerTime, value,
+                         tuple(answers.get(question_id, ())))
+        for question_id, position, text, answerTime, value in
+        Question.objects.filter(questionnaire_id=questionnaire_id)
+        .order_by('position')
+        .values_list('id', 'position', 'question', 'answerTime', 'value'))
+    return QuestionnaireSnapshot(questionnaire_id, version, questions)
+
+
+def compile_questionnaire(questionnaire):
+    """Devuelve el snapshot de la version actual de un cuestionario"""
+    return get_snapshot(questionnaire.pk, questionnaire.version)
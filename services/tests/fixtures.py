@@ -0,0 +1,53 @@
+from models.models import Answer, Game, Question, Questionnaire, User
+from services.engine import sessions
+
+
+class GameFixtures:
+    """
+    Base de los tests de partidas: crea el usuario (``self.user``) y vacia
+    las sesiones en memoria antes y despues de cada test. ``create_game``
+    crea el cuestionario y la partida; cada test solo indica lo que cambia.
+    """
+
+    def setUp(self):
+        super().setUp()
+        sessions.clear()
+        self.addCleanup(sessions.clear)
+        self.user = User.objects.create_user(username='a', password='a')
+
+    def create_game(self, questions=1, answers=('a',), question=None,
+                    **fields):
+        """
+        Crea un cuestionario del usuario y una partida suya.
+
+        Las preguntas se llaman ``q0``, ``q1``... y todas tienen las mismas
+        respuestas; la primera es la correcta. Quedan en ``self.questions``
+        (la primera tambien en ``self.question``) y las respuestas de la
+        primera en ``self.answers``.
+
+        :param questions: Numero de preguntas
+        :param answers: Textos de las respuestas de cada pregunta
+        :param question: Campos comunes de las preguntas (``value``...)
+        :param fields: Campos de la partida (``state``...)
+
+        :return: La partida, tambien en ``self.game``
+        """
+        self.questionnaire = Questionnaire.objects.create(title='q',
+                                                          user=self.user)
+        self.questions = []
+        self.answers = []
+        for n in range(questions):
+            created = Question.objects.create(
+                question='q%d' % n, questionnaire=self.questionnaire,
+                **(question or {}))
+            self.questions.append(created)
+            for i, answer in enumerate(answers):
+                answer = Answer.objects.create(answer=answer,
+                                               question=created,
+                                               correct=i == 0)
+                if n == 0:
+                    self.answers.append(answer)
+        self.question = self.questions[0] if self.questions else None
+        self.game = Game.objects.create(questionnaire=self.questionnaire,
+                                        **fields)
+        return self.game
@@ -0,0 +1,99 @@
+from django.test import TestCase
+from django.urls import reverse
+
+from models.models import Answer, Question, Questionnaire, User
+
+# consultas de sesion y usuario que hace cualquier peticion autenticada
+AUTH_QUERIES = 2
+
+
+class AuthoringTests(TestCase):
+    """Vistas de edicion de cuestionarios"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='a', password='a')
+        self.questionnaire = Questionnaire.objects.create(title='q',
+                                                          user=self.user)
+        self.questions = [
+            Question.objects.create(question='q%d' % n,
+                                    questionnaire=self.questionnaire)
+            for n in range(3)]
+        self.answers = [
+            Answer.objects.create(answer='a%d' % n, question=question,
+                                  correct=(n == 0))
+            for question in self.questions for n in range(3)]
+        self.client.force_login(self.user)
+
+    def test01_reorder(self):
+        "el propietario puede reordenar las preguntas"
+        url = reverse('questionnaire-reorder', args=[self.questionnaire.id])
+        order = [self.questions[2].id, self.questions[0].id,
+                 self.questions[1].id]
+        response = self.client.post(url, {'question': order})
+        self.assertRedirects(response, reverse(
+            'questionnaire-detail', args=[self.questionnaire.id]))
+        self.assertEqual(list(self.questionnaire.question_set.values_list(
+            'id', flat=True)), order)
+
+        response = self.client.post(url, {'question': order[:2]})
+        self.assertEqual(response.status_code, 400)
+
+        other = User.objects.create_user(username='b', password='b')
+        self.client.force_login(other)
+        response = self.client.post(url, {'question': order[::-1]})
+        self.assertRedirects(response, reverse('questionnaire-list'))
+        self.assertEqual(list(self.questionnaire.question_set.values_list(
+            'id', flat=True)), order)
+
+    def test02_query_counts(self):
+        "la propiedad se comprueba en la misma consulta que carga el objeto"
+        questionnaire = self.questionnaire.id
+        question = self.questions[0].id
+        answer = self.answers[0].id
+        cases = [
+            # cuestionario, preguntas y respuestas (prefetch)
+            ('get', 'questionnaire-detail', questionnaire, {}, 3),
+            ('get', 'questionnaire-update', questionnaire, {}, 1),
+            ('post', 'questionnaire-update', questionnaire,
+             {'title': 't'}, 2),
+            ('get', 'questionnaire-remove', questionnaire, {}, 1),
+            # pregunta con su cuestionario y sus respuestas
+            ('get', 'question-detail', question, {}, 2),
+            ('get', 'question-update', question, {}, 1),
+            ('post', 'question-update', question,
+             {'question': 'q', 'answerTime': 5, 'value': 2}, 5),
+            ('get', 'question-remove', question, {}, 1),
+            ('get', 'question-create', questionnaire, {}, 1),
+            ('post', 'question-create', questionnaire,
+             {'question': 'q', 'answerTime': 5, 'value': 2}, 6),
+            ('get', 'answer-create', question, {}, 1),
+            ('post', 'answer-create', question,
+             {'answer': 'a', 'correct': True}, 5),
+            ('get', 'answer-update', answer, {}, 1),
+            ('post', 'answer-update', answer,
+             {'answer': 'a', 'correct': True}, 5),
+            ('get', 'answer-remove', answer, {}, 1),
+            ('post', 'answer-remove', answer, {}, 4),
+        ]
+        for method, name, pk, data, queries in cases:
+            with self.subTest(view=name, method=method):
+                with self.assertNumQueries(AUTH_QUERIES + queries):
+                    response = getattr(self.client, method)(
+                        reverse(name, args=[pk]), data)
+                self.assertIn(response.status_code, (200, 302))
+
+    def test03_remove_query_counts(self):
+        "borrar no depende del numero de preguntas y respuestas"
+        question = self.questions[1].id
+        with self.assertNumQueries(AUTH_QUERIES + 16):
+            self.client.post(reverse('question-remove', args=[question]))
+        order = list(self.questionnaire.question_set.values_list(
+            'id', flat=True))
+        with self.assertNumQueries(AUTH_QUERIES + 8):
+            self.client.post(reverse('questionnaire-reorder',
+                                     args=[self.questionnaire.id]),
+                             {'question': order[::-1]})
+        with self.assertNumQueries(AUTH_QUERIES + 9):
+            self.client.post(reverse('questionnaire-remove',
+                                     args=[self.questionnaire.id]))
+        self.assertFalse(Questionnaire.objects.exists())
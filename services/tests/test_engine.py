@@ -0,0 +1,161 @@
+from django.db import connection
+from django.test import TestCase
+
+from models.constants import WAITING, QUESTION, ANSWER, LEADERBOARD
+from models.models import Answer, Game, Guess, Participant
+from services.engine import (ANSWER_TEMPLATE, COUNTDOWN_TEMPLATE,
+                             LEADERBOARD_TEMPLATE, QUESTION_TEMPLATE,
+                             SessionRegistry, sessions)
+from services.ingestion import ingestor
+from services.snapshot import compile_questionnaire
+
+from .fixtures import GameFixtures
+
+
+class EngineTests(GameFixtures, TestCase):
+    """Tests del motor de partidas en memoria"""
+
+    def setUp(self):
+        super().setUp()
+        self.create_game(questions=2, question={'value': 5})
+        self.answer = self.answers[0]
+        self.participant = Participant.objects.create(
+            game=self.game, alias='pepe')
+
+    def test01_transitions(self):
+        "las transiciones siguen la maquina de estados de CountDown"
+        session = sessions.get(self.game.publicId)
+        expected = [
+            (COUNTDOWN_TEMPLATE, QUESTION, 0),
+            (QUESTION_TEMPLATE, ANSWER, 0),
+            (ANSWER_TEMPLATE, QUESTION, 1),
+            (QUESTION_TEMPLATE, ANSWER, 1),
+            (ANSWER_TEMPLATE, LEADERBOARD, 1),
+            (LEADERBOARD_TEMPLATE, LEADERBOARD, 1),
+        ]
+        for template, state, questionNo in expected:
+            self.assertEqual(session.advance(), template)
+            self.assertEqual(session.state, state)
+            self.assertEqual(session.questionNo, questionNo)
+
+    def test02_checkpoints(self):
+        "solo se escribe Game al empezar cada pregunta y al terminar"
+        session = sessions.get(self.game.publicId)
+        with self.assertNumQueries(1):
+            session.advance()
+        with self.assertNumQueries(0):
+            session.advance()
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.state, QUESTION)
+        self.assertTrue(session.dirty)
+        with self.assertNumQueries(1):
+            session.advance()
+        self.game.refresh_from_db()
+        self.assertEqual((self.game.state, self.game.questionNo),
+                         (QUESTION, 1))
+
+    def test03_cached_session(self):
+        "la sesion se carga una vez y se descarta si se modifica Game"
+        session = sessions.get(self.game.publicId)
+        with self.assertNumQueries(0):
+            self.assertIs(sessions.get(self.game.publicId), session)
+        self.game.state = QUESTION
+        self.game.save()
+        self.assertIsNone(sessions.peek(self.game.publicId))
+        self.assertEqual(sessions.get(self.game.publicId).state, QUESTION)
+
+    def test04_scores(self):
+        "participantes y puntos nuevos se reflejan en la sesion"
+        session = sessions.get(self.game.publicId)
+        participant = Participant.objects.create(game=self.game, alias='luis')
+        self.assertEqual(session.scores[participant.id], 0)
+        Guess.objects.create(participant=participant, game=self.game,
+                             question=self.question, answer=self.answer)
+        self.assertEqual(session.scores[participant.id], 5)
+
+    def test05_eviction(self):
+        "al expulsar una sesion se guardan los cambios pendientes"
+        registry = SessionRegistry(max_sessions=1)
+        session = registry.get(self.game.publicId)
+        session.advance()
+        session.advance()
+        other = Game.objects.create(questionnaire=self.questionnaire)
+        registry.get(other.publicId)
+        self.assertIsNone(registry.peek(self.game.publicId))
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.state, ANSWER)
+        self.assertEqual(sessions.get(other.publicId).state, WAITING)
+
+    def test06_answer_counts(self):
+        "los contadores por respuesta se cargan con un GROUP BY y despues "
+        "se mantienen en memoria"
+        wrong = Answer.objects.create(
+            answer='b', question=self.question, correct=False)
+        other = Participant.objects.create(game=self.game, alias='juan')
+        Guess.objects.create(participant=self.participant, game=self.game,
+                             question=self.question, answer=wrong)
+        self.assertEqual(
+            Guess.objects.answer_counts(self.game.pk, self.question.pk),
+            {wrong.pk: 1})
+
+        session = sessions.get(self.game.publicId)
+
+        def distribution():
+            return [(answer.id, answer.correct, count) for answer, count
+                    in session.distribution(self.question.pk)]
+
+        with self.assertNumQueries(1):
+            self.assertEqual(distribution(), [
+                (self.answer.pk, True, 0), (wrong.pk, False, 1)])
+        self.assertTrue(session.record_guess(self.question.pk, other.pk,
+                                             self.answer.pk))
+        self.assertFalse(session.record_guess(self.question.pk, other.pk,
+                                              self.answer.pk))
+        with self.assertNumQueries(0):
+            self.assertEqual(distribution(), [
+                (self.answer.pk, True, 1), (wrong.pk, False, 1)])
+
+    def test07_snapshot(self):
+        "el cuestionario se compila una vez por version"
+        self.questionnaire.refresh_from_db()
+        snapshot = compile_questionnaire(self.questionnaire)
+        self.assertEqual([question.id for question in snapshot],
+                         [question.id for question in self.questions])
+        self.assertEqual(snapshot[0].answers, (
+            (self.answer.id, 'a', True),))
+        self.assertEqual(str(snapshot[0].answers[0]), 'a')
+        with self.assertNumQueries(0):
+            self.assertIs(compile_questionnaire(self.questionnaire),
+                          snapshot)
+
+        self.answer.answer = 'otra'
+        self.answer.save()
+        self.questionnaire.refresh_from_db()
+        updated = compile_questionnaire(self.questionnaire)
+        self.assertGreater(updated.version, snapshot.version)
+        self.assertEqual(str(updated[0].answers[0]), 'otra')
+
+        session = sessions.get(self.game.publicId)
+        with self.assertNumQueries(0):
+            self.assertEqual(session.answers(self.question.id),
+                             updated[0].answers)
+            self.assertEqual(session.question_value, 5)
+
+    def test08_queries_without_lock(self):
+        "el punto de control y los contadores se consultan sin el cerrojo "
+        "de la sesion"
+        session = sessions.get(self.game.publicId)
+        locked = []
+
+        def check_lock(execute, sql, params, many, context):
+            locked.append(session.lock._is_owned())
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(check_lock):
+            session.advance()
+            ingestor.submit(session, self.participant.uuidP, 0)
+            session.distribution(self.question.pk)
+            session.advance()
+        self.assertTrue(locked)
+        self.assertFalse(any(locked))
+        self.assertEqual(session.distribution(self.question.pk)[0][1], 1)
@@ -0,0 +1,201 @@
+import os
+import socket
+import tempfile
+import threading
+from unittest import mock
+
+from django.test import TestCase
+
+from models.constants import WAITING, QUESTION, ANSWER
+from models.models import Participant
+from services.engine import GameSession, QUESTION_TEMPLATE, sessions
+from services.events import (RESYNC_EVENT, SUBSCRIBE, EventBus, _frame,
+                             bus, publish_state)
+from services.ingestion import ingestor
+
+from .fixtures import GameFixtures
+
+
+class EventBusTests(TestCase):
+    """Bus de eventos de las partidas"""
+
+    def test01_local(self):
+        "los suscriptores reciben los eventos de su partida con su origen"
+        local = EventBus(backend='local')
+        received = []
+        subscription = local.subscribe(1, received.append)
+        local.subscribe(2, received.append)
+        local.publish(1, {'type': 'state', 'state': QUESTION})
+        self.assertEqual(received, [{'type': 'state', 'state': QUESTION,
+                                     'origin': local.origin}])
+        local.unsubscribe(subscription)
+        local.publish(1, {'type': 'state'})
+        self.assertEqual(len(received), 1)
+        self.assertEqual(local.subscribers(1), 0)
+        local.close()
+
+    def test02_unix(self):
+        "el transporte unix reparte los eventos entre procesos"
+        path = os.path.join(tempfile.mkdtemp(), 'events.sock')
+        # cada bus tiene su propia conexion, como dos workers
+        workers = [EventBus(backend='unix', path=path) for _ in range(3)]
+        received = [[] for _ in workers]
+        done = threading.Event()
+
+        def receiver(n):
+            def callback(event):
+                received[n].append(event)
+                if all(received[1:]):
+                    done.set()
+            return callback
+
+        for n, worker in enumerate(workers):
+            worker.subscribe(7, receiver(n))
+        workers[0].publish(7, {'type': 'changed'})
+        self.assertTrue(done.wait(5))
+        for events in received:
+            self.assertEqual(events, [{'type': 'changed',
+                                       'origin': workers[0].origin}])
+        for worker in workers:
+            worker.close()
+
+    def test03_unix_slow_subscriber(self):
+        "un proceso que no lee no frena al resto y pierde la conexion"
+        path = os.path.join(tempfile.mkdtemp(), 'events.sock')
+        workers = [EventBus(backend='unix', path=path) for _ in range(2)]
+        received = threading.Semaphore(0)
+        workers[1].subscribe(7, lambda event: received.release())
+        slow = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        slow.connect(path)
+        slow.sendall(_frame(workers[0].channel(7), SUBSCRIBE))
+        with mock.patch('services.events.MAX_BUFFER', 1 << 16):
+            for _ in range(20):
+                for _ in range(100):
+                    workers[0].publish(7, {'type': 'changed',
+                                           'padding': 'x' * 1000})
+                # el proceso que si lee las recibe todas
+                for _ in range(100):
+                    self.assertTrue(received.acquire(timeout=5))
+        # el concentrador ha cerrado la conexion del proceso lento
+        slow.settimeout(5)
+        while slow.recv(1 << 16):
+            pass
+        slow.close()
+        for worker in workers:
+            worker.close()
+
+    def test04_unix_resync(self):
+        "al reconectar se resincronizan las partidas de todos los procesos"
+        path = os.path.join(tempfile.mkdtemp(), 'events.sock')
+        workers = [EventBus(backend='unix', path=path) for _ in range(2)]
+        received = [[] for _ in workers]
+        done = threading.Event()
+
+        def receiver(n):
+            def callback(event):
+                received[n].append(event)
+                if all(received):
+                    done.set()
+            return callback
+
+        for n, worker in enumerate(workers):
+            worker.subscribe(7, receiver(n))
+        # se corta la conexion del segundo proceso con el concentrador
+        workers[1].transport._sock.shutdown(socket.SHUT_RDWR)
+        self.assertTrue(done.wait(5))
+        for events in received:
+            self.assertEqual(events, [RESYNC_EVENT])
+        for worker in workers:
+            worker.close()
+
+
+class ReplicationTests(GameFixtures, TestCase):
+    """Sesiones de una partida en varios procesos"""
+
+    def setUp(self):
+        super().setUp()
+        self.create_game(question={'value': 3})
+        self.answer = self.answers[0]
+        self.session = sessions.get(self.game.publicId)
+
+    def remote(self, **event):
+        "evento publicado por otro worker"
+        event['origin'] = 'other'
+        sessions._on_event(self.game.publicId, event)
+
+    def test01_remote_events(self):
+        "los eventos de otros workers se aplican sin consultas"
+        participant = Participant(id=99, alias='luis', game=self.game)
+        with self.assertNumQueries(0):
+            self.remote(type='state', state=QUESTION, questionNo=0,
+                        screen=[WAITING, 0], remaining=10)
+            self.remote(type='participant', id=participant.id,
+                        alias=participant.alias, points=0,
+                        uuidP=str(participant.uuidP))
+        self.assertEqual(self.session.state, QUESTION)
+        self.assertFalse(self.session.is_late())
+        self.assertIn(participant.uuidP, self.session.uuids)
+        self.remote(type='guess', question=self.question.id,
+                    participant=participant.id, answer=self.answer.id,
+                    points=3)
+        self.assertEqual(self.session.leaderboard.top(1)[0].points, 3)
+        self.assertEqual(self.session.answer_counts(self.question.id),
+                         {self.answer.id: 1})
+
+    def test02_remote_transition(self):
+        "la recarga del anfitrion en otro worker no vuelve a avanzar"
+        self.remote(type='state', state=ANSWER, questionNo=0,
+                    screen=[QUESTION, 0], remaining=None)
+        self.assertEqual(self.session.screen.template, QUESTION_TEMPLATE)
+        self.assertEqual(self.session.expire('%d-0' % QUESTION),
+                         QUESTION_TEMPLATE)
+        self.assertEqual(self.session.state, ANSWER)
+
+    def test03_own_events(self):
+        "los eventos propios se ignoran y los cambios externos descartan"
+        self.game.state = ANSWER
+        publish_state(self.game, [QUESTION, 0], None)
+        self.assertNotEqual(self.session.state, ANSWER)
+        self.assertEqual(bus.subscribers(self.game.publicId), 1)
+        self.remote(type='changed')
+        self.assertIsNone(sessions.peek(self.game.publicId))
+        self.assertEqual(bus.subscribers(self.game.publicId), 0)
+
+    def test04_ingestion(self):
+        "un participante dado de alta en otro worker puede responder"
+        participant = Participant.objects.create(game=self.game, alias='x')
+        self.session.leaderboard.scores.pop(participant.id)
+        self.session.uuids.pop(participant.uuidP)
+        self.remote(type='participant', id=participant.id, alias='x',
+                    points=0, uuidP=str(participant.uuidP))
+        self.remote(type='state', state=QUESTION, questionNo=0,
+                    screen=[WAITING, 0], remaining=10)
+        ingestor.submit(self.session, participant.uuidP, 0)
+        self.assertEqual(self.session.leaderboard.rank(participant.id), 1)
+
+    def test05_join_while_loading(self):
+        "un participante que se une mientras se carga la sesion no se pierde"
+        sessions.clear()
+        load = GameSession.load
+
+        def load_and_join(publicId):
+            session = load(publicId)
+            self.joined = Participant.objects.create(game=self.game,
+                                                     alias='tarde')
+            return session
+
+        with mock.patch.object(GameSession, 'load', load_and_join):
+            session = sessions.get(self.game.publicId)
+        self.assertIn(self.joined.uuidP, session.uuids)
+        self.assertEqual(sessions._pending, {})
+
+    def test06_resync(self):
+        "tras perder eventos se guarda la sesion y se vuelve a cargar"
+        self.session.advance()
+        self.session.advance()
+        self.assertTrue(self.session.dirty)
+        self.remote(type='resync')
+        self.assertIsNone(sessions.peek(self.game.publicId))
+        self.assertEqual(bus.subscribers(self.game.publicId), 0)
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.state, ANSWER)
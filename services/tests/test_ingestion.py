@@ -0,0 +1,132 @@
+from concurrent.futures import ThreadPoolExecutor
+from unittest import skipIf
+
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+
+from models.constants import QUESTION
+from models.models import Guess, Participant
+from services.engine import sessions
+from services.ingestion import (ASYNC, BATCH, GuessIngestor, GuessRejected,
+                                ingestor)
+
+from .fixtures import GameFixtures
+
+
+class IngestionBase(GameFixtures):
+
+    def createGame(self, participants):
+        self.create_game(answers=('right', 'wrong'), question={'value': 2},
+                         state=QUESTION)
+        self.right, self.wrong = self.answers
+        Participant.objects.bulk_create([
+            Participant(game=self.game, alias='p%d' % n)
+            for n in range(participants)])
+        # sin RETURNING (SQLite) bulk_create no rellena los ids
+        self.participants = list(
+            Participant.objects.filter(game=self.game).order_by('id'))
+        self.session = sessions.get(self.game.publicId)
+
+
+class IngestionTests(IngestionBase, TestCase):
+    """Ingesta de respuestas por lotes"""
+
+    def setUp(self):
+        super().setUp()
+        self.createGame(participants=5)
+
+    def test01_rejected(self):
+        "las respuestas no validas se rechazan sin escribir nada"
+        uuidP = self.participants[0].uuidP
+        ingestor.submit(self.session, uuidP, 0)
+        cases = [
+            (uuidP, 0, 'repeated'),
+            (self.participants[1].uuidP, 5, 'answer'),
+            (Participant(game=self.game).uuidP, 0, 'participant'),
+        ]
+        for uuidP, answer, reason in cases:
+            with self.assertNumQueries(0):
+                with self.assertRaises(GuessRejected) as rejected:
+                    ingestor.submit(self.session, uuidP, answer)
+            self.assertEqual(rejected.exception.reason, reason)
+        self.session.advance()
+        with self.assertRaises(GuessRejected) as rejected:
+            ingestor.submit(self.session, self.participants[1].uuidP, 0)
+        self.assertEqual(rejected.exception.reason, 'state')
+        self.assertEqual(Guess.objects.count(), 1)
+
+    def test02_one_insert_per_batch(self):
+        "un lote se escribe con un INSERT y un UPDATE"
+        buffered = GuessIngestor(durability=ASYNC, max_delay=60)
+        for n, participant in enumerate(self.participants):
+            buffered.submit(self.session, participant.uuidP, n % 2)
+        self.assertEqual(buffered.pending(self.game.publicId), 5)
+        self.assertEqual(Guess.objects.count(), 0)
+
+        with CaptureQueriesContext(connection) as queries:
+            buffered.flush(self.game.publicId)
+        statements = [q['sql'].split()[0] for q in queries.captured_queries]
+        self.assertEqual(statements.count('INSERT'), 1)
+        self.assertEqual(statements.count('UPDATE'), 1)
+        self.assertEqual(Guess.objects.count(), 5)
+        points = sorted(Participant.objects.values_list('points', flat=True))
+        self.assertEqual(points, [0, 0, 2, 2, 2])
+        self.assertEqual(sorted(self.session.scores.values()), points)
+
+    def test03_transition_flushes(self):
+        "al cerrar la pregunta se escriben las respuestas pendientes"
+        with self.settings(GUESS_INGESTION={'DURABILITY': ASYNC,
+                                            'MAX_DELAY': 60}):
+            ingestor.submit(self.session, self.participants[0].uuidP, 0)
+            self.assertEqual(Guess.objects.count(), 0)
+            self.session.advance()
+        self.assertEqual(Guess.objects.count(), 1)
+
+    def test04_repeated_after_reload(self):
+        "la base de datos rechaza la repeticion que la sesion no ve"
+        participant = self.participants[0]
+        ingestor.submit(self.session, participant.uuidP, 0)
+        # sesion recargada a mitad de pregunta: no sabe quien ha respondido
+        sessions.clear()
+        session = sessions.get(self.game.publicId)
+        with self.assertRaises(GuessRejected) as rejected:
+            ingestor.submit(session, participant.uuidP, 0)
+        self.assertEqual(rejected.exception.reason, 'repeated')
+        self.assertEqual(Guess.objects.count(), 1)
+        participant.refresh_from_db()
+        self.assertEqual(participant.points, 2)
+        self.assertEqual(session.scores[participant.id], 2)
+        self.assertEqual(session.answer_counts(self.question.id),
+                         {self.right.id: 1})
+        # ya cuenta como respondido: no se vuelve a intentar escribir
+        with self.assertNumQueries(0):
+            with self.assertRaises(GuessRejected):
+                ingestor.submit(session, participant.uuidP, 1)
+
+
+@skipIf(connection.vendor == 'sqlite',
+        'SQLite en memoria no admite escrituras concurrentes')
+class GroupCommitTests(IngestionBase, TransactionTestCase):
+    """Respuestas concurrentes confirmadas en lotes compartidos"""
+
+    PARTICIPANTS = 300
+
+    def test01_concurrent_batch(self):
+        "todas las respuestas concurrentes se escriben una vez"
+        self.createGame(participants=self.PARTICIPANTS)
+        grouped = GuessIngestor(durability=BATCH, max_batch=50,
+                                max_delay=0.05)
+
+        def submit(participant):
+            try:
+                grouped.submit(self.session, participant.uuidP, 0)
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            list(executor.map(submit, self.participants))
+
+        self.assertEqual(Guess.objects.count(), self.PARTICIPANTS)
+        self.assertEqual(
+            set(Participant.objects.values_list('points', flat=True)), {2})
@@ -0,0 +1,97 @@
+from unittest import mock
+
+from django.test import TestCase
+from django.urls import reverse
+
+from models.constants import QUESTION
+from models.models import Participant
+from services.engine import sessions
+from services.ingestion import ingestor
+from services.leaderboard import Entry, Leaderboard
+
+from .fixtures import GameFixtures
+
+
+class LeaderboardTests(TestCase):
+    """Tests de la clasificacion incremental"""
+
+    def test01_ranks(self):
+        "los empates comparten posicion y se ordenan por llegada"
+        leaderboard = Leaderboard([(1, 'a', 0), (2, 'b', 5), (3, 'c', 5)])
+        leaderboard.add(4, 'd')
+        self.assertEqual(leaderboard.top(), [
+            Entry(1, 2, 'b', 5), Entry(1, 3, 'c', 5),
+            Entry(3, 1, 'a', 0), Entry(3, 4, 'd', 0)])
+        leaderboard.add_points(4, 7)
+        leaderboard.add_points(1, 1)
+        self.assertEqual(leaderboard.rank(4), 1)
+        self.assertEqual(leaderboard.rank(2), 2)
+        self.assertEqual(leaderboard.rank(1), 4)
+        self.assertEqual([entry.id for entry in leaderboard.top(2)], [4, 2])
+        self.assertIsNone(leaderboard.rank(99))
+        self.assertEqual(len(leaderboard), 4)
+
+    def test02_matches_sort(self):
+        "el orden incremental coincide con ordenar todos los puntos"
+        leaderboard = Leaderboard((n, str(n), 0) for n in range(200))
+        for n in range(1000):
+            leaderboard.add_points(n * 7 % 200, n % 13)
+        expected = sorted(leaderboard.scores.items(),
+                          key=lambda item: (-item[1], item[0]))
+        self.assertEqual([(entry.id, entry.points)
+                          for entry in leaderboard.top(200)], expected)
+
+
+class LeaderboardGameTests(GameFixtures, TestCase):
+    """Clasificacion de una partida en el motor y en la API"""
+
+    def setUp(self):
+        super().setUp()
+        self.create_game(answers=('right', 'wrong'), question={'value': 3},
+                         state=QUESTION)
+        self.participants = [
+            Participant.objects.create(game=self.game, alias='p%d' % n)
+            for n in range(3)]
+        self.session = sessions.get(self.game.publicId)
+
+    def test01_guesses_update_ranks(self):
+        "las respuestas y las altas actualizan la clasificacion"
+        ingestor.submit(self.session, self.participants[2].uuidP, 0)
+        late = Participant.objects.create(game=self.game, alias='late')
+        top = self.session.leaderboard.top()
+        self.assertEqual([entry.alias for entry in top],
+                         ['p2', 'p0', 'p1', 'late'])
+        self.assertEqual(top[0].points, 3)
+        self.assertEqual(self.session.leaderboard.rank(late.id), 2)
+
+    def test02_api(self):
+        "la API devuelve el podio y la posicion sin consultar la base"
+        ingestor.submit(self.session, self.participants[1].uuidP, 0)
+        url = reverse('game-leaderboard', args=[self.game.publicId])
+        with self.assertNumQueries(0):
+            response = self.client.get(url, {
+                'top': 1, 'uuidp': str(self.participants[0].uuidP)})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['participants'], 3)
+        self.assertEqual(response.data['top'], [
+            {'rank': 1, 'id': self.participants[1].id, 'alias': 'p1',
+             'points': 3}])
+        self.assertEqual(response.data['participant']['rank'], 2)
+
+        response = self.client.get(url, {'uuidp': 'nope'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(
+            url, {'uuidp': str(Participant(game=self.game).uuidP)})
+        self.assertEqual(response.status_code, 404)
+
+    def test03_api_top(self):
+        "el podio esta acotado por arriba y no admite tamaños negativos"
+        url = reverse('game-leaderboard', args=[self.game.publicId])
+        response = self.client.get(url, {'top': 0})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['top'], [])
+        response = self.client.get(url, {'top': -1})
+        self.assertEqual(response.status_code, 400)
+        with mock.patch('restServer.views.LEADERBOARD_MAX_SIZE', 2):
+            response = self.client.get(url, {'top': 50})
+        self.assertEqual(len(response.data['top']), 2)
@@ -0,0 +1,96 @@
+import uuid
+
+from django.test import TestCase
+from django.urls import reverse
+
+from models.models import Participant, User
+from services import tokens, views
+from services.engine import sessions
+from services.events import bus
+
+from .fixtures import GameFixtures
+
+
+class LobbyParticipantsTests(GameFixtures, TestCase):
+    """Participantes nuevos de la sala de espera por cursor"""
+
+    def setUp(self):
+        super().setUp()
+        self.create_game(questions=0)
+        self.url = reverse('game-participants', args=[self.game.publicId])
+        self.client.force_login(self.user)
+
+    def get(self, after=None):
+        data = {} if after is None else {'after': after}
+        response = self.client.get(self.url, data)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test01_delta(self):
+        "solo los que se han unido despues del cursor, con el total"
+        first = Participant.objects.create(game=self.game, alias='p1')
+        data = self.get()
+        self.assertEqual(data['participants'],
+                         [{'id': first.id, 'alias': 'p1'}])
+        self.assertEqual(data['total'], 1)
+        self.assertEqual(data['cursor'], first.id)
+        self.assertFalse(data['more'])
+        second = Participant.objects.create(game=self.game, alias='p2')
+        data = self.get(data['cursor'])
+        self.assertEqual(data['participants'],
+                         [{'id': second.id, 'alias': 'p2'}])
+        self.assertEqual(data['total'], 2)
+        data = self.get(data['cursor'])
+        self.assertEqual(data['participants'], [])
+        self.assertEqual(data['cursor'], second.id)
+
+    def test02_pages(self):
+        "como mucho LOBBY_PAGE participantes por peticion"
+        Participant.objects.bulk_create(
+            Participant(game=self.game, alias='p%d' % i)
+            for i in range(views.LOBBY_PAGE + 1))
+        data = self.get()
+        self.assertEqual(len(data['participants']), views.LOBBY_PAGE)
+        self.assertTrue(data['more'])
+        data = self.get(data['cursor'])
+        self.assertEqual(len(data['participants']), 1)
+        self.assertFalse(data['more'])
+        self.assertEqual(data['total'], views.LOBBY_PAGE + 1)
+
+    def test03_out_of_order(self):
+        "un evento que llega desordenado queda en su lugar por id"
+        session = sessions.get(self.game.publicId)
+        for participant_id in (20, 10, 20):
+            bus.publish(self.game.publicId, {
+                'type': 'participant', 'id': participant_id,
+                'alias': 'p%d' % participant_id, 'points': 0,
+                'uuidP': str(uuid.uuid4())})
+        self.assertEqual(session.joined_after(0, 10),
+                         ([(10, 'p10'), (20, 'p20')], 2))
+        self.assertEqual(session.joined_after(10, 10), ([(20, 'p20')], 2))
+
+    def test04_invalid(self):
+        "cursor no valido, partida inexistente y sin sesion iniciada"
+        response = self.client.get(self.url, {'after': 'x'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(reverse(
+            'game-participants', args=[self.game.publicId + 1]))
+        self.assertEqual(response.status_code, 404)
+        self.client.logout()
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 302)
+
+    def test05_host_only(self):
+        "otro usuario no ve los alias salvo con el token de anfitrion"
+        other = User.objects.create_user(username='b', password='b')
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+        self.client.cookies[tokens.HOST_TOKEN_COOKIE] = tokens.issue(
+            self.game.publicId + 1, tokens.HOST)
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+        self.client.cookies[tokens.HOST_TOKEN_COOKIE] = tokens.issue(
+            self.game.publicId, tokens.PARTICIPANT, uuid.uuid4())
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+        self.client.cookies[tokens.HOST_TOKEN_COOKIE] = tokens.issue(
+            self.game.publicId, tokens.HOST)
+        self.assertEqual(self.get()['total'], 0)
@@ -0,0 +1,107 @@
+from asgiref.sync import async_to_sync
+from django.test import AsyncClient, TestCase, override_settings
+from django.urls import reverse
+
+from models.constants import QUESTION
+from models.models import Participant, User
+from services.engine import sessions
+from services.ingestion import GuessRejected, ingestor
+from services.metrics import Metrics, metrics
+
+from .fixtures import GameFixtures
+
+
+class MetricsTests(GameFixtures, TestCase):
+    """Metricas de las peticiones y del juego"""
+
+    def setUp(self):
+        super().setUp()
+        metrics.clear()
+        self.create_game(state=QUESTION)
+        self.admin = User.objects.create_user(username='admin',
+                                              password='admin',
+                                              is_staff=True)
+
+    def test01_render(self):
+        "histogramas acumulados en formato Prometheus"
+        registry = Metrics()
+        registry.record_request('home', 'GET', 200, 0.02, 3, 0.004, 1000)
+        registry.record_request('home', 'GET', 200, 2, 3, 0.001, None)
+        registry.inc('guesses_rejected_total', reason='late')
+        text = registry.render([('games', 'Games.', [((), 2)])])
+        self.assertIn('kahootclone_http_requests_total'
+                      '{method="GET",view="home",status="200"} 2', text)
+        self.assertIn('kahootclone_http_request_duration_seconds_bucket'
+                      '{method="GET",view="home",le="0.01"} 0', text)
+        self.assertIn('kahootclone_http_request_duration_seconds_bucket'
+                      '{method="GET",view="home",le="0.025"} 1', text)
+        self.assertIn('kahootclone_http_request_duration_seconds_bucket'
+                      '{method="GET",view="home",le="+Inf"} 2', text)
+        self.assertIn('kahootclone_http_request_queries_sum'
+                      '{method="GET",view="home"} 6', text)
+        # la respuesta sin tamaño (streaming) no cuenta en el histograma
+        self.assertIn('kahootclone_http_response_bytes_count'
+                      '{method="GET",view="home"} 1', text)
+        self.assertIn('kahootclone_guesses_rejected_total'
+                      '{reason="late"} 1', text)
+        self.assertIn('# TYPE kahootclone_games gauge\n'
+                      'kahootclone_games 2', text)
+
+    def test02_middleware(self):
+        "el middleware agrega por nombre de URL, con las consultas"
+        self.client.force_login(self.user)
+        self.client.get(reverse('questionnaire-list'))
+        self.client.get('/services/does-not-exist')
+        labels = (('method', 'GET'), ('view', 'questionnaire-list'))
+        histogram = metrics.histograms['http_request_queries'][labels]
+        self.assertEqual(sum(histogram.counts), 1)
+        self.assertGreater(histogram.sum, 0)
+        self.assertEqual(metrics.counters['http_requests_total'][
+            (('method', 'GET'), ('view', 'unmatched'), ('status', '404'))],
+            1)
+
+    def test03_game_counters(self):
+        "uniones y respuestas aceptadas y rechazadas"
+        participant = Participant.objects.create(game=self.game,
+                                                 alias='pepe')
+        session = sessions.get(self.game.publicId)
+        ingestor.submit(session, participant.uuidP, 0)
+        with self.assertRaises(GuessRejected):
+            ingestor.submit(session, participant.uuidP, 0)
+        self.assertEqual(metrics.counters['joins_total'][()], 1)
+        self.assertEqual(metrics.counters['guesses_total'][()], 1)
+        self.assertEqual(metrics.counters['guesses_rejected_total'][
+            (('reason', 'repeated'),)], 1)
+
+    def test04_endpoint(self):
+        "solo administradores o el token de Prometheus"
+        url = reverse('metrics')
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.client.force_login(self.admin)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertIn('kahootclone_games{state="%d"} 1' % QUESTION,
+                      response.content.decode())
+        self.client.logout()
+        with override_settings(GAME_METRICS={'TOKEN': 'secret'}):
+            self.assertEqual(self.client.get(
+                url, HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+            self.assertEqual(self.client.get(
+                url, HTTP_AUTHORIZATION='Bearer other').status_code, 403)
+
+    def test05_asgi_sync_view(self):
+        "bajo ASGI tambien se cuentan las consultas de las vistas sincronas"
+        self.client.force_login(self.user)
+        client = AsyncClient()
+        client.cookies = self.client.cookies
+
+        async def get(path):
+            return await client.get(path)
+
+        async_to_sync(get)(reverse('questionnaire-list'))
+        labels = (('method', 'GET'), ('view', 'questionnaire-list'))
+        histogram = metrics.histograms['http_request_queries'][labels]
+        self.assertEqual(sum(histogram.counts), 1)
+        self.assertGreater(histogram.sum, 0)
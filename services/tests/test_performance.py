@@ -0,0 +1,205 @@
+"""
+Presupuestos de consultas de las vistas y de la API.
+
+Cada comprobacion ejecuta una peticion sobre una partida grande (1000
+participantes y un cuestionario de 50 preguntas), cuenta sus consultas y
+falla si superan el presupuesto: un N+1 con estos tamaños supera cualquier
+presupuesto en cientos de consultas. Con ``PERF_REPORT=<fichero>`` se
+guardan ademas las consultas y los tiempos de cada comprobacion en JSON.
+"""
+import json
+import os
+import time
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from models.constants import WAITING, QUESTION, ANSWER, LEADERBOARD
+from models.models import (Answer, Game, Guess, Participant, Question,
+                           Questionnaire, User)
+from services.engine import sessions
+
+PARTICIPANTS = 1000
+QUESTIONS = 50
+ANSWERS = 4
+QUESTIONNAIRES = 20
+
+
+class QueryBudgetTestCase(TestCase):
+    """
+    Base de las comprobaciones de presupuesto de consultas.
+
+    ``setUpTestData`` crea el cuestionario grande (``self.questionnaire``),
+    otros cuestionarios del mismo usuario y una partida con todos los
+    participantes y sus respuestas a la ultima pregunta (``self.game``).
+    """
+    report = {}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='perf', password='perf')
+        for n in range(QUESTIONNAIRES - 1):
+            Questionnaire.objects.create(title='questionnaire %d' % n,
+                                         user=cls.user)
+        cls.questionnaire = Questionnaire.objects.create(
+            title='large', user=cls.user, question_count=QUESTIONS)
+        # sin RETURNING (SQLite) bulk_create no rellena los ids, asi que
+        # cada nivel se vuelve a leer antes de crear el siguiente
+        Question.objects.bulk_create([
+            Question(question='question %d' % n, position=n,
+                     questionnaire=cls.questionnaire)
+            for n in range(QUESTIONS)])
+        questions = list(Question.objects.filter(
+            questionnaire=cls.questionnaire).order_by('position'))
+        Answer.objects.bulk_create([
+            Answer(answer='answer %d' % i, question=question,
+                   correct=(i == 0))
+            for question in questions for i in range(ANSWERS)])
+        cls.question = questions[-1]
+        answers = list(cls.question.answer_set.order_by('id'))
+        cls.game = Game.objects.create(questionnaire=cls.questionnaire)
+        Participant.objects.bulk_create([
+            Participant(game=cls.game, alias='player %d' % n)
+            for n in range(PARTICIPANTS)])
+        participants = list(
+            Participant.objects.filter(game=cls.game).order_by('id'))
+        Guess.objects.bulk_create([
+            Guess(participant=participant, game=cls.game,
+                  question=cls.question,
+                  answer=answers[participant.id % ANSWERS])
+            for participant in participants])
+        cls.participant = participants[0]
+
+    def setUp(self):
+        sessions.clear()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        path = os.environ.get('PERF_REPORT')
+        if path and cls.report:
+            report = {}
+            if os.path.exists(path):
+                with open(path) as previous:
+                    report = json.load(previous)
+            report.update(cls.report)
+            with open(path, 'w') as output:
+                json.dump(report, output, indent=2, sort_keys=True)
+
+    def assertQueryBudget(self, name, budget, request):
+        """
+        Ejecuta ``request()`` y comprueba que no pasa de ``budget``
+        consultas.
+
+        :param name: Nombre de la comprobacion en el informe
+        :param budget: Numero maximo de consultas
+        :param request: Funcion sin argumentos que hace la peticion
+
+        :return: Lo que devuelva ``request``
+        """
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            result = request()
+            elapsed = time.perf_counter() - start
+        type(self).report[name] = {
+            'queries': len(queries),
+            'budget': budget,
+            'ms': round(elapsed * 1000, 3),
+        }
+        self.assertLessEqual(
+            len(queries), budget, '%s: %d queries, budget %d\n%s' % (
+                name, len(queries), budget, '\n'.join(
+                    query['sql'] for query in queries.captured_queries)))
+        return result
+
+
+class ViewBudgetTests(QueryBudgetTestCase):
+    """Presupuestos de consultas de las vistas de ``services``"""
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+
+    def get(self, name, budget, url):
+        response = self.assertQueryBudget(name, budget,
+                                          lambda: self.client.get(url))
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test01_home(self):
+        "inicio con los ultimos cuestionarios"
+        self.get('home', 3, reverse('home'))
+
+    def test02_questionnaire_list(self):
+        "lista de cuestionarios"
+        self.get('questionnaire-list', 3, reverse('questionnaire-list'))
+
+    def test03_questionnaire_detail(self):
+        "cuestionario con 50 preguntas y sus respuestas"
+        self.get('questionnaire-detail', 5, reverse(
+            'questionnaire-detail', args=[self.questionnaire.id]))
+
+    def test04_game_create(self):
+        "crear una partida del cuestionario grande"
+        # la sesion de Django se guarda dentro de un SAVEPOINT
+        self.get('game-create', 14, reverse(
+            'game-create', args=[self.questionnaire.id]))
+
+    def test05_update_participant(self):
+        "sala de espera con 1000 participantes"
+        session = self.client.session
+        session['gameID'] = self.game.publicId
+        session.save()
+        self.get('game-updateparticipant', 3,
+                 reverse('game-updateparticipant'))
+
+    def test06_count_down(self):
+        "cada estado de la partida, de la cuenta atras al podio"
+        session = self.client.session
+        session['gameID'] = self.game.publicId
+        session.save()
+        url = reverse('game-count-down')
+        # la primera peticion carga la sesion de la partida
+        self.get('game-count-down load', 10, url)
+        states = {QUESTION: 'question', ANSWER: 'answer',
+                  LEADERBOARD: 'leaderboard'}
+        seen = set()
+        while True:
+            state = sessions.get(self.game.publicId).state
+            # sesion, usuario y guardado de ``game_state`` (con SAVEPOINT)
+            budget = 5
+            if state == ANSWER:
+                # reparto de respuestas (GROUP BY) y paso a la siguiente
+                # pregunta (UPDATE de la partida)
+                budget = 7
+            self.get('game-count-down %s' % states[state], budget, url)
+            if state == LEADERBOARD:
+                break
+            seen.add(state)
+        self.assertEqual(seen, {QUESTION, ANSWER})
+        self.assertNotEqual(state, WAITING)
+
+    def test07_lobby_participants(self):
+        "sondeo de la sala de espera con 1000 participantes"
+        url = reverse('game-participants', args=[self.game.publicId])
+        data = self.get('game-participants load', 6, url).json()
+        while data['more']:
+            # sesion de Django y usuario
+            data = self.get('game-participants', 2, '%s?after=%d' % (
+                url, data['cursor'])).json()
+        self.assertEqual(data['total'], PARTICIPANTS)
+        data = self.get('game-participants idle', 2, '%s?after=%d' % (
+            url, data['cursor'])).json()
+        self.assertEqual(data['participants'], [])
+
+    def test08_game_state(self):
+        "sondeo del estado de la partida: sin consultas con la sesion cargada"
+        url = reverse('game-state', args=[self.game.publicId])
+        response = self.get('game-state load', 4, url)
+        self.get('game-state', 0, url)
+        response = self.assertQueryBudget(
+            'game-state not modified', 0, lambda: self.client.get(
+                url, HTTP_IF_NONE_MATCH=response['ETag']))
+        self.assertEqual(response.status_code, 304)
@@ -0,0 +1,135 @@
+import os
+import shutil
+import tempfile
+
+from asgiref.sync import async_to_sync
+from django.test import AsyncClient, TestCase, override_settings
+from django.urls import reverse
+
+from models.models import User
+from services import profiling
+
+
+class ProfilingTests(TestCase):
+    """Perfilado bajo demanda de peticiones"""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        settings = override_settings(GAME_PROFILING={
+            'PATH': self.path, 'MAX_PROFILES': 3})
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.addCleanup(profiling.toggle.disable)
+        self.user = User.objects.create_user(username='a', password='a')
+        self.admin = User.objects.create_user(username='admin',
+                                              password='admin',
+                                              is_staff=True)
+        self.client.force_login(self.user)
+
+    def test01_header(self):
+        "solo la cabecera con firma valida perfila la peticion"
+        url = reverse('questionnaire-list')
+        self.client.get(url)
+        self.client.get(url, HTTP_X_PROFILE='forged')
+        self.assertEqual(profiling.profile_ids(), [])
+        self.client.get(url, HTTP_X_PROFILE=profiling.sign())
+        ids = profiling.profile_ids()
+        self.assertEqual(len(ids), 1)
+        profile = profiling.load(ids[0])
+        self.assertEqual(profile['view'], 'questionnaire-list')
+        self.assertEqual(profile['trigger'], 'header')
+        self.assertTrue(profile['queries'])
+        stats = profiling.load_stats(ids[0])
+        stacks = profiling.collapsed_stacks(stats)
+        self.assertTrue(stacks)
+        for line in stacks:
+            stack, _, microseconds = line.rpartition(' ')
+            self.assertTrue(stack)
+            self.assertGreater(int(microseconds), 0)
+
+    def test02_ring(self):
+        "solo se conservan los MAX_PROFILES perfiles mas recientes"
+        url = reverse('questionnaire-list')
+        for _ in range(5):
+            self.client.get(url, HTTP_X_PROFILE=profiling.sign())
+        self.assertEqual(len(profiling.profile_ids()), 3)
+        self.assertEqual(len([name for name in os.listdir(self.path)
+                              if name.endswith('.pstats')]), 3)
+
+    def test03_toggle(self):
+        "el muestreo activado perfila las vistas elegidas"
+        with override_settings(GAME_PROFILING={
+                'PATH': self.path, 'VIEWS': ['home']}):
+            profiling.toggle.enable(1, 1.0)
+            self.client.get(reverse('questionnaire-list'))
+            self.assertEqual(profiling.profile_ids(), [])
+            self.client.get(reverse('home'))
+            self.assertEqual(len(profiling.profile_ids()), 1)
+            profiling.toggle.disable()
+            self.client.get(reverse('home'))
+            self.assertEqual(len(profiling.profile_ids()), 1)
+
+    def test04_pages(self):
+        "paginas de perfiles solo para administradores"
+        self.client.get(reverse('home'), HTTP_X_PROFILE=profiling.sign())
+        profile_id = profiling.profile_ids()[0]
+        self.assertEqual(
+            self.client.get(reverse('profile-list')).status_code, 403)
+        self.client.force_login(self.admin)
+        response = self.client.get(reverse('profile-list'))
+        self.assertContains(response, profile_id)
+        response = self.client.get(reverse('profile-detail',
+                                           args=[profile_id]))
+        self.assertContains(response, 'cumulative')
+        response = self.client.get(reverse('profile-export',
+                                           args=[profile_id, 'folded']))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('attachment', response['Content-Disposition'])
+        self.assertEqual(self.client.get(reverse(
+            'profile-detail', args=['..etc'])).status_code, 404)
+        self.client.post(reverse('profile-list'),
+                         {'action': 'enable', 'minutes': 5, 'rate': 0.5})
+        self.assertEqual(profiling.toggle.state()['rate'], 0.5)
+        self.client.post(reverse('profile-list'), {'action': 'disable'})
+        self.assertEqual(profiling.toggle.state()['rate'], 0)
+
+    def test05_toggle_views(self):
+        "al activarlo se eligen las vistas y se rechazan las que no existen"
+        self.client.force_login(self.admin)
+        response = self.client.post(reverse('profile-list'), {
+            'action': 'enable', 'minutes': 5, 'rate': 1,
+            'views': 'home, nonexistent'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(profiling.toggle.state()['rate'], 0)
+        self.client.post(reverse('profile-list'), {
+            'action': 'enable', 'minutes': 5, 'rate': 1,
+            'views': 'home admin:index'})
+        self.assertEqual(profiling.toggle.state()['views'],
+                         ('home', 'admin:index'))
+        self.client.get(reverse('questionnaire-list'))
+        self.assertEqual(profiling.profile_ids(), [])
+        self.client.get(reverse('home'))
+        self.assertEqual(len(profiling.profile_ids()), 1)
+
+    def test06_asgi(self):
+        "bajo ASGI se perfilan las vistas sincronas, con su SQL"
+        client = AsyncClient()
+        client.cookies = self.client.cookies
+
+        async def get(path, **headers):
+            return await client.get(path, **headers)
+
+        # el AsyncClient de Django 3.2 recibe las cabeceras por su nombre
+        response = async_to_sync(get)(reverse('questionnaire-list'),
+                                      **{'X-Profile': profiling.sign()})
+        self.assertEqual(response.status_code, 200)
+        ids = profiling.profile_ids()
+        self.assertEqual(len(ids), 1)
+        profile = profiling.load(ids[0])
+        self.assertEqual(profile['view'], 'questionnaire-list')
+        self.assertTrue(profile['queries'])
+        # la vista se ha ejecutado en el hilo perfilado
+        stacks = profiling.collapsed_stacks(profiling.load_stats(ids[0]))
+        self.assertTrue(any('views/generic/list.py' in line
+                            for line in stacks))
@@ -0,0 +1,135 @@
+import json
+
+from asgiref.sync import async_to_sync, sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from django.test import TestCase
+
+from models.constants import QUESTION
+from models.models import Guess, Participant
+from services import tokens
+from services.events import publish_state
+from services.realtime import channels, websocket_application
+
+from .fixtures import GameFixtures
+
+
+class RealtimeTests(GameFixtures, TestCase):
+    """Tests del canal WebSocket de las partidas"""
+
+    def setUp(self):
+        super().setUp()
+        self.create_game()
+        self.answer = self.answers[0]
+        Participant.objects.create(game=self.game, alias='pepe')
+
+    def communicator(self, path, cookies=None):
+        if cookies is None:
+            # por defecto, el anfitrion con su token
+            cookies = {tokens.HOST_TOKEN_COOKIE: tokens.issue(
+                self.game.publicId, tokens.HOST)}
+        cookie = '; '.join('%s=%s' % item for item in cookies.items())
+        scope = {'type': 'websocket', 'path': path,
+                 'headers': [(b'cookie', cookie.encode())]}
+        return ApplicationCommunicator(websocket_application, scope)
+
+    async def receive_json(self, communicator):
+        message = await communicator.receive_output(1)
+        self.assertEqual(message['type'], 'websocket.send')
+        return json.loads(message['text'])
+
+    def test01_unknown_game(self):
+        "conexion rechazada si la partida no existe"
+        async def scenario():
+            communicator = self.communicator('/ws/game/0/')
+            await communicator.send_input({'type': 'websocket.connect'})
+            message = await communicator.receive_output(1)
+            self.assertEqual(message['type'], 'websocket.close')
+        async_to_sync(scenario)()
+
+    def test02_push_events(self):
+        "snapshot inicial y eventos de cambio de estado"
+        async def scenario():
+            path = '/ws/game/%d/' % self.game.publicId
+            communicator = self.communicator(path)
+            await communicator.send_input({'type': 'websocket.connect'})
+            message = await communicator.receive_output(1)
+            self.assertEqual(message['type'], 'websocket.accept')
+
+            snapshot = await self.receive_json(communicator)
+            self.assertEqual(snapshot['type'], 'snapshot')
+            self.assertEqual(snapshot['participants'], ['pepe'])
+            self.assertEqual(channels.subscribers(self.game.publicId), 1)
+
+            self.game.state = QUESTION
+            publish_state(self.game)
+            event = await self.receive_json(communicator)
+            self.assertEqual(event, {'type': 'state', 'state': QUESTION,
+                                     'questionNo': 0})
+
+            await communicator.send_input({'type': 'websocket.disconnect'})
+            await communicator.wait(1)
+            self.assertEqual(channels.subscribers(self.game.publicId), 0)
+        async_to_sync(scenario)()
+
+    def test03_signals(self):
+        "las altas de participantes y respuestas se publican"
+        async def scenario():
+            path = '/ws/game/%d/' % self.game.publicId
+            communicator = self.communicator(path)
+            await communicator.send_input({'type': 'websocket.connect'})
+            await communicator.receive_output(1)
+            await self.receive_json(communicator)
+
+            participant = await self.create_participant()
+            event = await self.receive_json(communicator)
+            self.assertEqual(event['type'], 'participant')
+            self.assertEqual(event['alias'], 'luis')
+
+            await self.create_guess(participant)
+            event = await self.receive_json(communicator)
+            self.assertEqual(event, {'type': 'guess',
+                                     'question': self.question.id})
+
+            await communicator.send_input({'type': 'websocket.disconnect'})
+            await communicator.wait(1)
+        async_to_sync(scenario)()
+
+    def test04_aliases_host_only(self):
+        "solo el anfitrion o el propietario reciben los alias"
+        self.client.force_login(self.user)
+        owner = {'sessionid': self.client.cookies['sessionid'].value}
+
+        async def scenario():
+            path = '/ws/game/%d/' % self.game.publicId
+            player = self.communicator(path, {})
+            await player.send_input({'type': 'websocket.connect'})
+            await player.receive_output(1)
+            snapshot = await self.receive_json(player)
+            self.assertNotIn('participants', snapshot)
+            host = self.communicator(path, owner)
+            await host.send_input({'type': 'websocket.connect'})
+            await host.receive_output(1)
+            snapshot = await self.receive_json(host)
+            self.assertEqual(snapshot['participants'], ['pepe'])
+
+            participant = await self.create_participant()
+            self.assertEqual(await self.receive_json(player),
+                             {'type': 'participant', 'id': participant.id})
+            self.assertEqual(await self.receive_json(host),
+                             {'type': 'participant', 'id': participant.id,
+                              'alias': 'luis'})
+
+            for communicator in (player, host):
+                await communicator.send_input(
+                    {'type': 'websocket.disconnect'})
+                await communicator.wait(1)
+        async_to_sync(scenario)()
+
+    async def create_participant(self):
+        return await sync_to_async(Participant.objects.create)(
+            game=self.game, alias='luis')
+
+    async def create_guess(self, participant):
+        return await sync_to_async(Guess.objects.create)(
+            participant=participant, game=self.game,
+            question=self.question, answer=self.answer)
@@ -0,0 +1,244 @@
+import asyncio
+import gzip
+import json
+import threading
+import time
+import uuid
+from unittest import mock
+
+import brotli
+
+from django.conf import settings
+from django.test import AsyncClient, TestCase
+from django.urls import reverse
+from django.utils.module_loading import import_string
+
+from models.constants import ANSWER, LEADERBOARD, QUESTION, WAITING
+from models.models import Participant, Question
+from services import responses, tokens
+from services.engine import sessions
+from services.events import bus
+
+from .fixtures import GameFixtures
+
+
+class GameStateTests(GameFixtures, TestCase):
+    """Estado de la partida en JSON con ETag"""
+
+    def setUp(self):
+        super().setUp()
+        self.create_game(questions=2, question={'answerTime': 30},
+                         countdownTime=5)
+        self.url = reverse('game-state', args=[self.game.publicId])
+
+    def get(self, etag=None):
+        if etag is None:
+            return self.client.get(self.url)
+        return self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+
+    def test01_state(self):
+        "estado compacto con la version como ETag"
+        Participant.objects.create(game=self.game, alias='p')
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['publicId'], self.game.publicId)
+        self.assertEqual(data['state'], WAITING)
+        self.assertEqual(data['questionNo'], 0)
+        self.assertEqual(data['questions'], 2)
+        self.assertEqual(data['participants'], 1)
+        self.assertIsNone(data['deadline'])
+        self.assertEqual(response['ETag'], '"%d.%d-participant-identity"' % (
+            self.game.pk, data['version']))
+        self.assertIn('no-cache', response['Cache-Control'])
+        for header in ('Accept-Encoding', 'Cookie', 'Authorization'):
+            self.assertIn(header, response['Vary'])
+
+    def test02_not_modified(self):
+        "304 sin cuerpo mientras no cambia la partida"
+        etag = self.get()['ETag']
+        response = self.get(etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], etag)
+        Participant.objects.create(game=self.game, alias='p')
+        response = self.get(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test03_version_increases(self):
+        "la version crece con cada transicion hasta el podio"
+        session = sessions.get(self.game.publicId)
+        versions = [session.version]
+        states = [session.state]
+        while session.state != LEADERBOARD:
+            session.advance()
+            versions.append(session.version)
+            states.append(session.state)
+        self.assertEqual(states, [WAITING, QUESTION, ANSWER, QUESTION,
+                                  ANSWER, LEADERBOARD])
+        self.assertEqual(versions, sorted(set(versions)))
+        data = self.get().json()
+        self.assertEqual(data['version'], versions[-1])
+
+    def test04_same_version_after_reload(self):
+        "otro proceso que cargue la partida calcula la misma version"
+        session = sessions.get(self.game.publicId)
+        session.advance()
+        Participant.objects.create(game=self.game, alias='p')
+        etag = self.get()['ETag']
+        self.assertIsNotNone(self.get().json()['deadline'])
+        sessions.clear()
+        self.assertEqual(self.get(etag).status_code, 304)
+
+    def test05_not_found(self):
+        "PIN sin partida"
+        response = self.client.get(reverse(
+            'game-state', args=[self.game.publicId + 1]))
+        self.assertEqual(response.status_code, 404)
+
+    def test06_question(self):
+        "la pregunta en curso; las correctas solo al anfitrion o al final"
+        session = sessions.get(self.game.publicId)
+        self.assertIsNone(self.get().json()['question'])
+        session.advance()
+        question = self.get().json()['question']
+        self.assertEqual(question['question'], 'q0')
+        self.assertEqual(question['answerTime'], 30)
+        self.assertEqual(question['answers'], [
+            {'id': answer.id, 'answer': 'a'}
+            for answer in session.question.answers])
+        etag = self.get()['ETag']
+        self.client.cookies[tokens.HOST_TOKEN_COOKIE] = tokens.issue(
+            self.game.publicId, tokens.HOST)
+        response = self.get()
+        self.assertTrue(response.json()['question']['answers'][0]['correct'])
+        self.assertIn('private', response['Cache-Control'])
+        # la variante del participante no le vale al anfitrion
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(self.get(etag).status_code, 200)
+        del self.client.cookies[tokens.HOST_TOKEN_COOKIE]
+        session.advance()
+        response = self.get()
+        self.assertTrue(response.json()['question']['answers'][0]['correct'])
+        self.assertNotIn('private', response['Cache-Control'])
+
+    def test07_shared_body(self):
+        "el cuerpo de cada version se serializa una sola vez"
+        session = sessions.get(self.game.publicId)
+        session.advance()
+        with mock.patch.object(responses, 'state_payload',
+                               wraps=responses.state_payload) as payload:
+            bodies = {self.get().content for _ in range(3)}
+            self.assertEqual(payload.call_count, 1)
+            self.assertEqual(len(bodies), 1)
+            session.advance()
+            self.get()
+            self.assertEqual(payload.call_count, 2)
+        # solo quedan las variantes de la version actual
+        self.assertEqual(session.responses.version, session.version)
+        self.assertEqual(list(session.responses.bodies),
+                         [(tokens.PARTICIPANT, None)])
+
+    def test08_compressed(self):
+        "variantes gzip y brotli del mismo cuerpo"
+        Question.objects.filter(question='q0').update(question='q' * 250)
+        # los cuerpos pequeños no se comprimen
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(json.loads(response.content)['state'], WAITING)
+        sessions.get(self.game.publicId).advance()
+        plain = self.get()
+        self.assertFalse(plain.has_header('Content-Encoding'))
+        self.assertIn('Accept-Encoding', plain['Vary'])
+        for encoding, decompress in (('gzip', gzip.decompress),
+                                     ('br', brotli.decompress)):
+            response = self.client.get(self.url,
+                                       HTTP_ACCEPT_ENCODING=encoding)
+            self.assertEqual(response['Content-Encoding'], encoding)
+            self.assertNotEqual(response['ETag'], plain['ETag'])
+            self.assertLess(len(response.content), len(plain.content))
+            self.assertEqual(decompress(response.content), plain.content)
+
+
+class GameWaitTests(GameFixtures, TestCase):
+    """Espera al siguiente estado de la partida (long polling)"""
+
+    def setUp(self):
+        super().setUp()
+        self.create_game(questions=0)
+        self.url = reverse('game-wait', args=[self.game.publicId])
+        self.state_url = reverse('game-state', args=[self.game.publicId])
+
+    def join(self, alias):
+        # evento de otro worker: solo cambia la sesion en memoria
+        bus.publish(self.game.publicId, {
+            'type': 'participant', 'id': 1000 + len(alias), 'alias': alias,
+            'points': 0, 'uuidP': str(uuid.uuid4())})
+
+    def test01_without_etag(self):
+        "sin If-None-Match responde en el acto"
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'],
+                         self.client.get(self.state_url)['ETag'])
+
+    def test02_timeout(self):
+        "sin cambios responde 304 al agotarse el plazo"
+        etag = self.client.get(self.state_url)['ETag']
+        start = time.monotonic()
+        response = self.client.get(self.url, {'timeout': 0.2},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        # solo cuenta la version, no la variante del ETag
+        response = self.client.get(self.url, {'timeout': 0.2},
+                                   HTTP_IF_NONE_MATCH='W/' + etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test03_wakes_up(self):
+        "responde en cuanto cambia la version de la partida"
+        etag = self.client.get(self.state_url)['ETag']
+        timer = threading.Timer(0.1, self.join, ['p'])
+        timer.start()
+        start = time.monotonic()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        timer.join()
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['participants'], 1)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test04_invalid_timeout(self):
+        "plazo no valido"
+        for timeout in ('x', '-1', 'nan'):
+            response = self.client.get(self.url, {'timeout': timeout})
+            self.assertEqual(response.status_code, 400)
+
+    async def test05_asgi(self):
+        "bajo ASGI varias peticiones esperan a la vez sin bloquear otras"
+        client = AsyncClient()
+        etag = (await client.get(self.state_url))['ETag']
+        # el AsyncClient de Django 3.2 recibe las cabeceras por su nombre
+        waiting = [asyncio.ensure_future(client.get(
+            self.url, **{'If-None-Match': etag})) for _ in range(3)]
+        await asyncio.sleep(0.1)
+        start = time.monotonic()
+        response = await client.get(self.state_url)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(any(request.done() for request in waiting))
+        self.join('p')
+        responses = await asyncio.wait_for(asyncio.gather(*waiting), 5)
+        self.assertEqual([response.status_code for response in responses],
+                         [200] * 3)
+
+    def test06_async_middleware(self):
+        """
+        todo el middleware admite el modo asincrono: con uno solo sincrono
+        Django 3.2 ejecutaria la cadena de cada peticion, espera incluida,
+        en su unico hilo de codigo sincrono
+        """
+        for path in settings.MIDDLEWARE:
+            self.assertTrue(
+                getattr(import_string(path), 'async_capable', False), path)
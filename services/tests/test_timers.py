@@ -0,0 +1,106 @@
+import threading
+import time
+
+from django.test import TestCase, override_settings
+
+from models.constants import WAITING, QUESTION, ANSWER
+from models.models import Participant
+from services.engine import (COUNTDOWN_TEMPLATE, QUESTION_TEMPLATE,
+                             sessions)
+from services.ingestion import GuessRejected, ingestor
+from services.timers import GameTimers, TimerWheel
+
+from .fixtures import GameFixtures
+
+
+class TimerWheelTests(TestCase):
+    """Rueda de temporizadores jerarquica"""
+
+    def fired(self, wheel, until):
+        "ticks en los que vence cada temporizador hasta ``until``"
+        ticks = {}
+        for tick in range(wheel.now + 1, until + 1):
+            for timer in wheel.advance(tick):
+                ticks[timer.callback()] = tick
+        return ticks
+
+    def test01_expires(self):
+        "cada temporizador vence en su tick, tambien tras repartir niveles"
+        wheel = TimerWheel()
+        expires = [1, 63, 64, 65, 4095, 4096, 4097, 300000]
+        for tick in expires:
+            wheel.schedule(tick, lambda tick=tick: tick)
+        self.assertEqual(len(wheel), len(expires))
+        ticks = self.fired(wheel, 300000)
+        self.assertEqual(ticks, {tick: tick for tick in expires})
+        self.assertEqual(len(wheel), 0)
+
+    def test02_cancel(self):
+        "los temporizadores cancelados no vencen"
+        wheel = TimerWheel(now=100)
+        kept = wheel.schedule(150, lambda: 'kept')
+        wheel.schedule(150, lambda: 'cancelled').cancel()
+        # un plazo ya pasado vence en el siguiente tick
+        wheel.schedule(50, lambda: 'past')
+        self.assertEqual(self.fired(wheel, 200), {'kept': 150, 'past': 101})
+        self.assertFalse(kept.cancelled)
+
+    @override_settings(GAME_TIMERS={'ENABLED': True})
+    def test03_game_timers(self):
+        "el bucle de los temporizadores llama al callback al vencer"
+        timers = GameTimers(tick=0.01, workers=1)
+        fired = threading.Event()
+        start = time.monotonic()
+        timers.schedule(start + 0.05, fired.set)
+        self.assertTrue(fired.wait(5))
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+        self.assertEqual(len(timers), 0)
+
+
+class DeadlineTests(GameFixtures, TestCase):
+    """Plazos de las fases de la partida"""
+
+    def setUp(self):
+        super().setUp()
+        self.create_game(question={'answerTime': 10}, countdownTime=3)
+        self.participant = Participant.objects.create(game=self.game,
+                                                      alias='pepe')
+        self.session = sessions.get(self.game.publicId)
+
+    def test01_expire_once(self):
+        "el temporizador y la recarga del anfitrion no avanzan dos veces"
+        self.session.advance()
+        self.assertEqual(self.session.screen.state, WAITING)
+        phase = self.session.phase
+        self.assertEqual(self.session.expire(phase), QUESTION_TEMPLATE)
+        self.assertEqual(self.session.state, ANSWER)
+        # la segunda llamada con la misma fase solo repite la pantalla
+        self.assertEqual(self.session.expire(phase), QUESTION_TEMPLATE)
+        self.assertEqual(self.session.state, ANSWER)
+        self.assertEqual(self.session.screen.state, QUESTION)
+
+    def test02_late_guess(self):
+        "las respuestas fuera de plazo se rechazan sin consultas"
+        self.assertEqual(self.session.advance(), COUNTDOWN_TEMPLATE)
+        self.assertEqual(self.session.state, QUESTION)
+        self.session.deadline = time.monotonic() - 1
+        with self.assertNumQueries(0):
+            with self.assertRaises(GuessRejected) as rejected:
+                ingestor.submit(self.session, self.participant.uuidP, 0)
+        self.assertEqual(rejected.exception.reason, 'late')
+
+    def test03_view_expired(self):
+        "la recarga con la fase vencida no avanza si ya avanzo el servidor"
+        self.client.force_login(self.game.questionnaire.user)
+        session = self.client.session
+        session['gameID'] = self.game.publicId
+        session.save()
+        response = self.client.get('/services/gamecountdown')
+        self.assertTemplateUsed(response, COUNTDOWN_TEMPLATE)
+        phase = response.context['phase']
+        # vence el plazo en el servidor antes de que recargue el anfitrion
+        self.session.expire(self.session.phase)
+        response = self.client.get('/services/gamecountdown',
+                                   {'expired': phase})
+        self.assertTemplateUsed(response, QUESTION_TEMPLATE)
+        self.assertEqual(self.session.state, ANSWER)
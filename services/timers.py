@@ -0,0 +1,248 @@
+"""
+Plazos de las partidas en el servidor.
+
+Cada fase con tiempo (la cuenta atras y la pregunta) programa un
+temporizador al empezar. Cuando vence, la partida avanza sola aunque el
+anfitrion no recargue la pagina, y las respuestas que lleguen tarde se
+rechazan comparando con el plazo guardado en memoria.
+
+Los temporizadores se guardan en una rueda jerarquica (``TimerWheel``):
+programar y cancelar son O(1) y cada tick solo recorre la ranura que
+vence, de modo que el coste por tick no depende de cuantos plazos haya
+activos. La rueda avanza desde un bucle asyncio en un hilo propio
+(``GameTimers``); los vencimientos, que escriben en la base de datos, se
+ejecutan en un pool de hilos para no retrasar los siguientes ticks.
+
+La configuracion esta en ``settings.GAME_TIMERS``:
+
+- ``ENABLED``: si es False no se programa ningun temporizador.
+- ``TICK``: segundos por tick (resolucion de los plazos).
+- ``WORKERS``: hilos que ejecutan los vencimientos.
+"""
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED': True,
+    'TICK': 0.05,
+    'WORKERS': 4,
+}
+
+# bits de cada nivel de la rueda: 4 niveles de 64 ranuras cubren 2**24
+# ticks (unos 9 dias con ticks de 50 ms)
+LEVEL_BITS = 6
+LEVELS = 4
+
+
+class Timer:
+    """
+    Temporizador programado en una ``TimerWheel``.
+
+    :param expires: Tick en el que vence
+    :param callback: Funcion sin argumentos que se llama al vencer
+    """
+    __slots__ = ('expires', 'callback', 'cancelled')
+
+    def __init__(self, expires, callback):
+        self.expires = expires
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel:
+    """
+    Rueda de temporizadores jerarquica.
+
+    El nivel 0 tiene una ranura por tick; cada ranura del nivel ``n`` cubre
+    una vuelta completa del nivel ``n - 1``. Al completar una vuelta de un
+    nivel, la ranura siguiente del nivel superior se reparte (*cascade*)
+    entre las ranuras del nivel inferior.
+
+    No es segura entre hilos por si misma; ``GameTimers`` la protege con un
+    cerrojo.
+
+    :param now: Tick actual
+    """
+
+    SLOTS = 1 << LEVEL_BITS
+    MASK = SLOTS - 1
+
+    def __init__(self, now=0):
+        self.now = now
+        self.levels = [[[] for _ in range(self.SLOTS)]
+                       for _ in range(LEVELS)]
+        self.active = 0
+
+    def __len__(self):
+        return self.active
+
+    def schedule(self, expires, callback):
+        """
+        Programa ``callback`` para el tick ``expires``.
+
+        :param expires: Tick de vencimiento (si ya ha pasado, vence en el
+            siguiente tick)
+        :param callback: Funcion sin argumentos
+
+        :return: ``Timer`` que se puede cancelar
+        """
+        timer = Timer(max(expires, self.now + 1), callback)
+        self._insert(timer)
+        self.active += 1
+        return timer
+
+    def _insert(self, timer):
+        delta = timer.expires - self.now
+        for level in range(LEVELS):
+            if delta < 1 << (LEVEL_BITS * (level + 1)) or \
+                    level == LEVELS - 1:
+                shift = LEVEL_BITS * level
+                index = (min(timer.expires,
+                             self.now + (1 << (LEVEL_BITS * LEVELS)) - 1)
+                         >> shift) & self.MASK
+                self.levels[level][index].append(timer)
+                return
+
+    def advance(self, now):
+        """
+        Avanza la rueda hasta el tick ``now``.
+
+        :param now: Tick actual
+
+        :return: Lista de temporizadores vencidos y no cancelados
+        """
+        expired = []
+        while self.now < now:
+            self.now += 1
+            tick = self.now
+            # al completar una vuelta se reparten las ranuras superiores
+            level = 1
+            while level < LEVELS and \
+                    (tick & ((1 << (LEVEL_BITS * level)) - 1)) == 0:
+                index = (tick >> (LEVEL_BITS * level)) & self.MASK
+                slot = self.levels[level][index]
+                self.levels[level][index] = []
+                for timer in slot:
+                    self._insert(timer)
+                level += 1
+            slot = self.levels[0][tick & self.MASK]
+            self.levels[0][tick & self.MASK] = []
+            for timer in slot:
+                if timer.expires > tick:
+                    # plazo mas alla del alcance de la rueda: se recoloca
+                    self._insert(timer)
+                    continue
+                self.active -= 1
+                if not timer.cancelled:
+                    expired.append(timer)
+        return expired
+
+
+class GameTimers:
+    """
+    Planificador de los plazos de todas las partidas del proceso.
+
+    El bucle asyncio se arranca en un hilo propio la primera vez que se
+    programa un temporizador.
+
+    :param tick: Segundos por tick
+    :param workers: Hilos que ejecutan los vencimientos
+    """
+
+    def __init__(self, tick=None, workers=None):
+        self._tick = tick
+        self._workers = workers
+        self._lock = threading.Lock()
+        self._wheel = None
+        self._loop = None
+        self._executor = None
+        self._origin = None
+
+    def option(self, name):
+        value = getattr(self, '_' + name.lower(), None)
+        if value is None:
+            options = getattr(settings, 'GAME_TIMERS', {})
+            value = options.get(name, DEFAULTS[name])
+        return value
+
+    @property
+    def enabled(self):
+        return self.option('ENABLED')
+
+    def __len__(self):
+        with self._lock:
+            return len(self._wheel) if self._wheel is not None else 0
+
+    def schedule(self, deadline, callback):
+        """
+        Programa ``callback`` para el instante ``deadline``.
+
+        :param deadline: Instante de ``time.monotonic()``
+        :param callback: Funcion sin argumentos; se ejecuta en un hilo del
+            pool con su propia conexion a la base de datos
+
+        :return: ``Timer`` o None si los temporizadores estan desactivados
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            if self._loop is None:
+                self._start()
+            return self._wheel.schedule(self._ticks(deadline), callback)
+
+    def _ticks(self, instant):
+        # redondeo hacia arriba: un plazo nunca vence antes de tiempo
+        return -int(-(instant - self._origin) // self.option('TICK'))
+
+    def _start(self):
+        self._origin = time.monotonic()
+        self._wheel = TimerWheel()
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.option('WORKERS'),
+            thread_name_prefix='game-timers')
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+        thread = threading.Thread(target=self._run, args=[started],
+                                  name='game-timers', daemon=True)
+        thread.start()
+        started.wait()
+
+    def _run(self, started):
+        asyncio.set_event_loop(self._loop)
+        self._loop.call_soon(started.set)
+        self._loop.call_soon(self._on_tick)
+        self._loop.run_forever()
+
+    def _on_tick(self):
+        tick = self.option('TICK')
+        now = time.monotonic()
+        with self._lock:
+            expired = self._wheel.advance(int((now - self._origin) // tick))
+        for timer in expired:
+            self._loop.run_in_executor(self._executor, self._fire, timer)
+        # el siguiente tick se alinea con la rejilla para no acumular deriva
+        self._loop.call_later(tick - (now - self._origin) % tick,
+                              self._on_tick)
+
+    def _fire(self, timer):
+        try:
+            if not timer.cancelled:
+                timer.callback()
+        except Exception:
+            logger.exception('game timer failed')
+        finally:
+            connection.close()
+
+
+timers = GameTimers()
@@ -0,0 +1,87 @@
+"""
+Tokens firmados de las partidas.
+
+Al unirse a una partida cada participante recibe un token (JWT firmado con
+HMAC) con el PIN de la partida, su ``uuidP`` y su papel; el anfitrion
+recibe otro al crearla. Las peticiones de juego (responder, consultar la
+partida o el podio) se identifican con el token, que se comprueba en
+memoria, en lugar de con la sesion de Django, que cuesta una lectura (y a
+veces una escritura) de ``django_session`` en cada peticion.
+
+La configuracion esta en ``settings.GAME_TOKENS``:
+
+- ``TTL``: segundos de validez de un token.
+- ``ALGORITHM``: algoritmo de firma.
+
+La clave de firma es ``settings.SECRET_KEY``.
+"""
+import time
+from collections import namedtuple
+from uuid import UUID
+
+import jwt
+from django.conf import settings
+
+DEFAULTS = {
+    'TTL': 6 * 3600,
+    'ALGORITHM': 'HS256',
+}
+
+PARTICIPANT = 'participant'
+HOST = 'host'
+ROLES = (PARTICIPANT, HOST)
+
+# cookie con el token del anfitrion en las vistas de ``services``
+HOST_TOKEN_COOKIE = 'game_token'
+
+GameToken = namedtuple('GameToken', ['publicId', 'uuidP', 'role'])
+
+
+class InvalidToken(Exception):
+    """Token mal formado, con firma incorrecta o caducado"""
+
+
+def option(name):
+    options = getattr(settings, 'GAME_TOKENS', {})
+    return options.get(name, DEFAULTS[name])
+
+
+def issue(publicId, role, uuidP=None):
+    """
+    Genera el token de un participante o del anfitrion de una partida.
+
+    :param publicId: PIN de la partida
+    :param role: ``participant`` o ``host``
+    :param uuidP: uuid del participante (solo para ``participant``)
+
+    :return: Token (str)
+    """
+    now = int(time.time())
+    claims = {'pin': publicId, 'role': role, 'iat': now,
+              'exp': now + option('TTL')}
+    if uuidP is not None:
+        claims['sub'] = str(uuidP)
+    return jwt.encode(claims, settings.SECRET_KEY,
+                      algorithm=option('ALGORITHM'))
+
+
+def verify(token):
+    """
+    Comprueba la firma y la caducidad de un token, sin consultas.
+
+    :param token: Token generado por ``issue``
+
+    :return: ``GameToken``
+    :raises InvalidToken: si el token no es valido
+    """
+    try:
+        claims = jwt.decode(token, settings.SECRET_KEY,
+                            algorithms=[option('ALGORITHM')],
+                            options={'require': ['pin', 'role', 'exp']})
+        role = claims['role']
+        uuidP = UUID(claims['sub']) if 'sub' in claims else None
+    except (jwt.InvalidTokenError, ValueError) as error:
+        raise InvalidToken(str(error))
+    if role not in ROLES or (role == PARTICIPANT and uuidP is None):
+        raise InvalidToken('invalid role')
+    return GameToken(claims['pin'], uuidP, role)
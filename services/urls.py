@@ -13,6 +13,8 @@ urlpatterns = [
          views.QuestionnaireUpdate.as_view(), name='questionnaire-update'),
     path('questionnairecreate', views.QuestionnaireCreate.as_view(),
          name='questionnaire-create'),
+    path('questionnairereorder/<int:pk>',
+         views.QuestionnaireReorder.as_view(), name='questionnaire-reorder'),
     path('question/<int:pk>', views.QuestionDetail.as_view(),
          name='question-detail'),
     path('questionremove/<int:pk>',
@@ -31,5 +33,16 @@ urlpatterns = [
          views.GameCreate.as_view(), name='game-create'),
     path('gameUpdateParticipant', views.UpdateParticipant.as_view(),
          name='game-updateparticipant'),
+    path('gameparticipants/<int:publicId>',
+         views.LobbyParticipants.as_view(), name='game-participants'),
     path('gamecountdown', views.CountDown.as_view(), name='game-count-down'),
+    path('gamestate/<int:publicId>', views.GameState.as_view(),
+         name='game-state'),
+    path('gamewait/<int:publicId>', views.game_wait, name='game-wait'),
+    path('metrics', views.Metrics.as_view(), name='metrics'),
+    path('profiles', views.ProfileList.as_view(), name='profile-list'),
+    path('profiles/<str:profile_id>', views.ProfileDetail.as_view(),
+         name='profile-detail'),
+    path('profiles/<str:profile_id>/<str:format>',
+         views.ProfileExport.as_view(), name='profile-export'),
 ]
@@ -1,17 +1,113 @@
+import asyncio
+import hmac
+import io
+import marshal
+from datetime import datetime, timezone
+
 from django.urls import reverse_lazy
 
 from django.views.generic.edit import CreateView, DeleteView, UpdateView
-from django.views.generic import DetailView, ListView, TemplateView
+from django.views.generic import DetailView, ListView, TemplateView, View
 
 from models.models import (
-    Answer, Game, Guess, Participant, Question, Questionnaire)
+    Answer, Game, Participant, Question, Questionnaire)
 
 from django.shortcuts import get_object_or_404
 from django.shortcuts import redirect
+from django.core.exceptions import PermissionDenied
+from django.db.models import Count
+from django.http import (Http404, HttpResponse, HttpResponseBadRequest,
+                         JsonResponse)
+from django.utils.cache import (get_conditional_response, patch_cache_control,
+                                patch_vary_headers, parse_etags)
+
+from django.contrib.auth.mixins import (LoginRequiredMixin,
+                                        UserPassesTestMixin)
+
+from models.constants import ANSWER
+
+from . import metrics, profiling, tokens
+from .engine import aget_session_or_404, get_session_or_404, sessions
+from .realtime import channels
+from .responses import accepted_encoding
+from .snapshot import compile_questionnaire
+
+LEADERBOARD_SIZE = 10
+# participantes que como mucho devuelve cada peticion de la sala de espera
+LOBBY_PAGE = 500
+# segundos que como mucho espera ``game_wait`` un cambio de la partida
+LONG_POLL_TIMEOUT = 25
+
+
+class OwnerRequiredMixin:
+    """
+    Comprueba que el usuario es el propietario del cuestionario.
+
+    El objeto de la vista (o su padre en las vistas de creacion) se carga
+    una sola vez, junto con la cadena hasta su cuestionario en la misma
+    consulta (``select_related``), y se reutiliza durante toda la peticion.
+
+    - ``owner_model``: modelo a cargar; por defecto, el de la vista.
+    - ``owner_kwarg``: argumento de la URL con su clave primaria.
+    - ``owner_path``: ruta desde el objeto hasta su cuestionario, p.ej.
+      ``question__questionnaire``; vacia si el objeto es el cuestionario.
+    """
+    owner_model = None
+    owner_kwarg = 'pk'
+    owner_path = ''
+
+    def get_owned_object(self):
+        """
+        Devuelve el objeto cuyo propietario se comprueba.
+
+        :param self: Instancia de la clase
+
+        :return: Objeto cargado con su cadena de propietarios
+        """
+        if not hasattr(self, '_owned_object'):
+            if self.owner_model is None:
+                queryset = self.get_queryset()
+            else:
+                queryset = self.owner_model._default_manager.all()
+            if self.owner_path:
+                queryset = queryset.select_related(self.owner_path)
+            self._owned_object = get_object_or_404(
+                queryset, pk=self.kwargs[self.owner_kwarg])
+        return self._owned_object
+
+    def get_questionnaire(self):
+        """
+        Devuelve el cuestionario del objeto, sin consultas adicionales.
+
+        :param self: Instancia de la clase
 
-from django.contrib.auth.mixins import LoginRequiredMixin
+        :return: Cuestionario
+        """
+        questionnaire = self.get_owned_object()
+        for name in filter(None, self.owner_path.split('__')):
+            questionnaire = getattr(questionnaire, name)
+        return questionnaire
 
-from models.constants import WAITING, QUESTION, ANSWER, LEADERBOARD
+    def get_object(self, queryset=None):
+        if queryset is None and self.owner_model is None:
+            return self.get_owned_object()
+        return super().get_object(queryset)
+
+    def dispatch(self, request, *args, **kwargs):
+        """
+        Redirige a la lista de cuestionarios si el usuario no es el
+        propietario.
+
+        :param self: Instancia de la clase
+        :param request: Petición HTTP
+        :param args: Argumentos
+        :param kwargs: Argumentos clave
+
+        :return: Respuesta de la vista
+        """
+        if request.user.id != self.get_questionnaire().user_id:
+            return redirect('questionnaire-list')
+        return super().dispatch(request, *args, **kwargs)
 
 
 class Home(TemplateView):
@@ -45,7 +141,7 @@ class Home(TemplateView):
         return context
 
 
-class QuestionnaireDetail(LoginRequiredMixin, DetailView):
+class QuestionnaireDetail(OwnerRequiredMixin, LoginRequiredMixin, DetailView):
     """
     Vista de detalle de un cuestionario.
     
@@ -57,22 +153,17 @@ class QuestionnaireDetail(LoginRequiredMixin, DetailView):
     template_name = 'services/questionnaire_detail.html'
     redirect_field_name = 'login'
 
-    def dispatch(self, request, *args, **kwargs):
+    def get_queryset(self):
         """
-        Comprueba que el usuario que hace la petición es el mismo que el
-        usuario que ha creado el cuestionario.
-        
+        Devuelve el cuestionario con sus preguntas y respuestas, que la
+        plantilla recorre, en tres consultas.
+
         :param self: Instancia de la clase
-        :param request: Petición HTTP
-        :param args: Argumentos
-        :param kwargs: Argumentos clave
-        
-        :return: Redirige a la lista de cuestionarios si el usuario no es el
+
+        :return: QuerySet de cuestionarios
         """
-        questionnaire = self.get_object()
-        if request.user != questionnaire.user:
-            return redirect('questionnaire-list')
-        return super().dispatch(request, *args, **kwargs)
+        return Questionnaire.objects.prefetch_related(
+            'question_set__answer_set')
 
 
 class QuestionnaireList(LoginRequiredMixin, ListView):
@@ -88,7 +179,7 @@ class QuestionnaireList(LoginRequiredMixin, ListView):
     redirect_field_name = 'login'
 
 
-class QuestionnaireRemove(LoginRequiredMixin, DeleteView):
+class QuestionnaireRemove(OwnerRequiredMixin, LoginRequiredMixin, DeleteView):
     """
     Vista de eliminación de un cuestionario.
     
@@ -101,14 +192,8 @@ class QuestionnaireRemove(LoginRequiredMixin, DeleteView):
     success_url = reverse_lazy('questionnaire-list')
     redirect_field_name = 'login'
 
-    def dispatch(self, request, *args, **kwargs):
-        questionnaire = self.get_object()
-        if request.user != questionnaire.user:
-            return redirect('questionnaire-list')
-        return super().dispatch(request, *args, **kwargs)
 
-
-class QuestionnaireUpdate(LoginRequiredMixin, UpdateView):
+class QuestionnaireUpdate(OwnerRequiredMixin, LoginRequiredMixin, UpdateView):
     """
     Vista de actualización de un cuestionario.
     
@@ -135,22 +220,6 @@ class QuestionnaireUpdate(LoginRequiredMixin, UpdateView):
         return reverse_lazy('questionnaire-detail',
                             kwargs={'pk': self.object.id})
 
-    def dispatch(self, request, *args, **kwargs):
-        """
-        Comprueba que el usuario que hace la petición es el mismo que el
-          
-        :param self: Instancia de la clase
-        :param request: Petición HTTP
-        :param args: Argumentos
-        :param kwargs: Argumentos clave
-        
-        :return: Redirige a la lista de cuestionarios si el usuario no es el
-        """
-        questionnaire = self.get_object()
-        if request.user != questionnaire.user:
-            return redirect('questionnaire-list')
-        return super().dispatch(request, *args, **kwargs)
-
 
 class QuestionnaireCreate(LoginRequiredMixin, CreateView):
     """
@@ -192,7 +261,38 @@ class QuestionnaireCreate(LoginRequiredMixin, CreateView):
         return super().form_valid(form)
 
 
-class QuestionDetail(LoginRequiredMixin, DetailView):
+class QuestionnaireReorder(OwnerRequiredMixin, LoginRequiredMixin, View):
+    """
+    Vista de reordenación de las preguntas de un cuestionario.
+
+    Recibe por POST los ids de todas las preguntas (``question``) en el
+    orden nuevo y las renumera de una vez.
+    """
+    redirect_field_name = 'login'
+    http_method_names = ['post']
+    owner_model = Questionnaire
+
+    def post(self, request, *args, **kwargs):
+        """
+        Cambia el orden de las preguntas.
+
+        :param self: Instancia de la clase
+        :param request: Petición HTTP
+        :param args: Argumentos
+        :param kwargs: Argumentos clave
+
+        :return: Redirige al detalle del cuestionario
+        """
+        questionnaire = self.get_owned_object()
+        try:
+            Question.objects.reorder(questionnaire.id,
+                                     request.POST.getlist('question'))
+        except ValueError as error:
+            return HttpResponseBadRequest(str(error))
+        return redirect('questionnaire-detail', pk=questionnaire.id)
+
+
+class QuestionDetail(OwnerRequiredMixin, LoginRequiredMixin, DetailView):
     """
     Vista de detalle de una pregunta.
     
@@ -203,25 +303,20 @@ class QuestionDetail(LoginRequiredMixin, DetailView):
     model = Question
     template_name = 'services/question_detail.html'
     redirect_field_name = 'login'
+    owner_path = 'questionnaire'
 
-    def dispatch(self, request, *args, **kwargs):
+    def get_queryset(self):
         """
-        Comprueba que el usuario que hace la petición es el mismo que el
-        
+        Devuelve la pregunta con sus respuestas, que la plantilla recorre.
+
         :param self: Instancia de la clase
-        :param request: Petición HTTP
-        :param args: Argumentos
-        :param kwargs: Argumentos clave
-        
-        :return: Redirige a la lista de cuestionarios si el usuario no es el
+
+        :return: QuerySet de preguntas
         """
-        questionnaire = self.get_object().questionnaire
-        if request.user != questionnaire.user:
-            return redirect('questionnaire-list')
-        return super().dispatch(request, *args, **kwargs)
+        return Question.objects.prefetch_related('answer_set')
 
 
-class QuestionRemove(LoginRequiredMixin, DeleteView):
+class QuestionRemove(OwnerRequiredMixin, LoginRequiredMixin, DeleteView):
     """
     Vista de eliminación de una pregunta.
     
@@ -232,6 +327,7 @@ class QuestionRemove(LoginRequiredMixin, DeleteView):
     model = Question
     template_name = 'services/question_remove.html'
     redirect_field_name = 'login'
+    owner_path = 'questionnaire'
 
     def get_success_url(self):
         """
@@ -247,24 +343,8 @@ class QuestionRemove(LoginRequiredMixin, DeleteView):
         return reverse_lazy('questionnaire-detail',
                             kwargs={'pk': self.object.questionnaire.id})
 
-    def dispatch(self, request, *args, **kwargs):
-        """
-        Comprueba que el usuario que hace la petición es el mismo que el
-        
-        :param self: Instancia de la clase
-        :param request: Petición HTTP
-        :param args: Argumentos
-        :param kwargs: Argumentos clave
-        
-        :return: Redirige a la lista de cuestionarios si el usuario no es el
-        """
-        questionnaire = self.get_object().questionnaire
-        if request.user != questionnaire.user:
-            return redirect('questionnaire-list')
-        return super().dispatch(request, *args, **kwargs)
 
-
-class QuestionUpdate(LoginRequiredMixin, UpdateView):
+class QuestionUpdate(OwnerRequiredMixin, LoginRequiredMixin, UpdateView):
     """
     Vista de actualización de una pregunta.
     
@@ -276,6 +356,7 @@ class QuestionUpdate(LoginRequiredMixin, UpdateView):
     template_name = 'services/question_update.html'
     fields = ['question', 'answerTime', 'value']
     redirect_field_name = 'login'
+    owner_path = 'questionnaire'
 
     def get_success_url(self):
         """
@@ -290,24 +371,8 @@ class QuestionUpdate(LoginRequiredMixin, UpdateView):
         """
         return reverse_lazy('question-detail', kwargs={'pk': self.object.id})
 
-    def dispatch(self, request, *args, **kwargs):
-        """
-        Comprueba que el usuario que hace la petición es el mismo que el
-        
-        :param self: Instancia de la clase
-        :param request: Petición HTTP
-        :param args: Argumentos
-        :param kwargs: Argumentos clave
-        
-        :return: Redirige a la lista de cuestionarios si el usuario no es el
-        """
-        questionnaire = self.get_object().questionnaire
-        if request.user != questionnaire.user:
-            return redirect('questionnaire-list')
-        return super().dispatch(request, *args, **kwargs)
 
-
-class QuestionCreate(LoginRequiredMixin, CreateView):
+class QuestionCreate(OwnerRequiredMixin, LoginRequiredMixin, CreateView):
     """
     Vista de creación de una pregunta.
     
@@ -319,6 +384,8 @@ class QuestionCreate(LoginRequiredMixin, CreateView):
     template_name = 'services/question_create.html'
     fields = ['question', 'answerTime', 'value']
     redirect_field_name = 'login'
+    owner_model = Questionnaire
+    owner_kwarg = 'questionnaireid'
 
     def get_success_url(self):
         """
@@ -342,30 +409,11 @@ class QuestionCreate(LoginRequiredMixin, CreateView):
         
         :return: Devuelve el formulario
         """
-        questionnaire = get_object_or_404(
-            Questionnaire, pk=self.kwargs['questionnaireid'])
-        form.instance.questionnaire = questionnaire
+        form.instance.questionnaire = self.get_owned_object()
         return super().form_valid(form)
 
-    def dispatch(self, request, *args, **kwargs):
-        """
-        Comprueba que el usuario que hace la petición es el mismo que el
-        
-        :param self: Instancia de la clase
-        :param request: Petición HTTP
-        :param args: Argumentos
-        :param kwargs: Argumentos clave
-        
-        :return: Redirige a la lista de cuestionarios si el usuario no es el
-        """
-        questionnaire = get_object_or_404(
-            Questionnaire, pk=self.kwargs['questionnaireid'])
-        if request.user != questionnaire.user:
-            return redirect('questionnaire-list')
-        return super().dispatch(request, *args, **kwargs)
-
 
-class AnswerCreate(LoginRequiredMixin, CreateView):
+class AnswerCreate(OwnerRequiredMixin, LoginRequiredMixin, CreateView):
     """
     Vista de creación de una respuesta.
     
@@ -377,6 +425,9 @@ class AnswerCreate(LoginRequiredMixin, CreateView):
     template_name = 'services/answer_create.html'
     fields = ['answer', 'correct']
     redirect_field_name = 'login'
+    owner_model = Question
+    owner_kwarg = 'questionid'
+    owner_path = 'questionnaire'
 
     def get_success_url(self):
         """
@@ -401,29 +452,11 @@ class AnswerCreate(LoginRequiredMixin, CreateView):
         
         :return: Devuelve el formulario
         """
-        question = get_object_or_404(Question, pk=self.kwargs['questionid'])
-        form.instance.question = question
+        form.instance.question = self.get_owned_object()
         return super(AnswerCreate, self).form_valid(form)
 
-    def dispatch(self, request, *args, **kwargs):
-        """
-        Comprueba que el usuario que hace la petición es el mismo que el
-        
-        :param self: Instancia de la clase
-        :param request: Petición HTTP
-        :param args: Argumentos
-        :param kwargs: Argumentos clave
-        
-        :return: Redirige a la lista de cuestionarios si el usuario no es el
-        """
-        question = get_object_or_404(Question, pk=self.kwargs['questionid'])
-        questionnaire = question.questionnaire
-        if request.user != questionnaire.user:
-            return redirect('questionnaire-list')
-        return super().dispatch(request, *args, **kwargs)
-
 
-class AnswerRemove(LoginRequiredMixin, DeleteView):
+class AnswerRemove(OwnerRequiredMixin, LoginRequiredMixin, DeleteView):
     """
     Vista de eliminación de una respuesta.
     
@@ -434,6 +467,7 @@ class AnswerRemove(LoginRequiredMixin, DeleteView):
     model = Answer
     template_name = 'services/answer_remove.html'
     redirect_field_name = 'login'
+    owner_path = 'question__questionnaire'
 
     def get_success_url(self):
         """
@@ -449,24 +483,8 @@ class AnswerRemove(LoginRequiredMixin, DeleteView):
         return reverse_lazy('question-detail',
                             kwargs={'pk': self.object.question.id})
 
-    def dispatch(self, request, *args, **kwargs):
-        """
-        Comprueba que el usuario que hace la petición es el mismo que el
-        
-        :param self: Instancia de la clase
-        :param request: Petición HTTP
-        :param args: Argumentos
-        :param kwargs: Argumentos clave
-        
-        :return: Redirige a la lista de cuestionarios si el usuario no es el
-        """
-        questionnaire = self.get_object().question.questionnaire
-        if request.user != questionnaire.user:
-            return redirect('questionnaire-list')
-        return super().dispatch(request, *args, **kwargs)
 
-
-class AnswerUpdate(LoginRequiredMixin, UpdateView):
+class AnswerUpdate(OwnerRequiredMixin, LoginRequiredMixin, UpdateView):
     """
     Vista de actualización de una respuesta.
     
@@ -478,6 +496,7 @@ class AnswerUpdate(LoginRequiredMixin, UpdateView):
     template_name = 'services/answer_update.html'
     fields = ['answer', 'correct']
     redirect_field_name = 'login'
+    owner_path = 'question__questionnaire'
 
     def get_success_url(self):
         """
@@ -493,22 +512,6 @@ class AnswerUpdate(LoginRequiredMixin, UpdateView):
         return reverse_lazy('question-detail',
                             kwargs={'pk': self.object.question.id})
 
-    def dispatch(self, request, *args, **kwargs):
-        """
-        Comprueba que el usuario que hace la petición es el mismo que el
-        
-        :param self: Instancia de la clase
-        :param request: Petición HTTP
-        :param args: Argumentos
-        :param kwargs: Argumentos clave
-        
-        :return: Redirige a la lista de cuestionarios si el usuario no es el
-        """
-        questionnaire = self.get_object().question.questionnaire
-        if request.user != questionnaire.user:
-            return redirect('questionnaire-list')
-        return super().dispatch(request, *args, **kwargs)
-
 
 class GameCreate(LoginRequiredMixin, TemplateView):
     """
@@ -540,14 +543,40 @@ class GameCreate(LoginRequiredMixin, TemplateView):
         if self.request.user.is_authenticated:
             game = Game(questionnaire=questionnaire)
             game.save()
+            # la partida se juega con el cuestionario compilado en memoria
+            compile_questionnaire(questionnaire)
             context['game'] = game
             context['is_owner'] = (questionnaire.user == self.request.user)
             session = self.request.session
             session['gameID'] = game.publicId
             session['game_state'] = game.state
             session['is_owner'] = (questionnaire.user == self.request.user)
+            if context['is_owner']:
+                self.host_token = tokens.issue(game.publicId, tokens.HOST)
         return context
 
+    def get(self, request, *args, **kwargs):
+        """
+        Crea la partida y entrega al anfitrion su token en una cookie.
+
+        :param self: Instancia de la clase
+        :param request: Petición HTTP
+        :param args: Argumentos
+        :param kwargs: Argumentos clave
+
+        :return: Respuesta de la vista
+        """
+        response = super(GameCreate, self).get(request, *args, **kwargs)
+        host_token = getattr(self, 'host_token', None)
+        if host_token is not None:
+            response.set_cookie(tokens.HOST_TOKEN_COOKIE, host_token,
+                                max_age=tokens.option('TTL'),
+                                httponly=True, samesite='Lax')
+        else:
+            # el token de una partida anterior ya no es el de esta
+            response.delete_cookie(tokens.HOST_TOKEN_COOKIE)
+        return response
+
 
 class UpdateParticipant(LoginRequiredMixin, TemplateView):
     """
@@ -580,55 +609,138 @@ class UpdateParticipant(LoginRequiredMixin, TemplateView):
         return context
 
 
+class LobbyParticipants(LoginRequiredMixin, UserPassesTestMixin, View):
+    """
+    Vista de los participantes nuevos de la sala de espera.
+
+    En lugar de volver a pintar todos los alias en cada sondeo, como
+    ``UpdateParticipant``, devuelve en JSON solo los que se han unido
+    despues del cursor ``after`` (el id del ultimo que ya tiene la pagina),
+    como mucho ``LOBBY_PAGE``, junto con el total de participantes. Sale de
+    la sesion en memoria de la partida: con ella cargada, cada sondeo cuesta
+    una busqueda binaria y los participantes nuevos.
+
+    Solo la ve el anfitrion: quien trae el token de anfitrion de la
+    partida o el propietario de su cuestionario (comprobado en la sesion
+    en memoria, sin consultas).
+    """
+    redirect_field_name = 'login'
+
+    def test_func(self):
+        publicId = self.kwargs['publicId']
+        self.game_session = get_session_or_404(publicId)
+        if host_role(self.request, publicId) == tokens.HOST:
+            return True
+        return (self.game_session.game.questionnaire.user_id ==
+                self.request.user.id)
+
+    def get(self, request, publicId, *args, **kwargs):
+        """
+        Devuelve los participantes unidos despues del cursor.
+
+        :param self: Instancia de la clase
+        :param request: Petición HTTP
+        :param publicId: PIN de la partida
+        :param args: Argumentos
+        :param kwargs: Argumentos clave
+
+        :return: Respuesta JSON con los participantes nuevos, el total y el
+            cursor para la siguiente peticion
+        """
+        try:
+            after = int(request.GET.get('after', 0))
+        except ValueError:
+            return HttpResponseBadRequest('invalid cursor')
+        joined, total = self.game_session.joined_after(after, LOBBY_PAGE)
+        return JsonResponse({
+            'participants': [{'id': participant_id, 'alias': alias}
+                             for participant_id, alias in joined],
+            'total': total,
+            'cursor': joined[-1][0] if joined else after,
+            # la pagina esta llena: puede haber mas participantes
+            'more': len(joined) == LOBBY_PAGE,
+        })
+
+
 class CountDown(LoginRequiredMixin, TemplateView):
     """
     Vista de cuenta atrás.
     
     Esta vista se encarga de mostrar la cuenta atrás de un juego.
+    Las transiciones se aplican sobre la sesión en memoria de la partida
+    (``services.engine``), sin releer ni guardar ``Game`` en cada paso.
     
     Autor: Alejandro Monterrubio
     """
     redirect_field_name = 'login'
 
+    def get_game_session(self):
+        """
+        Devuelve la sesión en memoria de la partida del usuario.
+
+        La partida se toma del token del anfitrion (cookie) si lo tiene, y
+        si no de la sesión de Django.
+        
+        :param self: Instancia de la clase
+        
+        :return: Sesión de la partida
+        """
+        if not hasattr(self, 'game_session'):
+            publicId = None
+            cookie = self.request.COOKIES.get(tokens.HOST_TOKEN_COOKIE)
+            if cookie is not None:
+                try:
+                    publicId = tokens.verify(cookie).publicId
+                except tokens.InvalidToken:
+                    pass
+            if publicId is None:
+                publicId = self.request.session.get('gameID')
+            self.game_session = get_session_or_404(publicId)
+        return self.game_session
+
+    def get(self, request, *args, **kwargs):
+        """
+        Avanza la partida y muestra la pantalla resultante.
+
+        Si la pagina del anfitrion recarga al agotarse una cuenta atras,
+        indica en ``expired`` la fase que ha vencido; si el temporizador del
+        servidor ya ha avanzado la partida, no se vuelve a avanzar.
+
+        :param self: Instancia de la clase
+        :param request: Petición HTTP
+        :param args: Argumentos
+        :param kwargs: Argumentos clave
+
+        :return: Respuesta con la pantalla de la partida
+        """
+        game_session = self.get_game_session()
+        expired = request.GET.get('expired')
+        if expired:
+            game_session.expire(expired)
+        else:
+            game_session.advance()
+        self.request.session['game_state'] = game_session.state
+        return super(CountDown, self).get(request, *args, **kwargs)
+
     def get_template_names(self):
         """
         Devuelve el nombre de la plantilla.
         
-        Este metodo se encarga de devolver el nombre de la plantilla.
+        Este metodo se encarga de devolver el nombre de la plantilla de la
+        pantalla a la que ha llevado la ultima transicion.
         
         :param self: Instancia de la clase
         
         :return: Nombre de la plantilla
         """
-        gameID = self.request.session.get('gameID')
-        game = get_object_or_404(Game, publicId=gameID)
-        if game.state == WAITING:
-            game.state = QUESTION
-            game.save()
-            self.request.session['game_state'] = game.state
-            return 'services/game_countdown.html'
-        elif game.state == QUESTION:
-            game.state = ANSWER
-            game.save()
-            self.request.session['game_state'] = game.state
-            return 'services/game_question.html'
-        elif game.state == ANSWER:
-            if game.questionNo == game.questionnaire.question_set.count()-1:
-                game.state = LEADERBOARD
-            else:
-                game.questionNo += 1
-                game.state = QUESTION
-            self.request.session['game_state'] = game.state
-            game.save()
-            return 'services/game_answer.html'
-        else:
-            return 'services/game_leaderboard.html'
+        return [self.get_game_session().screen.template]
 
     def get_context_data(self, **kwargs):
         """
         Devuelve el contexto de la vista.
         
-        Este metodo se encarga de devolver el contexto de la vista.
+        Este metodo se encarga de devolver el contexto de la vista, con la
+        partida tal como estaba antes de la ultima transicion.
         
         :param self: Instancia de la clase
         :param kwargs: Argumentos clave
@@ -636,16 +748,409 @@ class CountDown(LoginRequiredMixin, TemplateView):
         :return: Contexto de la vista
         """
         context = super(CountDown, self).get_context_data(**kwargs)
-        gameID = self.request.session.get('gameID')
-        game = get_object_or_404(Game, publicId=gameID)
-        context['game'] = game
-        question = game.questionnaire.question_set.all()[game.questionNo]
+        game_session = self.get_game_session()
+        screen = game_session.screen
+        context['game'] = game_session.game
+        context['phase'] = screen.phase
+        # pregunta y respuestas desde el cuestionario compilado
+        if screen.questionNo >= len(game_session.questions):
+            raise Http404('No Question matches the given query.')
+        question = game_session.questions[screen.questionNo]
         context['question'] = question
-        if game.state == ANSWER:
-            guesses = Guess.objects.filter(question=question, game=game)
-            participants = Participant.objects.filter(game=game).count()
-            correct = guesses.filter(answer__correct=True).count()
+        # podio desde la clasificacion en memoria, sin cargar participantes
+        leaderboard = game_session.leaderboard
+        context['leaderboard'] = leaderboard.top(LEADERBOARD_SIZE)
+        context['participant_count'] = len(leaderboard)
+        if screen.state == ANSWER:
+            # reparto de respuestas desde los contadores de la sesion
+            participants = len(leaderboard)
+            distribution = []
+            correct = 0
+            for answer, count in game_session.distribution(question.id):
+                if answer.correct:
+                    correct += count
+                distribution.append({
+                    'answer': answer.answer,
+                    'correct': answer.correct,
+                    'count': count,
+                    'percentage': round(count/participants*100, 2)
+                    if participants > 0 else 0,
+                })
+            context['distribution'] = distribution
             context['percentage'] = round(
                 correct/participants*100, 2) if participants > 0 else 0
 
         return context
+
+
+def state_response(request, game_session, role=tokens.PARTICIPANT):
+    """
+    Respuesta con el estado compacto de la partida y su version como
+    ``ETag``, o 304 si el cliente ya la tiene (``If-None-Match``).
+
+    El cuerpo sale ya codificado (y comprimido si el cliente lo acepta) de
+    la cache de la sesion (``services.responses``): todas las peticiones de
+    una misma version comparten el mismo buffer. Cada variante (papel y
+    codificacion) tiene su propio ``ETag``.
+
+    :param request: Petición HTTP
+    :param game_session: Sesion de la partida
+    :param role: ``tokens.PARTICIPANT`` o ``tokens.HOST``
+
+    :return: Respuesta JSON o 304
+    """
+    with game_session.lock:
+        version = game_session.version
+        body, encoding = game_session.responses.body(
+            game_session, version, role, accepted_encoding(request))
+        etag = state_etag(game_session, version, role, encoding)
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = HttpResponse(body, content_type='application/json')
+            if encoding is not None:
+                response['Content-Encoding'] = encoding
+            response['Content-Length'] = len(body)
+    response['ETag'] = etag
+    # el papel sale de la cookie (services) o del token (restServer)
+    patch_vary_headers(response,
+                       ('Accept-Encoding', 'Cookie', 'Authorization'))
+    # se puede guardar pero hay que revalidarlo en cada sondeo; la del
+    # anfitrion, que muestra las respuestas correctas, solo en su navegador
+    if role == tokens.HOST:
+        patch_cache_control(response, no_cache=True, private=True)
+    else:
+        patch_cache_control(response, no_cache=True)
+    return response
+
+
+def host_role(request, publicId):
+    """
+    Papel de quien pide el estado en las vistas de ``services``: anfitrion
+    si trae el token de anfitrion de la partida en su cookie.
+
+    :param request: Petición HTTP
+    :param publicId: PIN de la partida
+
+    :return: ``tokens.HOST`` o ``tokens.PARTICIPANT``
+    """
+    cookie = request.COOKIES.get(tokens.HOST_TOKEN_COOKIE)
+    if cookie is not None:
+        try:
+            token = tokens.verify(cookie)
+        except tokens.InvalidToken:
+            token = None
+        if token is not None and token.role == tokens.HOST and \
+                token.publicId == publicId:
+            return tokens.HOST
+    return tokens.PARTICIPANT
+
+
+def state_version(game_session, version=None):
+    """
+    Partida y version actual (o ``version``) como ``pk.version``; el pk
+    distingue partidas que han reutilizado el PIN.
+    """
+    if version is None:
+        version = game_session.version
+    return '%d.%d' % (game_session.game.pk, version)
+
+
+def state_etag(game_session, version, role, encoding):
+    """
+    ETag de una variante de la respuesta de estado.
+
+    :param game_session: Sesion de la partida
+    :param version: Version de la partida
+    :param role: ``tokens.PARTICIPANT`` o ``tokens.HOST``
+    :param encoding: ``br``, ``gzip`` o None
+
+    :return: ETag ``"pk.version-papel-codificacion"``
+    """
+    return '"%s-%s-%s"' % (state_version(game_session, version), role,
+                           encoding or 'identity')
+
+
+def etag_version(etag):
+    """Parte ``pk.version`` de un ETag de ``state_etag``"""
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    return etag.strip('"').split('-', 1)[0]
+
+
+class GameState(View):
+    """
+    Vista del estado de una partida en JSON.
+
+    Para los clientes que no pueden usar WebSocket y sondean
+    ``UpdateParticipant`` o ``CountDown``: en lugar de la pagina completa
+    devuelve el estado compacto de la partida con su version
+    (``GameSession.version``) como ``ETag``. Si el cliente trae esa misma
+    version en ``If-None-Match`` responde 304 sin cuerpo; con la sesion ya
+    en memoria no se consulta la base de datos.
+    """
+
+    def get(self, request, publicId, *args, **kwargs):
+        """
+        Devuelve el estado de la partida o 304 si no ha cambiado.
+
+        :param self: Instancia de la clase
+        :param request: Petición HTTP
+        :param publicId: PIN de la partida
+        :param args: Argumentos
+        :param kwargs: Argumentos clave
+
+        :return: Respuesta JSON con el estado de la partida
+        """
+        return state_response(request, get_session_or_404(publicId),
+                              host_role(request, publicId))
+
+
+async def game_wait(request, publicId):
+    """
+    Espera al siguiente estado de una partida (long polling).
+
+    Respaldo de los WebSocket para las redes que los bloquean. Con el
+    ``ETag`` de ``GameState`` en ``If-None-Match``, retiene la peticion
+    hasta que cambia la version de la partida (sea cual sea la variante
+    del ``ETag``) y entonces responde como
+    ``GameState``; si no cambia en ``timeout`` segundos (como mucho
+    ``LONG_POLL_TIMEOUT``) responde 304. Sin ``If-None-Match`` responde en
+    el acto.
+
+    Es una vista asincrona (Django 3.2 no admite vistas de clase
+    asincronas): bajo ASGI (``kahootclone.asgi``) la espera no ocupa un
+    hilo, solo una cola de ``services.realtime`` que despierta con cada
+    evento de la partida. Bajo WSGI ocupa el worker mientras espera.
+
+    :param request: Petición HTTP
+    :param publicId: PIN de la partida
+
+    :return: Respuesta JSON con el estado de la partida o 304
+    """
+    try:
+        timeout = float(request.GET.get('timeout', LONG_POLL_TIMEOUT))
+    except ValueError:
+        timeout = None
+    if timeout is None or not timeout >= 0:
+        return HttpResponseBadRequest('invalid timeout')
+    timeout = min(timeout, LONG_POLL_TIMEOUT)
+    game_session = await aget_session_or_404(publicId)
+    versions = {etag_version(etag) for etag in
+                parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))}
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    # suscrita antes de comprobar la version, para no perder el cambio
+    subscription = channels.subscribe(publicId)
+    try:
+        while state_version(game_session) in versions:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(subscription[1].get(), remaining)
+            except asyncio.TimeoutError:
+                break
+    finally:
+        channels.unsubscribe(publicId, subscription)
+    return state_response(request, game_session,
+                          host_role(request, publicId))
+
+
+class Metrics(View):
+    """
+    Vista de metricas.
+
+    Sirve en formato Prometheus las metricas de las peticiones de este
+    proceso (``services.metrics``), las partidas por estado y las sesiones
+    en memoria. Solo la pueden ver los administradores o quien presente el
+    token de ``settings.GAME_METRICS['TOKEN']`` (``Authorization: Bearer``).
+    """
+
+    def has_permission(self, request):
+        """
+        Comprueba si la peticion puede leer las metricas.
+
+        :param self: Instancia de la clase
+        :param request: Petición HTTP
+
+        :return: True si es un administrador o trae el token
+        """
+        if request.user.is_staff:
+            return True
+        token = metrics.option('TOKEN')
+        header = request.META.get('HTTP_AUTHORIZATION', '')
+        return bool(token) and hmac.compare_digest(
+            header.encode(), ('Bearer %s' % token).encode())
+
+    def get(self, request, *args, **kwargs):
+        """
+        Devuelve las metricas.
+
+        :param self: Instancia de la clase
+        :param request: Petición HTTP
+        :param args: Argumentos
+        :param kwargs: Argumentos clave
+
+        :return: Respuesta en texto con las metricas
+        """
+        if not self.has_permission(request):
+            raise PermissionDenied
+        by_state = (Game.objects.order_by().values('state')
+                    .annotate(count=Count('id'))
+                    .values_list('state', 'count'))
+        gauges = [
+            ('games', 'Games by state.',
+             [((('state', str(state)),), count)
+              for state, count in sorted(by_state)]),
+            ('game_sessions', 'Game sessions loaded in this process.',
+             [((), len(sessions))]),
+        ]
+        return HttpResponse(metrics.metrics.render(gauges),
+                            content_type=metrics.CONTENT_TYPE)
+
+
+class StaffRequiredMixin(UserPassesTestMixin):
+    """Solo para administradores (``is_staff``)"""
+
+    def test_func(self):
+        return self.request.user.is_staff
+
+
+class ProfileList(StaffRequiredMixin, TemplateView):
+    """
+    Vista de los perfiles de peticiones.
+
+    Lista los perfiles guardados por ``services.profiling``, muestra el
+    valor de la cabecera ``X-Profile`` y permite activar o desactivar el
+    perfilado por muestreo.
+    """
+    template_name = 'services/profile_list.html'
+
+    def get_context_data(self, **kwargs):
+        """
+        Devuelve el contexto de la vista.
+
+        :param self: Instancia de la clase
+        :param kwargs: Argumentos clave
+
+        :return: Contexto de la vista
+        """
+        context = super(ProfileList, self).get_context_data(**kwargs)
+        profiles = []
+        for profile_id in profiling.profile_ids():
+            try:
+                profiles.append(profiling.load(profile_id))
+            except KeyError:
+                # borrado por otro worker mientras tanto
+                continue
+        context['profiles'] = profiles
+        toggle = profiling.toggle.state()
+        if toggle['until']:
+            toggle['until_time'] = datetime.fromtimestamp(toggle['until'],
+                                                          timezone.utc)
+        context['toggle'] = toggle
+        context['header'] = profiling.sign()
+        context['header_max_age'] = profiling.option('HEADER_MAX_AGE')
+        context['sample_rate'] = profiling.option('SAMPLE_RATE')
+        context['views'] = profiling.option('VIEWS')
+        context['enabled'] = profiling.option('ENABLED')
+        return context
+
+    def post(self, request, *args, **kwargs):
+        """
+        Activa (``minutes``, ``rate`` y ``views``, nombres de URL separados
+        por comas o espacios) o desactiva el perfilado por muestreo.
+
+        :param self: Instancia de la clase
+        :param request: Petición HTTP
+        :param args: Argumentos
+        :param kwargs: Argumentos clave
+
+        :return: Redireccion a la lista de perfiles
+        """
+        if request.POST.get('action') == 'disable':
+            profiling.toggle.disable()
+            return redirect('profile-list')
+        try:
+            minutes = float(request.POST.get('minutes', 10))
+            rate = float(request.POST.get('rate',
+                                          profiling.option('SAMPLE_RATE')))
+        except ValueError:
+            return HttpResponseBadRequest('minutes and rate must be numbers')
+        if not (minutes > 0 and 0 < rate <= 1):
+            return HttpResponseBadRequest('invalid minutes or rate')
+        views = [name for value in request.POST.getlist('views')
+                 for name in value.replace(',', ' ').split()]
+        unknown = [name for name in views if not profiling.known_view(name)]
+        if unknown:
+            return HttpResponseBadRequest(
+                'unknown URL names: %s' % ', '.join(unknown))
+        profiling.toggle.enable(minutes, rate, views)
+        return redirect('profile-list')
+
+
+class ProfileDetail(StaffRequiredMixin, TemplateView):
+    """
+    Vista de un perfil.
+
+    Muestra las funciones con mas tiempo acumulado y el log SQL de la
+    peticion perfilada.
+    """
+    template_name = 'services/profile_detail.html'
+
+    def get_context_data(self, **kwargs):
+        """
+        Devuelve el contexto de la vista.
+
+        :param self: Instancia de la clase
+        :param kwargs: Argumentos clave
+
+        :return: Contexto de la vista
+        """
+        context = super(ProfileDetail, self).get_context_data(**kwargs)
+        try:
+            profile = profiling.load(self.kwargs['profile_id'])
+            stats = profiling.load_stats(self.kwargs['profile_id'])
+        except KeyError:
+            raise Http404('No profile matches the given query.')
+        output = io.StringIO()
+        stats.stream = output
+        stats.sort_stats('cumulative').print_stats(40)
+        context['profile'] = profile
+        context['stats'] = output.getvalue()
+        return context
+
+
+class ProfileExport(StaffRequiredMixin, View):
+    """
+    Descarga de un perfil: ``folded`` (pilas plegadas para flamegraph.pl
+    o speedscope) o ``pstats`` (fichero de ``cProfile``).
+    """
+
+    def get(self, request, profile_id, format):
+        """
+        Devuelve el perfil en el formato pedido.
+
+        :param self: Instancia de la clase
+        :param request: Petición HTTP
+        :param profile_id: Id del perfil
+        :param format: ``folded`` o ``pstats``
+
+        :return: Fichero adjunto
+        """
+        if format not in ('folded', 'pstats'):
+            raise Http404('Unknown profile format.')
+        try:
+            stats = profiling.load_stats(profile_id)
+        except KeyError:
+            raise Http404('No profile matches the given query.')
+        if format == 'folded':
+            content = '\n'.join(profiling.collapsed_stacks(stats)) + '\n'
+            content_type = 'text/plain; charset=utf-8'
+        else:
+            content = marshal.dumps(stats.stats)
+            content_type = 'application/octet-stream'
+        response = HttpResponse(content, content_type=content_type)
+        response['Content-Disposition'] = \
+            'attachment; filename="%s.%s"' % (profile_id, format)
+        return response
@@ -0,0 +1,35 @@
+#!/usr/bin/env bash
+#
+# Start the web server: ./start.sh [wsgi|asgi]
+#
+#   wsgi  gunicorn with sync workers (kahootclone.wsgi), one request per
+#         worker at a time.
+#   asgi  gunicorn with uvicorn workers (kahootclone.asgi): the async play
+#         API (/api/play/), WebSockets and long polling share one event loop
+#         per worker, and the database is reached through a bounded pool of
+#         GAME_ASYNC_THREADS threads (services.executor).
+#
+# The profile can also be chosen with SERVER_PROFILE. PORT, WEB_CONCURRENCY
+# (workers) and GAME_ASYNC_THREADS are read from the environment. With more
+# than one worker the game events must go through the hub (GAME_EVENTS=unix).
+
+set -o errexit  # exit on error
+
+PROFILE=${1:-${SERVER_PROFILE:-wsgi}}
+BIND=0.0.0.0:${PORT:-8000}
+
+case "$PROFILE" in
+    wsgi)
+        exec gunicorn kahootclone.wsgi --bind "$BIND" \
+            --workers "${WEB_CONCURRENCY:-4}"
+        ;;
+    asgi)
+        exec gunicorn kahootclone.asgi --bind "$BIND" \
+            --worker-class uvicorn.workers.UvicornWorker \
+            --workers "${WEB_CONCURRENCY:-1}"
+        ;;
+    *)
+        echo "usage: $0 [wsgi|asgi]" >&2
+        exit 2
+        ;;
+esac